@@ -0,0 +1,101 @@
+"""
+Synthetic exam corpora in QTI-compatible text format.
+"""
+
+import os
+import random
+
+INDENT_SIZE = 6
+
+PTYPES = ["mctf", "true_false", "shortans"]
+
+WORDS = (
+    "dữ liệu bảng khóa chính truy vấn chỉ mục giao dịch nhiệt độ vận tốc "
+    "neural network gradient database relation schema entropy energy mass"
+).split()
+
+
+def _get_sentence(rng: random.Random, n_words: int):
+    return " ".join(rng.choice(WORDS) for _ in range(n_words)).capitalize() + "."
+
+
+def _get_paragraph(rng: random.Random, n_sentences: int):
+    return " ".join(_get_sentence(rng, rng.randint(6, 14)) for _ in range(n_sentences))
+
+
+def _format(prefix: str, s: str):
+    lines = s.splitlines()
+    return "\n".join(
+        [prefix.ljust(INDENT_SIZE) + lines[0]]
+        + [f"{' ' * INDENT_SIZE}{line}" if line else "" for line in lines[1:]]
+    )
+
+
+def create_medias(media_dir: str, n_images: int = 4, n_audios: int = 1):
+    """
+    Write a few small media files, to be shared between problems.
+    Return the list of their paths.
+    """
+
+    import numpy as np
+    import soundfile as sf
+    from PIL import Image
+
+    os.makedirs(media_dir, exist_ok=True)
+
+    medias = []
+    for i in range(n_images):
+        media_path = os.path.join(media_dir, f"image_{i}.{'png' if i % 2 else 'jpg'}")
+        Image.new("RGB", (640, 480), (40 * i % 256, 90, 160)).save(media_path)
+        medias.append(media_path)
+    for i in range(n_audios):
+        media_path = os.path.join(media_dir, f"audio_{i}.mp3")
+        sf.write(media_path, np.zeros(8000), 8000)
+        medias.append(media_path)
+
+    return medias
+
+
+def generate_corpus(
+    n_problems: int,
+    medias: list = None,
+    media_rate: float = 0.1,
+    seed: int = 0,
+):
+    """
+    Generate n_problems problems with a mix of multiple choice (mctf), true/false
+    (shortans encoded as a string of D/S) and numeric short answer problems.
+
+    :param medias: Paths to media files, some of which are attached to problems.
+    :param media_rate: Probability that a problem has a media attached.
+    """
+
+    rng = random.Random(seed)
+    chunks = []
+
+    for i in range(n_problems):
+        ptype = PTYPES[rng.randrange(len(PTYPES))]
+        question = f"[{i}] {_get_paragraph(rng, rng.randint(1, 4))}"
+
+        if ptype == "true_false":
+            question += "".join(
+                f"\n\n{chr(ord('a') + j)}) {_get_sentence(rng, 10)}" for j in range(4)
+            )
+        if medias and rng.random() < media_rate:
+            media_path = rng.choice(medias)
+            question += f"\n\n![media]({os.path.abspath(media_path)})"
+
+        chunks.append(_format("1.", question))
+        chunks.append(_format("...", _get_paragraph(rng, rng.randint(2, 6))))
+
+        if ptype == "mctf":
+            i_correct = rng.randrange(4)
+            for j in range(4):
+                prefix = f"{'*' if j == i_correct else ''}{chr(ord('a') + j)})"
+                chunks.append(_format(prefix, f"{_get_sentence(rng, 5)} ({j})"))
+        elif ptype == "true_false":
+            chunks.append(_format("*", "".join(rng.choice("DS") for _ in range(4))))
+        else:
+            chunks.append(_format("*", str(rng.randint(0, 1000))))
+
+    return "\n\n".join(chunks) + "\n"
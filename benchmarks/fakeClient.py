@@ -0,0 +1,200 @@
+"""
+Local stand-in for `google.genai.Client`, so that the pipeline can run without
+an API key or network access.
+"""
+
+import asyncio
+import itertools
+import json
+import random
+import time
+
+from google import genai
+from google.genai import errors, types
+
+
+class FakeSettings:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        latency_jitter: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+        canned: dict = None,
+        chunk_size: int = 64,
+    ):
+        """
+        :param latency: Seconds spent per request.
+        :param latency_jitter: Extra random seconds, uniformly drawn, per request.
+        :param error_rate: Probability of a request failing with a 503 error.
+        :param seed: Seed of the random generator.
+        :param canned: Canned responses, keyed by the title of the response schema.
+        :param chunk_size: Number of characters per chunk of streamed responses.
+        """
+
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.canned = canned or {}
+        self.chunk_size = chunk_size
+        self.n_requests = 0
+        self.n_errors = 0
+
+
+SETTINGS = FakeSettings()
+
+_counter = itertools.count()
+
+
+def _get_fake_value(schema: dict, defs: dict):
+    if "$ref" in schema:
+        return _get_fake_value(defs[schema["$ref"].split("/")[-1]], defs)
+    if "anyOf" in schema:
+        return _get_fake_value(schema["anyOf"][0], defs)
+
+    schema_type = schema.get("type")
+    if schema_type == "object":
+        return {
+            key: _get_fake_value(value, defs)
+            for key, value in schema.get("properties", {}).items()
+        }
+    if schema_type == "array":
+        return [
+            _get_fake_value(schema["items"], defs)
+            for _ in range(schema.get("minItems", 1))
+        ]
+    if schema_type == "integer":
+        return next(_counter)
+    if schema_type == "number":
+        return next(_counter) / 4
+    if schema_type == "boolean":
+        return True
+
+    # Strings are unique, since e.g. text2qti rejects duplicate choices.
+    return f"Lorem ipsum dolor sit amet {next(_counter)}."
+
+
+def get_fake_response_text(config: dict):
+    schema = (config or {}).get("response_schema")
+    if schema is None:
+        return f"1.    Lorem ipsum {next(_counter)}?\n\n*a)   Yes.\n\nb)    No.\n"
+
+    schema = schema.model_json_schema()
+    if schema.get("title") in SETTINGS.canned:
+        return SETTINGS.canned[schema["title"]]
+
+    return json.dumps(
+        _get_fake_value(schema, schema.get("$defs", {})), ensure_ascii=False
+    )
+
+
+def _get_fake_response(contents, config: dict):
+    SETTINGS.n_requests += 1
+    if SETTINGS.random.random() < SETTINGS.error_rate:
+        SETTINGS.n_errors += 1
+        raise errors.ServerError(
+            503,
+            {
+                "error": {
+                    "code": 503,
+                    "message": "The model is overloaded.",
+                    "status": "UNAVAILABLE",
+                }
+            },
+        )
+
+    text = get_fake_response_text(config)
+    return types.GenerateContentResponse(
+        candidates=[
+            types.Candidate(
+                content=types.Content(role="model", parts=[types.Part(text=text)]),
+                finish_reason=types.FinishReason.STOP,
+            )
+        ],
+        usage_metadata=types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=len(str(contents)) // 4,
+            candidates_token_count=len(text) // 4,
+            total_token_count=(len(str(contents)) + len(text)) // 4,
+        ),
+    )
+
+
+def _get_fake_chunks(response: types.GenerateContentResponse):
+    text = response.text
+    for i in range(0, len(text), SETTINGS.chunk_size):
+        yield types.GenerateContentResponse(
+            candidates=[
+                types.Candidate(
+                    content=types.Content(
+                        role="model",
+                        parts=[types.Part(text=text[i : i + SETTINGS.chunk_size])],
+                    ),
+                    finish_reason=(
+                        response.candidates[0].finish_reason
+                        if i + SETTINGS.chunk_size >= len(text)
+                        else None
+                    ),
+                )
+            ],
+            usage_metadata=response.usage_metadata,
+        )
+
+
+def _get_latency():
+    return SETTINGS.latency + SETTINGS.random.random() * SETTINGS.latency_jitter
+
+
+class FakeModels:
+    def generate_content(self, *, model: str, contents, config: dict = None):
+        time.sleep(_get_latency())
+        return _get_fake_response(contents, config)
+
+    def generate_content_stream(self, *, model: str, contents, config: dict = None):
+        response = _get_fake_response(contents, config)
+        chunks = list(_get_fake_chunks(response))
+        for chunk in chunks:
+            time.sleep(_get_latency() / len(chunks))
+            yield chunk
+
+
+class FakeAsyncModels:
+    async def generate_content(self, *, model: str, contents, config: dict = None):
+        await asyncio.sleep(_get_latency())
+        return _get_fake_response(contents, config)
+
+    async def generate_content_stream(
+        self, *, model: str, contents, config: dict = None
+    ):
+        response = _get_fake_response(contents, config)
+        chunks = list(_get_fake_chunks(response))
+
+        async def _stream():
+            for chunk in chunks:
+                await asyncio.sleep(_get_latency() / len(chunks))
+                yield chunk
+
+        return _stream()
+
+
+class FakeAsyncClient:
+    def __init__(self):
+        self.models = FakeAsyncModels()
+
+
+class FakeClient:
+    def __init__(self, *args, **kwargs):
+        self.models = FakeModels()
+        self.aio = FakeAsyncClient()
+
+
+def install(**kwargs):
+    """
+    Replace `google.genai.Client` with `FakeClient`. Must be called before any
+    handler is loaded.
+    """
+
+    global SETTINGS
+    SETTINGS = FakeSettings(**kwargs)
+    genai.Client = FakeClient
+    return SETTINGS
@@ -0,0 +1,406 @@
+"""
+End-to-end benchmarks of the exam generation pipeline.
+
+Run from the root of the repository:
+
+    python -m benchmarks.run
+"""
+
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import warnings
+from tempfile import TemporaryDirectory
+
+from clize import run
+from rich import print
+from rich.table import Table
+
+from benchmarks import fakeClient
+from benchmarks.corpus import create_medias, generate_corpus
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(ROOT_DIR, "benchmarks", "baseline.json")
+
+PROBLEMS_PER_BATCH = 10
+
+
+def _setup_content_handler(
+    n_problems: int, tmpdir: str, latency: float, stream: bool = False
+):
+    from handlers import content_handler
+
+    config_per_prompt = {
+        f"batch_{i}": {
+            "mode": "generated",
+            "prompt": "informatics/database.txt",
+            "handler": "multiple_choice/default",
+            "n_problems": min(PROBLEMS_PER_BATCH, n_problems - i * PROBLEMS_PER_BATCH),
+        }
+        for i in range(-(-n_problems // PROBLEMS_PER_BATCH))
+    }
+
+    def _run():
+        with TemporaryDirectory(dir=tmpdir) as path:
+            # Token stats of the fake client must not size real requests.
+            content_handler(
+                path,
+                {
+                    "max_concurrency": 8,
+                    "stream": stream,
+                    "token_stats": os.path.join(path, "token_stats.json"),
+                },
+                config_per_prompt,
+            )
+
+    return _run
+
+
+def _setup_content_handler_stream(n_problems: int, tmpdir: str, latency: float):
+    return _setup_content_handler(n_problems, tmpdir, latency, stream=True)
+
+
+def _setup_txt_to_json(n_problems: int, tmpdir: str, latency: float):
+    from handlers.contentHandler import txt_to_json
+
+    content = generate_corpus(n_problems, create_medias(os.path.join(tmpdir, "media")))
+
+    def _run():
+        txt_to_json(content)
+
+    return _run
+
+
+def _setup_json_to_txt(n_problems: int, tmpdir: str, latency: float):
+    from handlers.contentHandler import json_to_txt, txt_to_json
+
+    problems = txt_to_json(
+        generate_corpus(n_problems, create_medias(os.path.join(tmpdir, "media")))
+    )
+
+    def _run():
+        with TemporaryDirectory(dir=tmpdir) as path:
+            json_to_txt(problems, path, with_hidden_uuid=True)
+
+    return _run
+
+
+def _setup_write_content(n_problems: int, tmpdir: str, latency: float):
+    from handlers.contentHandler import txt_to_json, write_content
+
+    problems = txt_to_json(
+        generate_corpus(n_problems, create_medias(os.path.join(tmpdir, "media")))
+    )
+
+    def _run():
+        with TemporaryDirectory(dir=tmpdir) as path:
+            write_content(
+                problems,
+                path,
+                os.path.join(path, "content.txt"),
+                os.path.join(path, "content_clean.txt"),
+            )
+
+    return _run
+
+
+def _write_corpus(n_problems: int, tmpdir: str):
+    content_dir = os.path.join(tmpdir, "content.txt")
+    with open(content_dir, "w", encoding="utf-8") as f:
+        f.write(
+            generate_corpus(n_problems, create_medias(os.path.join(tmpdir, "media")))
+        )
+    return content_dir
+
+
+def _setup_docx_handler(n_problems: int, tmpdir: str, latency: float):
+    from handlers import docx_handler
+
+    content_dir = _write_corpus(n_problems, tmpdir)
+
+    def _run():
+        with TemporaryDirectory(dir=tmpdir) as path:
+            docx_handler(content_dir, path)
+
+    return _run
+
+
+def _setup_docx_handler_incremental(n_problems: int, tmpdir: str, latency: float):
+    from handlers import docx_handler
+
+    content_dir = _write_corpus(n_problems, tmpdir)
+    with open(content_dir, "r", encoding="utf-8") as f:
+        content = f.read()
+    path = os.path.join(tmpdir, "out")
+    os.makedirs(path)
+    docx_handler(content_dir, path)
+
+    # Each run edits 3 questions, then rebuilds in the same output directory.
+    n_runs = [0]
+
+    def _run():
+        n_runs[0] += 1
+        with open(content_dir, "w", encoding="utf-8") as f:
+            f.write(content.replace("\n1.    ", f"\n1.    Edit {n_runs[0]}. ", 3))
+        docx_handler(content_dir, path)
+
+    return _run
+
+
+def _setup_qti_handler(n_problems: int, tmpdir: str, latency: float):
+    from handlers import qti_handler
+
+    content_dir = _write_corpus(n_problems, tmpdir)
+
+    def _run():
+        with TemporaryDirectory(dir=tmpdir) as path:
+            qti_handler(content_dir, path)
+
+    return _run
+
+
+def _setup_dedup(n_problems: int, tmpdir: str, latency: float):
+    from handlers.contentHandler import txt_to_json
+    from handlers.dedup import DedupIndex
+
+    problems = txt_to_json(
+        generate_corpus(n_problems, create_medias(os.path.join(tmpdir, "media")))
+    )
+
+    def _run():
+        DedupIndex().filter(problems, "batch_0", drop=True)
+
+    return _run
+
+
+SCENARIOS = {
+    "content_handler": _setup_content_handler,
+    "content_handler_stream": _setup_content_handler_stream,
+    "txt_to_json": _setup_txt_to_json,
+    "json_to_txt": _setup_json_to_txt,
+    "write_content": _setup_write_content,
+    "docx_handler": _setup_docx_handler,
+    "docx_handler_incremental": _setup_docx_handler_incremental,
+    "qti_handler": _setup_qti_handler,
+    "dedup": _setup_dedup,
+}
+
+
+def _time(func, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def _measure_memory(n_problems: int, tmpdir: str):
+    """
+    Return the memory in bytes held by the problems parsed from a corpus.
+    """
+
+    from handlers.contentHandler import txt_to_json
+
+    content = generate_corpus(n_problems, create_medias(os.path.join(tmpdir, "media")))
+
+    tracemalloc.start()
+    problems = txt_to_json(content)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    del problems
+    return memory
+
+
+def _measure_throughput(n_problems: int, tmpdir: str, repeat: int):
+    """
+    Return the time in seconds to parse a corpus file with iter_problems, along
+    with the size of the file in bytes.
+    """
+
+    from handlers.contentHandler import iter_problems
+
+    content_dir = _write_corpus(n_problems, tmpdir)
+
+    def _run():
+        with open(content_dir, "r", encoding="utf-8") as f:
+            for _ in iter_problems(f):
+                pass
+
+    return (_time(_run, repeat), os.path.getsize(content_dir))
+
+
+def _load_baseline(baseline_path: str):
+    if not os.path.isfile(baseline_path):
+        return {}
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        return json.load(f).get("results", {})
+
+
+def main(
+    *,
+    sizes: str = "10,100,1000",
+    scenarios: str = ",".join(SCENARIOS),
+    repeat: int = 3,
+    latency: float = 0.05,
+    baseline: str = BASELINE_PATH,
+    save_baseline: bool = False,
+    tolerance: float = 0.25,
+    memory: bool = True,
+    throughput: bool = True,
+):
+    """
+    Time each scenario for several numbers of problems, and compare the results
+    against a stored baseline.
+
+    :param sizes: Comma-separated numbers of problems, from 10 up to 100000.
+    :param scenarios: Comma-separated names of scenarios to run.
+    :param repeat: Number of runs per measurement, the fastest one is kept.
+    :param latency: Latency in seconds of each fake LLM request.
+    :param baseline: Path to the baseline file.
+    :param save_baseline: Store the results of this run in the baseline.
+    :param tolerance: Relative slowdown against the baseline reported as a regression.
+    :param memory: Also measure the memory held per parsed problem.
+    :param throughput: Also measure the parsing throughput of content files.
+    """
+
+    os.chdir(ROOT_DIR)
+    fakeClient.install(latency=latency)
+
+    sizes = [int(size) for size in sizes.split(",")]
+    scenarios = scenarios.split(",")
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            raise KeyError(f"Unknown scenario: {scenario}")
+
+    results_baseline = _load_baseline(baseline)
+    results = {}
+    regressions = []
+
+    for scenario in scenarios:
+        table = Table(title=scenario)
+        for column in ["problems", "seconds", "µs/problem", "baseline", "ratio"]:
+            table.add_column(column, justify="right")
+
+        results[scenario] = {}
+        for size in sizes:
+            with TemporaryDirectory() as tmpdir:
+                seconds = _time(SCENARIOS[scenario](size, tmpdir, latency), repeat)
+            results[scenario][str(size)] = seconds
+
+            seconds_baseline = results_baseline.get(scenario, {}).get(str(size))
+            ratio = seconds / seconds_baseline if seconds_baseline else None
+            if ratio is not None and ratio > 1 + tolerance:
+                regressions.append((scenario, size, ratio))
+
+            table.add_row(
+                str(size),
+                f"{seconds:.4f}",
+                f"{seconds / size * 1e6:.1f}",
+                f"{seconds_baseline:.4f}" if seconds_baseline else "-",
+                (
+                    f"[{'red' if ratio > 1 + tolerance else 'green'}]{ratio:.2f}x"
+                    if ratio is not None
+                    else "-"
+                ),
+            )
+
+        print(table)
+
+    if memory:
+        table = Table(title="memory")
+        for column in ["problems", "KiB", "bytes/problem", "baseline", "ratio"]:
+            table.add_column(column, justify="right")
+
+        results["memory"] = {}
+        for size in sizes:
+            with TemporaryDirectory() as tmpdir:
+                bytes_per_problem = _measure_memory(size, tmpdir) / size
+            results["memory"][str(size)] = bytes_per_problem
+
+            bytes_baseline = results_baseline.get("memory", {}).get(str(size))
+            ratio = bytes_per_problem / bytes_baseline if bytes_baseline else None
+            if ratio is not None and ratio > 1 + tolerance:
+                regressions.append(("memory", size, ratio))
+
+            table.add_row(
+                str(size),
+                f"{bytes_per_problem * size / 1024:.1f}",
+                f"{bytes_per_problem:.0f}",
+                f"{bytes_baseline:.0f}" if bytes_baseline else "-",
+                (
+                    f"[{'red' if ratio > 1 + tolerance else 'green'}]{ratio:.2f}x"
+                    if ratio is not None
+                    else "-"
+                ),
+            )
+
+        print(table)
+
+    if throughput:
+        table = Table(title="throughput")
+        for column in ["problems", "seconds", "problems/s", "MB/s", "baseline", "ratio"]:
+            table.add_column(column, justify="right")
+
+        results["throughput"] = {}
+        for size in sizes:
+            with TemporaryDirectory() as tmpdir:
+                seconds, n_bytes = _measure_throughput(size, tmpdir, repeat)
+            results["throughput"][str(size)] = seconds
+
+            seconds_baseline = results_baseline.get("throughput", {}).get(str(size))
+            ratio = seconds / seconds_baseline if seconds_baseline else None
+            if ratio is not None and ratio > 1 + tolerance:
+                regressions.append(("throughput", size, ratio))
+
+            table.add_row(
+                str(size),
+                f"{seconds:.4f}",
+                f"{size / seconds:.0f}",
+                f"{n_bytes / seconds / 1e6:.1f}",
+                f"{seconds_baseline:.4f}" if seconds_baseline else "-",
+                (
+                    f"[{'red' if ratio > 1 + tolerance else 'green'}]{ratio:.2f}x"
+                    if ratio is not None
+                    else "-"
+                ),
+            )
+
+        print(table)
+
+    if save_baseline:
+        results_all = _load_baseline(baseline)
+        for scenario, results_curr in results.items():
+            results_all.setdefault(scenario, {}).update(results_curr)
+        with open(baseline, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "python": sys.version.split()[0],
+                    "platform": platform.platform(),
+                    "latency": latency,
+                    "results": results_all,
+                },
+                f,
+                indent=2,
+            )
+        print(f"[green]Đã lưu baseline tại [white]{baseline}[/white].[/green]")
+
+    for scenario, size, ratio in regressions:
+        print(
+            f"[red]Regression: {scenario} ({size} problems) is {ratio:.2f}x "
+            + ("larger." if scenario == "memory" else "slower.")
+        )
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run(main)
@@ -1,3 +1,22 @@
-from handlers.contentHandler import content_handler
-from handlers.docxHandler import docx_handler
-from handlers.qtiHandler import qti_handler
+# Exporters pull in heavy dependencies (python-docx, lxml, PIL, soundfile...), so
+# they are only imported on first access. See PEP 562.
+_EXPORTS = {
+    "content_handler": "handlers.contentHandler",
+    "docx_handler": "handlers.docxHandler",
+    "problems_to_docx": "handlers.docxHandler",
+    "problems_to_qti": "handlers.qtiHandler",
+    "qti_handler": "handlers.qtiHandler",
+    "run_exports": "handlers.exportHandler",
+}
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        import importlib
+
+        return getattr(importlib.import_module(_EXPORTS[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_EXPORTS))
@@ -0,0 +1,74 @@
+import csv
+import os
+import re
+
+from rich import print
+
+from .buildManifest import BuildManifest, get_digest
+from .contentHandler import ANSWER_PATTERNS, iter_problems, parse_raw_problems
+from .mediaHandler import get_file_hash
+from .problemModel import Problem, ProblemIds
+
+ANSWER_KEY_HEADER = ["Câu", "Mã câu hỏi", "Đáp án"]
+
+
+def get_answer(problem: Problem):
+    """
+    Return the answer of problem as written in answer keys: the letters of its
+    correct choices (e.g. "B", "A, C"), or its accepted short answers, such as
+    the D/S string of true/false problems.
+    """
+
+    prefixes = [prefix for prefix, _ in problem.answers]
+    if all(re.match(ANSWER_PATTERNS["mctf"], prefix) for prefix in prefixes) or all(
+        re.match(ANSWER_PATTERNS["multans"], prefix) for prefix in prefixes
+    ):
+        return ", ".join(
+            chr(ord("A") + i)
+            for i, prefix in enumerate(prefixes)
+            if prefix.startswith(("*", "[*"))
+        )
+    return "; ".join(content for _, content in problem.answers)
+
+
+def answer_key_handler(dir_input: str, dir_output: str, manifest: BuildManifest = None):
+    with open(os.path.join(dir_input), "r", encoding="utf-8") as f:
+        problems_to_answer_key(iter_problems(f), dir_output, manifest=manifest)
+
+
+def problems_to_answer_key(problems, dir_output: str, manifest: BuildManifest = None):
+    """
+    Write the answer of each problem, numbered in exam order, to answer_key.csv
+    in dir_output, unless the same problems were already written there.
+
+    answer_key.csv is recorded in manifest if given, which is then left to the
+    caller to save (see run_exports).
+    """
+
+    save_manifest = manifest is None
+    if manifest is None:
+        manifest = BuildManifest(dir_output)
+
+    problems = [
+        problem
+        for problem in parse_raw_problems(problems)
+        if isinstance(problem, Problem)
+    ]
+    problem_ids = ProblemIds()
+    ids = [problem_ids.get(problem) for problem in problems]
+    digest = get_digest(get_file_hash(__file__), ids)
+    if manifest.is_up_to_date("answer_key.csv", digest):
+        print("[blue]├── [/blue][green]Nội dung không thay đổi, giữ nguyên đáp án.")
+        return
+
+    # With a BOM, so that spreadsheet software reads it as UTF-8.
+    answer_key_dir = os.path.join(dir_output, "answer_key.csv")
+    with open(answer_key_dir, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(ANSWER_KEY_HEADER)
+        for i, (problem, problem_id) in enumerate(zip(problems, ids)):
+            writer.writerow([i + 1, problem_id, get_answer(problem)])
+
+    manifest.record("answer_key.csv", digest, ids)
+    if save_manifest:
+        manifest.save()
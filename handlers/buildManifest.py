@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+
+MANIFEST_NAME = "manifest.json"
+FRAGMENTS_DIR = ".fragments"
+
+
+def get_digest(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        part = json.dumps(part, ensure_ascii=False, default=str)
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def get_media_stats(media_locs):
+    """
+    Return the size and modification time of each media, so that a digest
+    changes along with the medias it refers to, without hashing them.
+    """
+
+    stats = []
+    for media_loc in media_locs:
+        try:
+            stat = os.stat(media_loc)
+            stats.append((media_loc, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            stats.append((media_loc, None, None))
+    return stats
+
+
+def _get_file_stat(file_dir: str):
+    try:
+        stat = os.stat(file_dir)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class BuildManifest:
+    """
+    Record of the outputs built in a directory (exam.docx, qti.zip...), stored
+    in its manifest.json.
+
+    Each output is recorded with the digest of what it was built from, so that
+    it is only rebuilt once its inputs (or the exporter itself) change.
+    """
+
+    def __init__(self, dir_output: str):
+        self.dir_output = dir_output
+        self.manifest_dir = os.path.join(dir_output, MANIFEST_NAME)
+        self.outputs = self._load()
+
+    def _load(self):
+        try:
+            with open(self.manifest_dir, "r", encoding="utf-8") as f:
+                return json.load(f).get("outputs", {})
+        except (OSError, ValueError):
+            return {}
+
+    def is_up_to_date(self, name: str, digest: str):
+        output = self.outputs.get(name)
+        return (
+            output is not None
+            and output["digest"] == digest
+            and output["stat"] == _get_file_stat(os.path.join(self.dir_output, name))
+        )
+
+    def record(self, name: str, digest: str, problem_ids: list = None):
+        self.outputs[name] = {
+            "digest": digest,
+            "stat": _get_file_stat(os.path.join(self.dir_output, name)),
+            "problems": problem_ids,
+        }
+
+    def save(self):
+        # Outputs recorded by other exporters since this manifest was loaded are kept.
+        outputs = self._load() | self.outputs
+
+        tmp_dir = f"{self.manifest_dir}.tmp"
+        with open(tmp_dir, "w", encoding="utf-8") as f:
+            json.dump({"outputs": outputs}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_dir, self.manifest_dir)
+
+
+class FragmentStore:
+    """
+    Fragments of an output (e.g. the table rows of a problem in exam.docx),
+    stored per problem id in .fragments/{name}.json in the output directory.
+
+    Only the fragments used by the last build are kept.
+    """
+
+    def __init__(self, dir_output: str, name: str, version: str):
+        self.store_dir = os.path.join(dir_output, FRAGMENTS_DIR, f"{name}.json")
+        self.version = version
+        self.fragments = {}
+        self.n_reused = 0
+
+        try:
+            with open(self.store_dir, "r", encoding="utf-8") as f:
+                store = json.load(f)
+        except (OSError, ValueError):
+            store = {}
+        # Fragments of a previous version of the exporter are never reused.
+        self._fragments_prev = (
+            store.get("fragments", {}) if store.get("version") == version else {}
+        )
+
+    def get(self, fragment_id: str):
+        fragment = self._fragments_prev.get(fragment_id)
+        if fragment is not None:
+            self.fragments[fragment_id] = fragment
+            self.n_reused += 1
+        return fragment
+
+    def put(self, fragment_id: str, fragment: str):
+        self.fragments[fragment_id] = fragment
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.store_dir), exist_ok=True)
+        tmp_dir = f"{self.store_dir}.tmp"
+        with open(tmp_dir, "w", encoding="utf-8") as f:
+            json.dump(
+                {"version": self.version, "fragments": self.fragments},
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(tmp_dir, self.store_dir)
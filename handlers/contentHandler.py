@@ -1,17 +1,36 @@
-import importlib.util
+import asyncio
+import contextvars
+import functools
+import io
 import json
+import mmap
 import os
 import random
 import re
 import shutil
-import uuid
+from concurrent.futures import ThreadPoolExecutor
 
-import dotenv
-import soundfile as sf
-from PIL import Image
 from rich import print
 
-dotenv.load_dotenv()
+from .handlerRegistry import Handler, get_handler
+from .jsonStream import JSONObjectStream
+from .mediaHandler import prepare_assets
+from .problemModel import Answer, Passage, Problem, ProblemIds, Raw
+from .responseCache import (
+    CACHE_DIR,
+    CACHE_MAX_AGE_DAYS,
+    CACHE_MAX_SIZE_MB,
+    ResponseCache,
+    get_cache_key,
+)
+from .telemetry import (
+    METRICS_NAME,
+    TOKEN_STATS_PATH,
+    Telemetry,
+    TokenStats,
+    get_call_stats,
+    track_call,
+)
 
 # https://github.com/gpoore/text2qti/blob/master/text2qti/quiz.py
 # For generating DOCX file. Syntaxes outside these are currently not supported.
@@ -29,246 +48,957 @@ ANSWER_OR_SOLUTION_PATTERN = "|".join(
 MEDIA_PATTERN = r"^\!\[[^\]]*\]\([^\)]+\)"
 MEDIA_COMPONENTS_PATTERN = r"!\[([^\]]*)\]\(([^)]+)\)"
 
-IMAGE_FORMATS = ["gif", "jpeg", "jpg", "svg", "png"]
-AUDIO_FORMATS = ["mp3", "mpeg"]
-
 INDENT_SIZE = 6
+WRITE_BUFFER_SIZE = 1 << 20
+
+MAX_CONCURRENCY = 4
+AUTO_SHARD_SIZE = 8
+# Output token limit of the model, overridable with [global] max_output_tokens.
+MAX_OUTPUT_TOKENS = 8192
+# Requests made to complete a response that was cut off, see _continue.
+MAX_CONTINUATIONS = 2
+
+DEDUP_MODES = ["off", "flag", "drop"]
+DEDUP_THRESHOLD = 0.8
+# Rounds of regeneration of the problems dropped as duplicates, at most.
+DEDUP_MAX_ROUNDS = 3
+DUPLICATES_NAME = "duplicates.json"
+
+
+_QUESTION_RE = re.compile(QUESTION_PATTERN)
+_ANSWER_OR_SOLUTION_RE = re.compile(ANSWER_OR_SOLUTION_PATTERN)
+_SOLUTION_RE = re.compile(SOLUTION_PATTERN)
+_MEDIA_RE = re.compile(MEDIA_PATTERN)
+_MEDIA_ANYWHERE_RE = re.compile(MEDIA_PATTERN[1:])
+_MEDIA_COMPONENTS_RE = re.compile(MEDIA_COMPONENTS_PATTERN)
+
+
+def _iter_lines(source):
+    if isinstance(source, str):
+        source = io.StringIO(source)
+
+    if isinstance(source, mmap.mmap):
+        while line := source.readline():
+            yield line.decode("utf-8").replace("\r\n", "\n")
+    else:
+        yield from source
+
+
+def _dedent(lines: list):
+    # Lines after the first one are indented by INDENT_SIZE, see _get_formatted_multiline_str.
+    return "\n".join(
+        [lines[0]] + [line[INDENT_SIZE:] if line else line for line in lines[1:]]
+    )
+
+
+def _get_problem(question_lines: list, segments: list):
+    answers = []
+    solution = ""
+    for prefix, lines in segments:
+        content = _dedent([line.rstrip("\n") for line in lines])
+        if _SOLUTION_RE.match(prefix):
+            solution = content
+        else:
+            answers.append(Answer(prefix, content.strip()))
+
+    medias = []
+    for line in question_lines:
+        line = line.strip()
+        if _MEDIA_RE.match(line):
+            medias.append(_MEDIA_COMPONENTS_RE.search(line).group(2))
+
+    question = _MEDIA_ANYWHERE_RE.sub("", "".join(question_lines)).strip()
+    question = _dedent(question.split("\n"))
+
+    return Problem(question, answers, solution, medias)
 
 
-def load_handler(handler_name: str):
-    handler_path = os.path.join("handlers/custom", f"{handler_name}.py")
+def iter_problems(source):
+    """
+    Parse problems in QTI-compatible text format, one line at a time.
 
-    if not os.path.exists(handler_path):
-        raise ImportError(f"Module {handler_name} not found at {handler_path}.")
+    source is a string, a text file or an mmap of a UTF-8 file. Problems are
+    yielded as soon as they end, so a file is never held in memory as a whole.
+    """
 
-    module_name = f"handlers.custom.{handler_name.replace('/', '.')}"
+    question_lines = None
+    segments = []
 
-    spec = importlib.util.spec_from_file_location(module_name, handler_path)
-    module = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(module)
+    for line in _iter_lines(source):
+        match = _QUESTION_RE.match(line)
+        if match:
+            if question_lines is not None:
+                yield _get_problem(question_lines, segments)
+            question_lines = [line[match.end() :]]
+            segments = []
+            continue
+
+        # Text before the first question is ignored.
+        if question_lines is None:
+            continue
 
-    if not hasattr(module, "handler"):
-        raise ImportError(f"Module {handler_name} does not define function handler.")
+        match = _ANSWER_OR_SOLUTION_RE.match(line)
+        if match:
+            segments.append((match.group(), [line[match.end() :]]))
+        elif segments:
+            segments[-1][1].append(line)
+        else:
+            question_lines.append(line)
 
-    return module.handler
+    if question_lines is not None:
+        yield _get_problem(question_lines, segments)
 
 
 def txt_to_json(content: str):
-    def _process(s: str):
-        s_split = s.splitlines()
-        return "\n".join(
-            [s_split[0]]
-            + [line[INDENT_SIZE:] if line else line for line in s_split[1:]]
-        )
+    return list(iter_problems(content))
 
-    problems = {}
 
-    for i, problem_raw in enumerate(
-        re.split(QUESTION_PATTERN, content, flags=re.MULTILINE)[1:]
-    ):
-        chunks = [
-            chunk
-            for chunk in re.split(
-                ANSWER_OR_SOLUTION_PATTERN, problem_raw, flags=re.MULTILINE
-            )
-            if chunk
-        ]
-
-        answers = []
-        solution = ""
-        for j in range(1, len(chunks), 2):
-            prefix, content = chunks[j], chunks[j + 1]
-            content = _process(content)
-            if re.match(SOLUTION_PATTERN, prefix):
-                solution = content
-            else:
-                answers.append((prefix, content.strip()))
-        medias = []
-        for media_raw in [
-            line.strip()
-            for line in chunks[0].splitlines()
-            if re.match(MEDIA_PATTERN, line.strip())
-        ]:
-            _, media_path = re.search(MEDIA_COMPONENTS_PATTERN, media_raw).groups()
-            medias.append(media_path)
-        question = re.sub(MEDIA_PATTERN[1:], "", chunks[0]).strip()
-        question = _process(question)
-
-        problems[f"q{i + 1}"] = {
-            "question": question,
-            "answers": answers,
-            "solution": solution,
-            "medias": medias,
-        }
+def parse_raw_problems(problems):
+    """
+    Yield problems, with Raw problems, already in QTI-compatible text format,
+    parsed into the problems of their text.
+    """
 
-    return problems
+    for problem in problems:
+        if isinstance(problem, Raw):
+            yield from iter_problems(problem.raw)
+        else:
+            yield problem
 
 
-def json_to_txt(problems: dict, path, with_hidden_uuid: bool):
-    if not problems:
+def _get_formatted_multiline_str(p: str, s: str):
+    if not s:
         return ""
+    stripped_lines = s.splitlines()
+    formatted_lines = [
+        f"{' ' * INDENT_SIZE}{line}" if line else "" for line in stripped_lines
+    ]
+    formatted_lines[0] = p.ljust(INDENT_SIZE) + stripped_lines[0]
+    return "\n".join(formatted_lines)
+
 
-    indent_size = INDENT_SIZE
-
-    def _get_formatted_multiline_str(p: str, s: str):
-        if not s:
-            return ""
-        stripped_lines = [line for line in s.splitlines()]
-        formatted_lines = [
-            f"{' ' * indent_size}{line}" if line else "" for line in stripped_lines
-        ]
-        formatted_lines[0] = p.ljust(indent_size) + stripped_lines[0]
-        return "\n".join(formatted_lines)
-
-    def _get_text_with_hidden_uuid(s: str):
-        return (
-            f'{s}\n\n<font style="display:none">{uuid.uuid4()}</font>'
-            if with_hidden_uuid
-            else s
+def resolve_medias(problems: list, path: str):
+    """
+    Store the medias of problems once in the assets directory of path, return
+    the problems referring to these assets instead of the original medias.
+    """
+
+    asset_paths = prepare_assets(
+        (
+            media_loc
+            for problem in problems
+            if isinstance(problem, Problem)
+            for media_loc in problem.medias
+        ),
+        os.path.join(path, "assets"),
+    )
+    if not asset_paths:
+        return problems
+
+    return [
+        (
+            problem.replace(medias=[asset_paths[m] for m in problem.medias])
+            if isinstance(problem, Problem) and problem.medias
+            else problem
         )
+        for problem in problems
+    ]
 
-    content = ""
 
-    if path:
-        assets_dir = os.path.join(path, "assets")
-        os.makedirs(assets_dir, exist_ok=True)
+def _iter_txt_chunks(problems: list, path):
+    """
+    Render problems in QTI-compatible text format, chunk by chunk.
 
-    n_problems = 0
+    Yield pairs (chunk, chunk_with_hidden_uuid), which only differ for question
+    texts, so that both variants of the content are rendered in a single pass.
+    Hidden uuids are derived from the content of problems (see get_problem_id),
+    so that identical content is rendered identically.
+    If path is given, medias are first stored in its assets directory.
+    """
 
-    for key, problem in problems.items():
-        if "raw" in problem:
-            content += problem["raw"] + "\n\n"
-            continue
+    if path:
+        problems = resolve_medias(problems, path)
 
-        if "text" in problem:
-            content += _get_formatted_multiline_str("Text: ", problem["text"]) + "\n\n"
+    problem_ids = ProblemIds()
+    for i, problem in enumerate(problems):
+        if isinstance(problem, Raw):
+            chunk = problem.raw + "\n\n"
+            yield (chunk, chunk)
             continue
 
-        n_problems += 1
+        if isinstance(problem, Passage):
+            chunk = _get_formatted_multiline_str("Text: ", problem.text) + "\n\n"
+            yield (chunk, chunk)
+            continue
 
-        question = problem["question"]
-        solution = problem["solution"]
-        answers = problem["answers"]
-        medias = problem["medias"]
+        question = problem.question
+        solution = problem.solution
+        answers = problem.answers
+        medias = problem.medias
 
         for j, media_loc in enumerate(medias):
-            media_format = os.path.splitext(media_loc)[1][1:]
-
-            if os.path.isfile(media_loc):
-                if path:
-                    if media_format in IMAGE_FORMATS:
-                        img = Image.open(media_loc)
-                        media_path = os.path.join(
-                            assets_dir,
-                            f"{key}_{j}.png",
-                        )
-                        img.save(media_path)
-                    elif media_format in AUDIO_FORMATS:
-                        data, samplerate = sf.read(media_loc)
-                        media_path = os.path.join(
-                            assets_dir,
-                            f"{key}_{j}.mp3",
-                        )
-                        sf.write(media_path, data, samplerate)
-                    else:
-                        raise Exception(f"Invalid or unsupported media at: {media_loc}")
-                question += f"\n\n![{key}_{j}]({os.path.abspath(media_loc)})"
-            else:
+            if not os.path.isfile(media_loc):
                 raise Exception(f"Invalid or unsupported media at: {media_loc}")
+            question += f"\n\n![q{i + 1}_{j}]({os.path.abspath(media_loc)})"
 
-        content += (
-            _get_formatted_multiline_str("1.", _get_text_with_hidden_uuid(question))
-            + "\n\n"
+        problem_id = problem_ids.get(problem)
+        yield (
+            _get_formatted_multiline_str("1.", question) + "\n\n",
+            _get_formatted_multiline_str(
+                "1.", f'{question}\n\n<font style="display:none">{problem_id}</font>'
+            )
+            + "\n\n",
         )
         if solution:
-            content += _get_formatted_multiline_str("...", solution) + "\n\n"
+            chunk = _get_formatted_multiline_str("...", solution) + "\n\n"
+            yield (chunk, chunk)
         for prefix, answer in answers:
-            content += _get_formatted_multiline_str(prefix, answer) + "\n\n"
+            chunk = _get_formatted_multiline_str(prefix, answer) + "\n\n"
+            yield (chunk, chunk)
+
+
+def json_to_txt(problems: list, path, with_hidden_uuid: bool):
+    i = 1 if with_hidden_uuid else 0
+    return "".join(chunks[i] for chunks in _iter_txt_chunks(problems, path))
+
+
+def write_content(problems: list, path: str, content_dir: str, content_clean_dir: str):
+    """
+    Write content.txt (with hidden uuids) and content_clean.txt in a single pass.
+    """
+
+    with open(content_dir, "w+", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as f:
+        with open(
+            content_clean_dir, "w+", encoding="utf-8", buffering=WRITE_BUFFER_SIZE
+        ) as f_clean:
+            for chunk, chunk_with_hidden_uuid in _iter_txt_chunks(problems, path):
+                f_clean.write(chunk)
+                f.write(chunk_with_hidden_uuid)
+
+
+def get_shard_sizes(n_problems: int, shard_size, max_shard_size: int = None):
+    """
+    Split n_problems into balanced shards of at most shard_size problems.
+
+    Unless shard_size is a number, shards also hold at most max_shard_size
+    problems, e.g. as many as fit the output token limit (see TokenStats).
+    """
+
+    if not shard_size:
+        if not max_shard_size:
+            return [n_problems]
+        shard_size = max_shard_size
+    if shard_size == "auto":
+        shard_size = min(AUTO_SHARD_SIZE, max_shard_size or AUTO_SHARD_SIZE)
+    if not isinstance(shard_size, int) or shard_size < 1:
+        raise ValueError(f"Invalid shard_size: {shard_size}")
+
+    n_shards = max(1, -(-n_problems // shard_size))
+    return [
+        n_problems // n_shards + (1 if i < n_problems % n_shards else 0)
+        for i in range(n_shards)
+    ]
+
+
+def _get_cache_key(
+    handler: Handler, prompt_content: str, n_problems: int, extra_cfg, replica
+):
+    # Only handlers that expose their config and post-processing can be replayed.
+    if not handler.can_cache:
+        return None
+
+    return get_cache_key(
+        prompt_content,
+        handler.source,
+        handler.get_config(n_problems, extra_cfg),
+        handler.model,
+        extra_cfg,
+        n_problems,
+        replica,
+    )
 
-    return content
 
+class _RunContext:
+    """
+    State shared by all batches of a content_handler run.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        config_global: dict,
+        executor: ThreadPoolExecutor,
+        semaphore: asyncio.Semaphore,
+        cache: ResponseCache,
+        replay: bool,
+        telemetry: Telemetry,
+        token_stats: TokenStats,
+        bank,
+    ):
+        self.path = path
+        self.logs_dir = os.path.join(path, "logs")
+        self.config_global = config_global
+        self.executor = executor
+        self.semaphore = semaphore
+        self.cache = cache
+        self.replay = replay
+        self.telemetry = telemetry
+        self.token_stats = token_stats
+        # Problems are sampled from the bank once per run at most.
+        self.bank = bank
+        self.bank_ids = set()
+
+
+async def _generate_stream(
+    handler: Handler,
+    prompt_content: str,
+    n_problems: int,
+    extra_cfg: dict,
+    keys: list,
+    log_prefix: str,
+    label: str,
+):
+    # Each problem is parsed and written to the logs as soon as its JSON object closes.
+    parser = JSONObjectStream()
+    problems = []
+    chunks = []
+
+    with open(f"{log_prefix}_response.json", "w+", encoding="utf-8") as f_response:
+        with open(f"{log_prefix}_content.txt", "w+", encoding="utf-8") as f_content:
+            try:
+                async for chunk in handler.generate_stream(
+                    prompt_content, n_problems, extra_cfg, keys
+                ):
+                    if not chunks:
+                        get_call_stats().on_first_token()
+                    chunks.append(chunk)
+                    f_response.write(chunk)
+                    f_response.flush()
+
+                    for key, problem_raw in parser.feed(chunk):
+                        problems.append(handler.get_problem(key, problem_raw))
+                        f_content.write(
+                            json_to_txt(problems[-1:], None, with_hidden_uuid=False)
+                        )
+                        f_content.flush()
+            except Exception as e:
+                if not problems:
+                    raise
+                print(
+                    f"[blue]│   └── [/blue][yellow]Batch {label}: [/yellow]"
+                    f"[red]Lỗi khi nhận phản hồi: [white]{e}[/white][/red]"
+                )
 
-def content_handler(path: str, config_global: dict, config_per_prompt: dict):
-    content_dir = os.path.join(path, "content.txt")
-    content_clean_dir = os.path.join(path, "content_clean.txt")
-    logs_dir = os.path.join(path, "logs")
-    os.makedirs(logs_dir, exist_ok=True)
+    response = "".join(chunks)
+    is_complete = parser.is_complete and not parser.n_invalid
+    if not is_complete:
+        os.replace(f"{log_prefix}_response.json", f"{log_prefix}_response.rxt")
+
+    return (problems, response, is_complete)
+
+
+async def _call_llm(
+    ctx: _RunContext,
+    handler: Handler,
+    prompt_content: str,
+    n_problems: int,
+    extra_cfg: dict,
+    keys: list,
+    stream: bool,
+    log_prefix: str,
+    label: str,
+    shard: int,
+):
+    started = ctx.telemetry.now()
+    async with ctx.semaphore:
+        # Each batch and shard runs in its own task, hence its own context.
+        queued = ctx.telemetry.now() - started
+        started += queued
+        stats = track_call()
+        try:
+            if stream:
+                problems, response, is_complete = await _generate_stream(
+                    handler,
+                    prompt_content,
+                    n_problems,
+                    extra_cfg,
+                    keys,
+                    log_prefix,
+                    label,
+                )
+            elif handler.is_async:
+                problems, response, is_complete = await handler.generate_async(
+                    prompt_content, n_problems, extra_cfg, keys
+                )
+            else:
+                (
+                    problems,
+                    response,
+                    is_complete,
+                ) = await asyncio.get_running_loop().run_in_executor(
+                    ctx.executor,
+                    functools.partial(
+                        contextvars.copy_context().run,
+                        handler.generate,
+                        prompt_content,
+                        n_problems,
+                        extra_cfg,
+                        keys,
+                    ),
+                )
+        except Exception as e:
+            ctx.telemetry.record(
+                handler.name, label, shard, started, queued, stats, error=str(e)
+            )
+            raise
+        ctx.telemetry.record(
+            handler.name, label, shard, started, queued, stats, n_problems=len(problems)
+        )
+        ctx.token_stats.update(handler.name, stats, len(problems))
+
+    if not stream:
+        _write_response_log(log_prefix, response)
+
+    return (problems, response, is_complete)
+
+
+def _add_members(
+    handler: Handler,
+    response: str,
+    problems: list,
+    keys: list,
+    members: dict,
+    built: dict,
+):
+    # Problems are parsed from the members of response one by one, in order.
+    for (key, problem_raw), problem in zip(handler.salvage(response)[0], problems):
+        if key in keys:
+            members[key] = problem_raw
+            built[key] = problem
+
+
+async def _continue(
+    ctx: _RunContext,
+    handler: Handler,
+    prompt_content: str,
+    n_problems: int,
+    extra_cfg: dict,
+    problems: list,
+    response: str,
+    stream: bool,
+    log_prefix: str,
+    label: str,
+    shard: int,
+):
+    """
+    Complete a response that was cut off, of which problems were parsed,
+    keeping its fully formed members and requesting only the missing ones,
+    for at most MAX_CONTINUATIONS more requests. Return the problems of the
+    merged response, the merged response and whether it is complete.
+    """
+
+    keys = handler.get_keys(n_problems)
+    members = {}
+    # Problems are kept as first built, e.g. as streamed to the logs, since
+    # get_problem may shuffle choices.
+    built = {}
+    _add_members(handler, response, problems, keys, members, built)
+    for round_ in range(1, MAX_CONTINUATIONS + 1):
+        missing = [key for key in keys if key not in members]
+        if not missing:
+            break
+
+        print(
+            f"[blue]│   └── [/blue][yellow]Batch {label}: [/yellow]"
+            f"[red]Phản hồi bị cắt ngang, đang tạo tiếp {len(missing)} phần còn thiếu...[/red]"
+        )
+        try:
+            problems_curr, response_curr, _ = await _call_llm(
+                ctx,
+                handler,
+                handler.get_continuation_prompt(prompt_content, members, missing),
+                len(missing),
+                extra_cfg,
+                missing,
+                stream,
+                f"{log_prefix}_continuation_{round_}",
+                label,
+                shard,
+            )
+        except Exception as e:
+            print(
+                f"[blue]│   └── [/blue][yellow]Batch {label}: [/yellow]"
+                f"[red]Lỗi khi tạo tiếp: [white]{e}[/white][/red]"
+            )
+            break
+        _add_members(handler, response_curr, problems_curr, missing, members, built)
+
+    members = {key: members[key] for key in keys if key in members}
+    problems = [built[key] for key in members]
+    response = json.dumps(members, ensure_ascii=False)
+    _write_response_log(log_prefix, response)
+    return (problems, response, len(members) == len(keys))
+
+
+async def _generate(
+    ctx: _RunContext,
+    handler: Handler,
+    prompt_content: str,
+    n_problems: int,
+    extra_cfg: dict,
+    cache_key: str,
+    stream: bool,
+    log_prefix: str,
+    label: str,
+    shard: int,
+):
+    if cache_key is not None:
+        started = ctx.telemetry.now()
+        response = ctx.cache.get(cache_key)
+        if response is not None:
+            _write_response_log(log_prefix, response)
+            problems = handler.get_problems(response)
+            ctx.telemetry.record(
+                handler.name,
+                label,
+                shard,
+                started,
+                0.0,
+                n_problems=len(problems),
+                cached=True,
+            )
+            return (problems, response)
 
-    problems = {}
-    n_prompts = len(config_per_prompt)
-    for i, (key, config_per_prompt_curr) in enumerate(config_per_prompt.items()):
-        print((f"[blue]├── [/blue][yellow]Đang xử lí batch {i + 1}/{n_prompts}..."))
+    if ctx.replay:
+        raise LookupError(
+            f"Handler {handler.name}: no cached response found, cannot call the LLM in replay mode."
+        )
 
-        problems_curr = {}
+    problems, response, is_complete = await _call_llm(
+        ctx,
+        handler,
+        prompt_content,
+        n_problems,
+        extra_cfg,
+        None,
+        stream,
+        log_prefix,
+        label,
+        shard,
+    )
+    if not is_complete and handler.can_continue:
+        problems, response, is_complete = await _continue(
+            ctx,
+            handler,
+            prompt_content,
+            n_problems,
+            extra_cfg,
+            problems,
+            response,
+            stream,
+            log_prefix,
+            label,
+            shard,
+        )
+    if not is_complete:
+        print(
+            f"[blue]│   └── [/blue][yellow]Batch {label}: [/yellow]"
+            f"[red]Phản hồi không đầy đủ, chỉ giữ lại {len(problems)} bài.[/red]"
+        )
+
+    if cache_key is not None and is_complete:
+        ctx.cache.put(cache_key, response, {"handler": handler.name})
+
+    return (problems, response)
+
+
+def _write_response_log(log_prefix: str, response: str):
+    try:
+        json.loads(response)
+        response_dir = f"{log_prefix}_response.json"
+    except Exception:
+        response_dir = f"{log_prefix}_response.rxt"
+    with open(response_dir, "w+", encoding="utf-8") as f:
+        f.write(response)
 
-        if config_per_prompt_curr["mode"] == "manual":
-            with open(config_per_prompt_curr["source"], "r", encoding="utf-8") as f:
-                problems_curr = txt_to_json(f.read())
 
+async def _process_batch(
+    ctx: _RunContext,
+    key: str,
+    config_per_prompt_curr: dict,
+    replica: int,
+    label: str,
+    round_: int = 0,
+):
+    """
+    Return the problems of a batch. Batches generated again to replace
+    duplicates are told apart by round_, both in the cache and in the logs.
+    """
+
+    problems_curr = []
+
+    print((f"[blue]├── [/blue][yellow]Đang xử lí batch {label}..."))
+
+    if config_per_prompt_curr["mode"] == "manual":
+        with open(config_per_prompt_curr["source"], "r", encoding="utf-8") as f:
+            problems_curr = list(iter_problems(f))
+
+        print(
+            (
+                f"[blue]│   └── [/blue][yellow]Batch {label}: [/yellow]"
+                + f"[green]Đã đọc nội dung đề thi tại [white]{config_per_prompt_curr['source']}[/white] thành công.[/green]"
+            )
+        )
+
+    if config_per_prompt_curr["mode"] == "bank":
+        from .questionBank import SELECTOR_KEYS
+
+        selector = config_per_prompt_curr["from_bank"]
+        for name in selector:
+            if name not in SELECTOR_KEYS:
+                raise KeyError(
+                    f"Unknown from_bank key: {name}. "
+                    f"Expected some of {', '.join(SELECTOR_KEYS)}."
+                )
+
+        problems_curr, ids = ctx.bank.sample(**selector, exclude=ctx.bank_ids)
+        ctx.bank_ids.update(ids)
+        # Without a number of problems nor quotas, every matching problem is taken.
+        quotas = selector.get("types") or selector.get("topics") or {}
+        n_problems = selector.get("n_problems", sum(quotas.values()) or len(ids))
+
+        print(
+            (
+                f"[blue]│   └── [/blue][yellow]Batch {label}: [/yellow]"
+                + f"[green]Đã lấy {len(ids)}/{n_problems} bài từ ngân hàng câu hỏi [white]{ctx.bank.path}[/white].[/green]"
+            )
+        )
+        if len(ids) < n_problems:
             print(
-                (
-                    "[blue]│   └── [/blue]"
-                    + f"[green]Đã đọc nội dung đề thi tại [white]{content_dir}[/white] thành công.[/green]"
+                f"[blue]│   └── [/blue][yellow]Batch {label}: [/yellow]"
+                f"[red]Ngân hàng câu hỏi không đủ bài phù hợp.[/red]"
+            )
+
+    if config_per_prompt_curr["mode"] == "generated":
+        prompt_name = config_per_prompt_curr["prompt"]
+
+        prompt_dir = os.path.join("prompts", prompt_name)
+        prompt_copy_dir = os.path.join(ctx.path, prompt_dir)
+        os.makedirs(os.path.dirname(prompt_copy_dir), exist_ok=True)
+        shutil.copy(prompt_dir, os.path.join(ctx.path, prompt_dir))
+
+        handler = get_handler(config_per_prompt_curr["handler"])
+        n_problems = config_per_prompt_curr.get("n_problems", 1)
+        extra_cfg = config_per_prompt_curr.get("extra_cfg", dict())
+        shard_sizes = get_shard_sizes(
+            n_problems,
+            config_per_prompt_curr.get(
+                "shard_size", ctx.config_global.get("shard_size")
+            ),
+            ctx.token_stats.get_max_problems(
+                handler.name,
+                ctx.config_global.get("max_output_tokens", MAX_OUTPUT_TOKENS),
+            ),
+        )
+        stream = handler.can_stream and config_per_prompt_curr.get(
+            "stream", ctx.config_global.get("stream", False)
+        )
+
+        with open(prompt_dir, "r", encoding="utf-8") as f:
+            prompt_content = f.read()
+
+        results = await asyncio.gather(
+            *(
+                _generate(
+                    ctx,
+                    handler,
+                    prompt_content,
+                    shard_size,
+                    extra_cfg,
+                    _get_cache_key(
+                        handler,
+                        prompt_content,
+                        shard_size,
+                        extra_cfg,
+                        [replica, k, round_] if round_ else [replica, k],
+                    )
+                    if ctx.cache.mode != "off"
+                    else None,
+                    stream,
+                    os.path.join(
+                        ctx.logs_dir, key if len(shard_sizes) == 1 else f"{key}_shard_{k}"
+                    ),
+                    label,
+                    k,
                 )
+                for k, shard_size in enumerate(shard_sizes)
             )
+        )
 
-        if config_per_prompt_curr["mode"] == "generated":
-            prompt_name = config_per_prompt_curr["prompt"]
+        # Shards are merged in order.
+        for problems_shard, _ in results:
+            problems_curr += problems_shard
 
-            prompt_dir = os.path.join("prompts", prompt_name)
-            prompt_copy_dir = os.path.join(path, prompt_dir)
-            os.makedirs(os.path.dirname(prompt_copy_dir), exist_ok=True)
-            shutil.copy(prompt_dir, os.path.join(path, prompt_dir))
+        content_curr_dir = os.path.join(ctx.logs_dir, f"{key}_content.txt")
+        with open(content_curr_dir, "w+", encoding="utf-8") as f:
+            f.write(json_to_txt(problems_curr, None, with_hidden_uuid=False))
 
-            problems_curr = {}
+        print(
+            (
+                f"[blue]│   └── [/blue][yellow]Batch {label}: [/yellow]"
+                + f"[green]Đã đọc nội dung đề thi được sinh bởi prompt [white]{prompt_name}[/white] thành công"
+                + (f" ({len(results)} shard)" if len(results) > 1 else "")
+                + ".[/green]"
+            )
+        )
 
-            front_handler = load_handler(config_per_prompt_curr["handler"])
-            n_problems = config_per_prompt_curr.get("n_problems", 1)
-            extra_cfg = config_per_prompt_curr.get("extra_cfg", dict())
+    return problems_curr
+
+
+async def _process_batches(
+    path: str,
+    config_global: dict,
+    config_per_prompt: dict,
+    cache: ResponseCache,
+    replay: bool,
+    telemetry: Telemetry,
+    token_stats: TokenStats,
+    bank,
+):
+    max_concurrency = config_global.get("max_concurrency", MAX_CONCURRENCY)
+    if max_concurrency < 1:
+        raise ValueError("max_concurrency must be at least 1.")
+    dedup = config_global.get("dedup", "off")
+    if dedup not in DEDUP_MODES:
+        raise ValueError(
+            f"Invalid dedup mode: {dedup}. Expected one of {', '.join(DEDUP_MODES)}."
+        )
 
-            with open(prompt_dir, "r", encoding="utf-8") as f:
-                prompt_content = f.read()
+    n_prompts = len(config_per_prompt)
 
-            problems_curr, response = front_handler(
-                prompt_content, n_problems, extra_cfg
+    # Identical batches must not share cached responses, so each one is numbered.
+    replicas = []
+    n_replicas = {}
+    for config_per_prompt_curr in config_per_prompt.values():
+        signature = json.dumps(config_per_prompt_curr, sort_keys=True, default=str)
+        replicas.append(n_replicas.get(signature, 0))
+        n_replicas[signature] = replicas[-1] + 1
+
+    # The semaphore bounds concurrent LLM calls across all batches and shards.
+    # Sync handlers are run on a thread pool, async ones directly on the event loop.
+    # gather() returns results in submission order, so batch keys stay deterministic.
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        ctx = _RunContext(
+            path,
+            config_global,
+            executor,
+            asyncio.Semaphore(max_concurrency),
+            cache,
+            replay,
+            telemetry,
+            token_stats,
+            bank,
+        )
+        results = await asyncio.gather(
+            *(
+                _process_batch(
+                    ctx,
+                    key,
+                    config_per_prompt_curr,
+                    replicas[i],
+                    f"{i + 1}/{n_prompts}",
+                )
+                for i, (key, config_per_prompt_curr) in enumerate(
+                    config_per_prompt.items()
+                )
             )
+        )
 
-            content_curr_dir = os.path.join(logs_dir, f"{key}_content.txt")
-            with open(content_curr_dir, "w+", encoding="utf-8") as f:
-                f.write(json_to_txt(problems_curr, None, with_hidden_uuid=False))
+        if dedup != "off":
+            results = await _dedup_batches(ctx, config_per_prompt, replicas, results)
+        return results
+
+
+async def _dedup_batches(
+    ctx: _RunContext, config_per_prompt: dict, replicas: list, results: list
+):
+    """
+    Find the near duplicates among the problems of all batches, keeping the
+    first of each, and flag or drop the others. Duplicates are written to
+    logs/duplicates.json.
+
+    With dedup_regenerate, generated batches are generated again for as many
+    problems as they lost, until no duplicate is left or DEDUP_MAX_ROUNDS.
+    """
+
+    # numpy is only imported by runs which dedup.
+    from .dedup import DedupIndex
+
+    drop = ctx.config_global["dedup"] == "drop"
+    regenerate = drop and ctx.config_global.get("dedup_regenerate", False)
+    index = DedupIndex(ctx.config_global.get("dedup_threshold", DEDUP_THRESHOLD))
+
+    keys = list(config_per_prompt)
+    duplicates = []
+    missing = []
+    for i, key in enumerate(keys):
+        results[i], duplicates_curr = index.filter(results[i], key, drop)
+        duplicates += duplicates_curr
+        # Only generated batches can make up for their duplicates.
+        is_generated = config_per_prompt[key]["mode"] == "generated"
+        missing.append(len(duplicates_curr) if regenerate and is_generated else 0)
+
+    if regenerate:
+        for round_ in range(1, DEDUP_MAX_ROUNDS + 1):
+            pending = [i for i in range(len(keys)) if missing[i]]
+            if not pending:
+                break
+
+            regenerated = await asyncio.gather(
+                *(
+                    _process_batch(
+                        ctx,
+                        f"{keys[i]}_dedup_{round_}",
+                        {**config_per_prompt[keys[i]], "n_problems": missing[i]},
+                        replicas[i],
+                        f"{i + 1}/{len(keys)} (bổ sung {missing[i]} bài)",
+                        round_,
+                    )
+                    for i in pending
+                )
+            )
+            for i, problems in zip(pending, regenerated):
+                kept, duplicates_curr = index.filter(problems, keys[i], drop)
+                results[i] += kept
+                duplicates += duplicates_curr
+                missing[i] = len(duplicates_curr)
 
-            try:
-                json.loads(response)
-                response_dir = os.path.join(logs_dir, f"{key}_response.json")
-                with open(response_dir, "w+", encoding="utf-8") as f:
-                    f.write(response)
-            except Exception:
-                response_dir = os.path.join(logs_dir, f"{key}_response.rxt")
-                with open(response_dir, "w+", encoding="utf-8") as f:
-                    f.write(response)
+    with open(
+        os.path.join(ctx.logs_dir, DUPLICATES_NAME), "w", encoding="utf-8"
+    ) as f:
+        json.dump(duplicates, f, ensure_ascii=False, indent=2)
 
-            print(
-                (
-                    "[blue]│   └── [/blue]"
-                    + f"[green]Đã đọc nội dung đề thi được sinh bởi prompt [white]{prompt_name}[/white] thành công.[/green]"
-                )
+    print(
+        (
+            f"[blue]├── [/blue][yellow]Phát hiện {len(duplicates)} bài trùng lặp"
+            + (", đã loại bỏ" if drop else "")
+            + f": [/yellow][white]{os.path.join(ctx.logs_dir, DUPLICATES_NAME)}[/white]"
+        )
+    )
+    if sum(missing):
+        print(
+            f"[blue]├── [/blue][red]Còn thiếu {sum(missing)} bài sau khi loại bỏ bài trùng lặp.[/red]"
+        )
+
+    return results
+
+
+def _add_to_bank(bank, config_per_prompt: dict, results: list):
+    # Problems sampled from the bank are already in it.
+    n_added = 0
+    for config_per_prompt_curr, problems_curr in zip(config_per_prompt.values(), results):
+        if config_per_prompt_curr["mode"] == "generated":
+            prompt_name = config_per_prompt_curr["prompt"]
+            n_added += bank.add(
+                problems_curr,
+                prompt=prompt_name,
+                handler=config_per_prompt_curr["handler"],
+                topic=config_per_prompt_curr.get("topic", os.path.splitext(prompt_name)[0]),
+            )
+        if config_per_prompt_curr["mode"] == "manual":
+            n_added += bank.add(
+                problems_curr,
+                source=config_per_prompt_curr["source"],
+                topic=config_per_prompt_curr.get("topic"),
             )
 
-        problems.update(
-            {f"{key}_{_key}": _value for _key, _value in problems_curr.items()}
+    print(
+        (
+            f"[blue]├── [/blue][green]Đã thêm {n_added} bài mới vào ngân hàng câu hỏi: [/green]"
+            f"[white]{bank.path}[/white]"
         )
+    )
+
+
+def content_handler(
+    path: str,
+    config_global: dict,
+    config_per_prompt: dict,
+    cache_mode: str = "off",
+    replay: bool = False,
+):
+    """
+    Generate the exam content, write it to content.txt and content_clean.txt,
+    and return the problems, with medias referring to their assets, to be
+    passed as is to the exporters (see problems_to_docx, problems_to_qti).
+    """
+
+    content_dir = os.path.join(path, "content.txt")
+    content_clean_dir = os.path.join(path, "content_clean.txt")
+    logs_dir = os.path.join(path, "logs")
+    os.makedirs(logs_dir, exist_ok=True)
+
+    if replay and cache_mode == "off":
+        cache_mode = "read"
+    cache = ResponseCache(
+        cache_mode,
+        config_global.get("cache_dir", CACHE_DIR),
+        config_global.get("cache_max_size_mb", CACHE_MAX_SIZE_MB),
+        config_global.get("cache_max_age_days", CACHE_MAX_AGE_DAYS),
+    )
+
+    bank = None
+    if "bank" in config_global or any(
+        config_per_prompt_curr["mode"] == "bank"
+        for config_per_prompt_curr in config_per_prompt.values()
+    ):
+        from .questionBank import BANK_PATH, QuestionBank
+
+        bank = QuestionBank(config_global.get("bank", BANK_PATH))
+
+    telemetry = Telemetry()
+    token_stats = TokenStats(config_global.get("token_stats", TOKEN_STATS_PATH))
+    try:
+        results = asyncio.run(
+            _process_batches(
+                path,
+                config_global,
+                config_per_prompt,
+                cache,
+                replay,
+                telemetry,
+                token_stats,
+                bank,
+            )
+        )
+        if "bank" in config_global:
+            _add_to_bank(bank, config_per_prompt, results)
+    finally:
+        if bank is not None:
+            bank.close()
+        if not replay:
+            token_stats.save()
+
+    problems = []
+    for problems_curr in results:
+        problems += problems_curr
+
+    metrics_dir = os.path.join(logs_dir, METRICS_NAME)
+    metrics = telemetry.save(metrics_dir, len(problems))
+    print(
+        (
+            "[blue]├── [/blue]"
+            f"[green]Đã ghi số liệu các lời gọi LLM ({metrics['problems_per_second']} bài/giây): [/green]"
+            f"[white]{metrics_dir}[/white]"
+        )
+    )
 
     do_shuffle = config_global.get("shuffle", False)
     if do_shuffle:
-        problems_items = list(problems.items())
-        random.shuffle(problems_items)
-        problems = dict(problems_items)
-
-    with open(content_dir, "w+", encoding="utf-8") as f:
-        f.write(json_to_txt(problems, path, with_hidden_uuid=True))
+        random.shuffle(problems)
 
-    with open(content_clean_dir, "w+", encoding="utf-8") as f:
-        f.write(json_to_txt(problems, path, with_hidden_uuid=False))
+    problems = resolve_medias(problems, path)
+    write_content(problems, None, content_dir, content_clean_dir)
 
     print(
         (
@@ -277,3 +1007,5 @@ def content_handler(path: str, config_global: dict, config_per_prompt: dict):
             f"[white]{content_dir}[/white]"
         )
     )
+
+    return problems
@@ -1,20 +1,12 @@
-import json
-import os
+import random
 from copy import deepcopy
 from typing import List
 
-import dotenv
-import numpy as np
-from google import genai
-from pydantic import BaseModel, Field, create_model
+from pydantic import BaseModel, Field
 
-dotenv.load_dotenv()
-
-API_KEY = os.environ.get("API_KEY")
-MODEL = os.environ.get("MODEL") or "gemini-2.0-flash"
-
-client = genai.Client(api_key=API_KEY)
+from handlers.problemModel import Answer, Problem
 
+TEMPERATURE = 1.5
 N_CHOICES = 4
 
 
@@ -43,58 +35,24 @@ class QuestionBlock(BaseModel):
     )
 
 
-def handler(prompt_content: str, n_problems: int, extra_cfg: dict):
-    """
-    Takes in content of a prompt and the number of problems to be generated.
-    Return LLM's response.
-    """
-
-    response = client.models.generate_content(
-        model=MODEL,
-        contents=prompt_content,
-        config={
-            "response_mime_type": "application/json",
-            "response_schema": create_model(
-                "MyQuestions",
-                **{f"q{i}": (QuestionBlock, ...) for i in range(n_problems)},
-            ),
-            "temperature": extra_cfg.get("temperature", 1.5),
-        },
-    ).text
-    assert response is not None
-    response_dict = json.loads(response)
-
-    keys = response_dict.keys()
+def get_problem(key: str, problem_raw: dict):
+    choices = deepcopy(problem_raw["choices_false"])
+    i_correct = random.randrange(N_CHOICES)
+    choices.insert(i_correct, problem_raw["choice_true"])
 
-    problems = {
-        key: dict.fromkeys(["ptype", "question", "answers", "medias"], None)
-        for key in keys
-    }
+    answers = []
+    for i, choice in enumerate(choices):
+        prefix = f"{'*' if i == i_correct else ''}{chr(ord('a') + i)})"
+        answers.append(Answer(prefix, choice))
 
-    for key in keys:
-        problem_raw = response_dict[key]
-        problem = problems[key]
+    question = (
+        problem_raw["question"]
+        + f"""
 
-        choices = deepcopy(problem_raw["choices_false"])
-        i_correct = np.random.randint(N_CHOICES)
-        choices.insert(i_correct, problem_raw["choice_true"])
-
-        answers = []
-        for i, choice in enumerate(choices):
-            prefix = f"{'*' if i == i_correct else ''}{chr(ord('a') + i)})"
-            answers.append((prefix, choice))
-
-        problem["question"] = (
-            problem_raw["question"]
-            + f"""
-
-            ```
-            {problem_raw["code"]}
-            ```
-        """
-        )
-        problem["solution"] = problem_raw["solution"]
-        problem["answers"] = answers
-        problem["medias"] = []
+        ```
+        {problem_raw["code"]}
+        ```
+    """
+    )
 
-    return (problems, response)
+    return Problem(question, answers, problem_raw["solution"])
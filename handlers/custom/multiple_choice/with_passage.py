@@ -1,20 +1,12 @@
-import json
-import os
+import random
 from copy import deepcopy
 from typing import List
 
-import dotenv
-import numpy as np
-from google import genai
-from pydantic import BaseModel, Field, create_model
+from pydantic import BaseModel, Field
 
-dotenv.load_dotenv()
-
-API_KEY = os.environ.get("API_KEY")
-MODEL = os.environ.get("MODEL") or "gemini-2.0-flash"
-
-client = genai.Client(api_key=API_KEY)
+from handlers.problemModel import Answer, Passage, Problem
 
+TEMPERATURE = 1.5
 N_CHOICES = 4
 
 
@@ -50,54 +42,20 @@ class QuestionBlock(BaseModel):
     )
 
 
-def handler(prompt_content: str, n_problems: int, extra_cfg: dict):
-    """
-    Takes in content of a prompt and the number of problems to be generated.
-    Return LLM's response.
-    """
-
-    response = client.models.generate_content(
-        model=MODEL,
-        contents=prompt_content,
-        config={
-            "response_mime_type": "application/json",
-            "response_schema": create_model(
-                "MyQuestions",
-                **(
-                    {"p": PassageBlock}
-                    | {f"q{i}": (QuestionBlock, ...) for i in range(n_problems)}
-                ),
-            ),
-            "temperature": extra_cfg.get("temperature", 1.5),
-        },
-    ).text
-    assert response is not None
-    response_dict = json.loads(response)
-
-    keys = response_dict.keys()
-
-    problems = {key: {} for key in keys}
-
-    for key in keys:
-        problem_raw = response_dict[key]
-        problem = problems[key]
+HEADER_BLOCKS = {"p": PassageBlock}
 
-        if key == "p":
-            problem["text"] = problem_raw["passage"]
-            continue
 
-        choices = deepcopy(problem_raw["choices_false"])
-        i_correct = np.random.randint(N_CHOICES)
-        choices.insert(i_correct, problem_raw["choice_true"])
+def get_problem(key: str, problem_raw: dict):
+    if key == "p":
+        return Passage(problem_raw["passage"])
 
-        answers = []
-        for i, choice in enumerate(choices):
-            prefix = f"{'*' if i == i_correct else ''}{chr(ord('a') + i)})"
-            answers.append((prefix, choice))
+    choices = deepcopy(problem_raw["choices_false"])
+    i_correct = random.randrange(N_CHOICES)
+    choices.insert(i_correct, problem_raw["choice_true"])
 
-        problem["question"] = problem_raw["question"]
-        problem["solution"] = problem_raw["solution"]
-        problem["answers"] = answers
-        problem["medias"] = []
+    answers = []
+    for i, choice in enumerate(choices):
+        prefix = f"{'*' if i == i_correct else ''}{chr(ord('a') + i)})"
+        answers.append(Answer(prefix, choice))
 
-    return (problems, response)
+    return Problem(problem_raw["question"], answers, problem_raw["solution"])
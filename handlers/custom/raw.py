@@ -1,29 +1,7 @@
-import os
+from handlers.problemModel import Raw
 
-import dotenv
-from google import genai
+TEMPERATURE = 1.2
 
-dotenv.load_dotenv()
 
-API_KEY = os.environ.get("API_KEY")
-MODEL = os.environ.get("MODEL") or "gemini-2.0-flash"
-
-client = genai.Client(api_key=API_KEY)
-
-
-def handler(prompt_content: str, n_problems: int, extra_cfg: dict):
-    """
-    Takes in content of a prompt and the number of problems to be generated.
-    Return LLM's response.
-    """
-
-    response = client.models.generate_content(
-        model=MODEL,
-        contents=prompt_content,
-        config={
-            "temperature": extra_cfg.get("temperature", 1.2),
-        },
-    ).text
-    assert response is not None
-
-    return ({"q0": {"raw": response}}, response)
+def get_problems(response: str):
+    return [Raw(response)]
@@ -1,17 +1,10 @@
-import json
-import os
 from typing import Union
 
-import dotenv
-from google import genai
-from pydantic import BaseModel, Field, create_model
+from pydantic import BaseModel, Field
 
-dotenv.load_dotenv()
+from handlers.problemModel import Answer, Problem
 
-API_KEY = os.environ.get("API_KEY")
-MODEL = os.environ.get("MODEL") or "gemini-2.0-flash"
-
-client = genai.Client(api_key=API_KEY)
+TEMPERATURE = 1.2
 
 
 class QuestionBlock(BaseModel):
@@ -33,41 +26,9 @@ class QuestionBlock(BaseModel):
     )
 
 
-def handler(prompt_content: str, n_problems: int, extra_cfg: dict):
-    """
-    Takes in content of a prompt and the number of problems to be generated.
-    Return LLM's response.
-    """
-
-    response = client.models.generate_content(
-        model=MODEL,
-        contents=prompt_content,
-        config={
-            "response_mime_type": "application/json",
-            "response_schema": create_model(
-                "MyQuestions",
-                **{f"q{i}": (QuestionBlock, ...) for i in range(n_problems)},
-            ),
-            "temperature": extra_cfg.get("temperature", 1.2),
-        },
-    ).text
-    assert response is not None
-    response_dict = json.loads(response)
-
-    keys = response_dict.keys()
-
-    problems = {
-        key: dict.fromkeys(["ptype", "question", "answers", "medias"], None)
-        for key in keys
-    }
-
-    for key in keys:
-        problem_raw = response_dict[key]
-        problem = problems[key]
-
-        problem["question"] = problem_raw["question"]
-        problem["solution"] = problem_raw["solution"]
-        problem["answers"] = problem_raw["answer"]
-        problem["medias"] = []
-
-    return (problems, response)
+def get_problem(key: str, problem_raw: dict):
+    return Problem(
+        problem_raw["question"],
+        [Answer("*", str(problem_raw["answer"]))],
+        problem_raw["solution"],
+    )
@@ -1,22 +1,15 @@
 # NOT UP-TO-DATE
 
-import json
-import os
 from tempfile import mkstemp
 from typing import List
 
-import dotenv
 import matplotlib.pyplot as plt
 import numpy as np
-from google import genai
-from pydantic import BaseModel, Field, create_model
+from pydantic import BaseModel, Field
 
-dotenv.load_dotenv()
+from handlers.problemModel import Answer, Problem
 
-API_KEY = os.environ.get("API_KEY")
-MODEL = os.environ.get("MODEL") or "gemini-2.0-flash"
-
-client = genai.Client(api_key=API_KEY)
+TEMPERATURE = 1.5
 
 
 class QuestionBlockVariables(BaseModel):
@@ -99,48 +92,17 @@ def get_images(problem_raw):
     return [path]
 
 
-def handler(prompt_content: str, n_problems: int):
-    """
-    Takes in content of a prompt and the number of problems to be generated.
-    Return problems structured in JSON format.
-    """
-
-    response = client.models.generate_content(
-        model=MODEL,
-        contents=prompt_content,
-        config={
-            "response_mime_type": "application/json",
-            "response_schema": create_model(
-                "MyQuestions",
-                **{f"q{i}": (QuestionBlock, ...) for i in range(n_problems)},
-            ),
-            "temperature": 1.5,
-        },
-    ).text
-    assert response is not None
-    response_dict = json.loads(response)
-
-    keys = response_dict.keys()
-
-    problems = {
-        key: dict.fromkeys(["ptype", "question", "answers", "medias"], None)
-        for key in keys
-    }
-
-    for key in keys:
-        problem_raw = response_dict[key]
-        problem = problems[key]
-
-        answer = "".join(np.random.choice(["D", "S"], size=4))
-        statements = []
-        for j, statement_pair in enumerate(problem_raw["statements"]):
-            statement = statement_pair["true" if answer[j] == "D" else "false"]
-            statement_prefix = f"{chr(ord('a') + j)})"
-            statements.append(f"{statement_prefix} {statement}")
-
-        problem["question"] = "\n\n".join([problem_raw["question"]] + statements)
-        problem["solution"] = problem_raw["solution"]
-        problem["answers"] = [("*", answer)]
-        problem["medias"] = get_images(problem_raw)
-
-    return (problems, response)
+def get_problem(key: str, problem_raw: dict):
+    answer = "".join(np.random.choice(["D", "S"], size=4))
+    statements = []
+    for j, statement_pair in enumerate(problem_raw["statements"]):
+        statement = statement_pair["true" if answer[j] == "D" else "false"]
+        statement_prefix = f"{chr(ord('a') + j)})"
+        statements.append(f"{statement_prefix} {statement}")
+
+    return Problem(
+        "\n\n".join([problem_raw["question"]] + statements),
+        [Answer("*", answer)],
+        problem_raw["solution"],
+        get_images(problem_raw),
+    )
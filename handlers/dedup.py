@@ -0,0 +1,185 @@
+import re
+import unicodedata
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .contentHandler import DEDUP_THRESHOLD
+from .problemModel import Passage, Problem
+
+# MinHash signatures of NUM_PERM values, split into N_BANDS bands for LSH: two
+# problems are compared when they agree on a whole band, which happens with
+# probability 1 - (1 - s^4)^32 for a similarity s, e.g. 0.87 for s = 0.5 and
+# above 0.999 for s = 0.8.
+NUM_PERM = 128
+N_BANDS = 32
+SHINGLE_SIZE = 5
+# Shingles hashed at once, bounding memory to CHUNK_SIZE * NUM_PERM * 8 bytes.
+CHUNK_SIZE = 1 << 15
+
+# Shingles and bands are hashed as polynomials of their values, wrapping at 2^64.
+_WEIGHTS = np.array([pow(1000003, i, 1 << 64) for i in range(NUM_PERM)], dtype=np.uint64)
+
+
+def normalize_text(text: str):
+    """
+    Return text lowercased, with punctuation and extra whitespace removed.
+    """
+
+    text = unicodedata.normalize("NFC", text).lower()
+    return " ".join(re.findall(r"\w+", text))
+
+
+def get_problem_text(problem: Problem):
+    # Choices are sorted, so that the same choices in another order still match.
+    choices = sorted(normalize_text(content) for _, content in problem.answers)
+    return " ".join([normalize_text(problem.question)] + choices)
+
+
+def _iter_chunks(texts: list):
+    start, size = 0, 0
+    for i, text in enumerate(texts):
+        if i > start and size + len(text) > CHUNK_SIZE:
+            yield start, i
+            start, size = i, 0
+        size += len(text)
+    if start < len(texts):
+        yield start, len(texts)
+
+
+class DedupIndex:
+    """
+    MinHash/LSH index of problems, telling whether a problem is a near
+    duplicate of one already added, that is whether the estimated Jaccard
+    similarity of their shingles is at least threshold.
+
+    Only problems sharing an LSH band are compared, so that adding n problems
+    takes about linear rather than quadratic time.
+    """
+
+    def __init__(self, threshold: float = DEDUP_THRESHOLD, seed: int = 1):
+        rng = np.random.RandomState(seed)
+        self.threshold = threshold
+        # Odd multipliers, as multiply-shift hashing requires.
+        self._a = rng.randint(0, 1 << 63, NUM_PERM, dtype=np.uint64) * 2 + 1
+        self._b = rng.randint(0, 1 << 63, NUM_PERM, dtype=np.uint64)
+        self._rows = NUM_PERM // N_BANDS
+        self._buckets = [{} for _ in range(N_BANDS)]
+        # Grown by doubling, so that candidates are compared all at once.
+        self._signatures = np.empty((64, NUM_PERM), dtype=np.uint64)
+        self.entries = []
+
+    def get_signatures(self, texts: list):
+        """
+        Return the MinHash signatures of texts, one row per text, over their
+        shingles, that is their substrings of SHINGLE_SIZE characters.
+        """
+
+        # Texts are hashed a chunk at a time rather than one by one, with the
+        # shingles of a whole chunk hashed at once, skipping those that span
+        # two texts. Each value of a signature is then the minimum over the
+        # shingles of a text, with a multiply-shift hash for each permutation.
+        texts = [text.ljust(SHINGLE_SIZE) for text in texts]
+        signatures = np.empty((len(texts), NUM_PERM), dtype=np.uint64)
+        for start, end in _iter_chunks(texts):
+            chunk = "".join(texts[start:end])
+            codes = np.frombuffer(chunk.encode("utf-32-le"), dtype=np.uint32)
+            hashes = sliding_window_view(codes.astype(np.uint64), SHINGLE_SIZE) @ (
+                _WEIGHTS[:SHINGLE_SIZE]
+            )
+
+            lengths = np.array([len(text) for text in texts[start:end]])
+            counts = lengths - SHINGLE_SIZE + 1
+            offsets = np.cumsum(lengths) - lengths
+            starts = np.cumsum(counts) - counts
+            hashes = hashes[np.arange(counts.sum()) + np.repeat(offsets - starts, counts)]
+
+            # One row per permutation, so that reduceat runs along rows.
+            permuted = (np.outer(self._a, hashes) + self._b[:, None]) >> np.uint64(32)
+            signatures[start:end] = np.minimum.reduceat(permuted, starts, axis=1).T
+        return signatures
+
+    def _get_bands(self, signature):
+        return (signature.reshape(N_BANDS, self._rows) @ _WEIGHTS[: self._rows]).tolist()
+
+    def find(self, signature):
+        """
+        Return the index of the entry most similar to signature and their
+        similarity, or None if no entry is similar enough.
+        """
+
+        candidates = set()
+        for bucket, band in zip(self._buckets, self._get_bands(signature)):
+            candidates.update(bucket.get(band, ()))
+        if not candidates:
+            return None
+
+        candidates = np.sort(np.fromiter(candidates, dtype=np.int64))
+        similarities = (self._signatures[candidates] == signature).mean(axis=1)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        return int(candidates[best]), float(similarities[best])
+
+    def add(self, signature, entry):
+        i = len(self.entries)
+        if i == len(self._signatures):
+            self._signatures = np.concatenate([self._signatures, self._signatures])
+        self._signatures[i] = signature
+        self.entries.append(entry)
+        for bucket, band in zip(self._buckets, self._get_bands(signature)):
+            bucket.setdefault(band, []).append(i)
+
+    def filter(self, problems: list, source: str, drop: bool):
+        """
+        Add the problems of source (e.g. a batch) to the index, and return
+        them without the near duplicates of problems already added if drop,
+        along with a record of each duplicate.
+
+        Passages left without problems are dropped along with them.
+        """
+
+        texts = [
+            get_problem_text(problem) if isinstance(problem, Problem) else ""
+            for problem in problems
+        ]
+        signatures = self.get_signatures(texts)
+
+        kept = []
+        duplicates = []
+        passage = None
+        for problem, text, signature in zip(problems, texts, signatures):
+            if isinstance(problem, Passage) and drop:
+                # Kept once one of its problems is.
+                passage = problem
+                continue
+            if not isinstance(problem, Problem):
+                kept.append(problem)
+                continue
+
+            if text:
+                match = self.find(signature)
+                if match is not None:
+                    i, similarity = match
+                    duplicates.append(
+                        {
+                            "source": source,
+                            "question": problem.question,
+                            "duplicate_of": {
+                                "source": self.entries[i][0],
+                                "question": self.entries[i][1].question,
+                            },
+                            "similarity": round(similarity, 4),
+                        }
+                    )
+                    if drop:
+                        continue
+                else:
+                    self.add(signature, (source, problem))
+
+            if passage is not None:
+                kept.append(passage)
+                passage = None
+            kept.append(problem)
+
+        return kept, duplicates
@@ -8,8 +8,17 @@ from docx.oxml import OxmlElement, ns
 from docx.oxml.xmlchemy import BaseOxmlElement
 from docx.shared import Cm, Pt
 from docx.text.run import Run
+from rich import print
 
-from .contentHandler import ANSWER_PATTERNS, IMAGE_FORMATS, txt_to_json
+from . import docxWriter
+from .buildManifest import BuildManifest, FragmentStore, get_digest, get_media_stats
+from .contentHandler import ANSWER_PATTERNS, iter_problems, parse_raw_problems
+from .docxWriter import DocxItem, Picture, get_label_xml, iter_problems_xml, write_docx
+from .mediaHandler import IMAGE_FORMATS, get_file_hash, prepare_scaled_images
+from .problemModel import Problem, ProblemIds
+
+PTYPE_LABELS = {"multiple_choice": "Câu 1", "true_false": "Câu 2"}
+PICTURE_WIDTH_CM = 5.0
 
 
 def create_element(name):
@@ -62,12 +71,24 @@ def add_page_number(run: Run):
     run._r.append(fldChar4)
 
 
-def docx_handler(dir_input: str, dir_output: str):
+def docx_handler(dir_input: str, dir_output: str, manifest: BuildManifest = None):
     with open(os.path.join(dir_input), "r", encoding="utf-8") as f:
-        content = f.read()
+        problems_to_docx(iter_problems(f), dir_output, manifest=manifest)
+
+
+def _get_ptype(problem: Problem):
+    answer_prefix, answer_content = problem.answers[0]
+    ptype = ""
+    if re.match(ANSWER_PATTERNS["mctf"], answer_prefix):
+        ptype = "multiple_choice"
+    if re.match(ANSWER_PATTERNS["shortans"], answer_prefix) and re.match(
+        r"^[SD]+$", answer_content
+    ):
+        ptype = "true_false"
+    return ptype
 
-    problems = txt_to_json(content)
 
+def _create_document():
     doc = Document()
 
     for section in doc.sections:
@@ -85,20 +106,93 @@ def docx_handler(dir_input: str, dir_output: str):
     font.name = "Times New Roman"
     font.size = Pt(14)
 
-    n_problems_of_ptype = {}
-
+    return doc
+
+
+def _add_image(doc, media_path: str, scaled_path: str):
+    """
+    Add the image at scaled_path to the package of doc, shown with the size of
+    the image at media_path. Return its rId, filename and size in EMU.
+
+    python-docx adds each distinct image once, however many runs refer to it.
+    """
+
+    from docx.image.image import Image
+
+    image = Image.from_file(media_path)
+    cx, cy = image.scaled_dimensions(Cm(PICTURE_WIDTH_CM), None)
+    rId, _ = doc.part.get_or_add_image(scaled_path)
+    return rId, image.filename, cx, cy
+
+
+def problems_to_docx(
+    problems,
+    dir_output: str,
+    max_workers: int = None,
+    manifest: BuildManifest = None,
+):
+    """
+    Write the problems to exam.docx in dir_output.
+
+    The document is created with python-docx, but its table rows are written
+    as XML straight into the package (see write_docx), and large exams are
+    rendered in a process pool of max_workers.
+
+    Table rows of problems without medias are stored as fragments, keyed by
+    problem id (see get_problem_id), and reused by the next build in the same
+    directory. exam.docx is not rebuilt at all if no problem changed.
+
+    exam.docx is recorded in manifest if given, which is then left to the
+    caller to save (see run_exports).
+    """
+
+    version = get_digest(get_file_hash(__file__), get_file_hash(docxWriter.__file__))
+    save_manifest = manifest is None
+    if manifest is None:
+        manifest = BuildManifest(dir_output)
+    fragments = FragmentStore(dir_output, "docx", version)
+
+    problems = [
+        problem
+        for problem in parse_raw_problems(problems)
+        if isinstance(problem, Problem)
+    ]
+    problem_ids = ProblemIds()
+    ids = [problem_ids.get(problem) for problem in problems]
+    digest = get_digest(
+        version,
+        ids,
+        get_media_stats(media for problem in problems for media in problem.medias),
+    )
+    if manifest.is_up_to_date("exam.docx", digest):
+        print("[blue]├── [/blue][green]Nội dung không thay đổi, giữ nguyên file docx.")
+        return
+
+    doc = _create_document()
     my_table = doc.add_table(0, 2)
+    widths = tuple(
+        gridCol.get(ns.qn("w:w")) for gridCol in my_table._tbl.tblGrid.gridCol_lst
+    )
+    shape_id = doc.part.next_id
+
+    image_paths = [
+        media
+        for problem in problems
+        for media in problem.medias
+        if os.path.splitext(media)[1][1:] in IMAGE_FORMATS
+    ]
+    scaled_paths = prepare_scaled_images(
+        image_paths, PICTURE_WIDTH_CM, max_workers=max_workers
+    )
+    images = {}
 
-    for problem in problems.values():
-        answer_prefix, answer_content = problem["answers"][0]
-        ptype = ""
-        if re.match(ANSWER_PATTERNS["mctf"], answer_prefix):
-            ptype = "multiple_choice"
-        if re.match(ANSWER_PATTERNS["shortans"], answer_prefix) and re.match(
-            r"^[SD]+$", answer_content
-        ):
-            ptype = "true_false"
+    n_problems_of_ptype = {}
+    # The label and either the fragment or the item of each problem, in order.
+    entries = []
+    items = []
 
+    for problem, problem_id in zip(problems, ids):
+        ptype = _get_ptype(problem)
         if not ptype:
             warnings.warn("Skipping problem of unknown or unsupported type")
             continue
@@ -108,75 +202,47 @@ def docx_handler(dir_input: str, dir_output: str):
         else:
             n_problems_of_ptype[ptype] = 1
 
-        question = problem["question"]
-        answers = problem["answers"]
-        solution = problem["solution"]
-        medias = problem["medias"]
-
-        if ptype == "multiple_choice":
-            row = my_table.add_row()
-            row.cells[0].paragraphs[0].add_run(
-                f"Câu 1.{n_problems_of_ptype[ptype]}"
-            ).bold = True
-            r = row.cells[1].paragraphs[0]
-            r.add_run(question)
-            for media_path in medias:
-                media_format = os.path.splitext(media_path)[1][1:]
-                if media_format in IMAGE_FORMATS:
-                    r.add_run("\n\n")
-                    r.add_run().add_picture(media_path, width=Cm(5.0))
-
-            answer = 0
-            for i, (prefix, choice) in enumerate(answers):
-                if prefix[0] == "*":
-                    answer = i
-                row = my_table.add_row()
-                row.cells[0].paragraphs[0].add_run(chr(ord("A") + i)).bold = True
-                row.cells[1].paragraphs[0].add_run(choice)
-
-            row = my_table.add_row()
-            row.cells[0].paragraphs[0].add_run("Lời giải").bold = True
-            row.cells[1].paragraphs[0].add_run(solution)
-
-            row = my_table.add_row()
-            row.cells[0].paragraphs[0].add_run("Đáp án").bold = True
-            row.cells[1].paragraphs[0].add_run(chr(ord("A") + answer))
-
-        if ptype == "true_false":
-            question_without_statements, *statements = [
-                chunk.strip()
-                for chunk in re.split(
-                    r"^\*?[a-zA-z]\)",
-                    question,
-                    flags=re.MULTILINE,
-                )
-                if chunk
-            ]
-
-            row = my_table.add_row()
-            row.cells[0].paragraphs[0].add_run(
-                f"Câu 2.{n_problems_of_ptype[ptype]}"
-            ).bold = True
-            r = row.cells[1].paragraphs[0]
-            r.add_run(question_without_statements)
-            for media_path in medias:
-                media_format = os.path.splitext(media_path)[1][1:]
-                if media_format in IMAGE_FORMATS:
-                    r.add_run("\n\n")
-                    r.add_run().add_picture(media_path, width=Cm(5.0))
-
-            answer = 0
-            for i, statement in enumerate(statements):
-                row = my_table.add_row()
-                row.cells[0].paragraphs[0].add_run(f"{chr(ord('A') + i)})").bold = True
-                row.cells[1].paragraphs[0].add_run(statement)
-
-            row = my_table.add_row()
-            row.cells[0].paragraphs[0].add_run("Lời giải").bold = True
-            row.cells[1].paragraphs[0].add_run(solution)
-
-            row = my_table.add_row()
-            row.cells[0].paragraphs[0].add_run("Đáp án").bold = True
-            row.cells[1].paragraphs[0].add_run(answers[0][1])
-
-    doc.save(os.path.join(dir_output, "exam.docx"))
+        label = f"{PTYPE_LABELS[ptype]}.{n_problems_of_ptype[ptype]}"
+        fragment = None if problem.medias else fragments.get(problem_id)
+        if fragment is not None:
+            entries.append((label, problem_id, fragment))
+            continue
+
+        # Images are added to the package up front, their runs refer to them.
+        pictures = []
+        for media_path in problem.medias:
+            media_format = os.path.splitext(media_path)[1][1:]
+            if media_format in IMAGE_FORMATS:
+                if media_path not in images:
+                    images[media_path] = _add_image(
+                        doc, media_path, scaled_paths.get(media_path, media_path)
+                    )
+                pictures.append(Picture(shape_id, *images[media_path]))
+                shape_id += 1
+
+        item = DocxItem(problem, ptype, label, tuple(pictures))
+        entries.append((label, problem_id, item))
+        items.append(item)
+
+    def iter_rows_xml():
+        problems_xml = iter_problems_xml(items, widths, max_workers)
+        for label, problem_id, entry in entries:
+            if isinstance(entry, DocxItem):
+                fragment = next(problems_xml)
+                if not entry.problem.medias:
+                    fragments.put(problem_id, fragment)
+            else:
+                fragment = entry
+            yield get_label_xml(widths, label) + fragment
+
+    write_docx(doc, iter_rows_xml(), os.path.join(dir_output, "exam.docx"))
+
+    if fragments.n_reused:
+        print(
+            "[blue]├── [/blue]"
+            f"[green]Dùng lại {fragments.n_reused}/{len(ids)} bài từ lần tạo trước.[/green]"
+        )
+    fragments.save()
+    manifest.record("exam.docx", digest, ids)
+    if save_manifest:
+        manifest.save()
@@ -0,0 +1,245 @@
+import io
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
+
+DOCUMENT_NAME = "word/document.xml"
+
+# Problems are rendered in shards of at most SHARD_SIZE problems when several
+# workers are used, below SHARD_SIZE problems they are rendered in process.
+SHARD_SIZE = 2000
+
+# Characters lxml refuses in text, see _check_xml_chars.
+INVALID_XML_CHARS_PATTERN = r"[\x00-\x08\x0b\x0c\x0e-\x1f]"
+RUN_CONTENT_PATTERN = r"([^\t\r\n]+)|(\t)|[\r\n]"
+
+# The XML python-docx writes for a picture added with Run.add_picture.
+INLINE_PICTURE = (
+    "<w:r><w:drawing>"
+    '<wp:inline xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+    'xmlns:pic="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+    '<wp:extent cx="{cx}" cy="{cy}"/>'
+    '<wp:docPr id="{shape_id}" name="Picture {shape_id}"/>'
+    '<wp:cNvGraphicFramePr><a:graphicFrameLocks noChangeAspect="1"/></wp:cNvGraphicFramePr>'
+    '<a:graphic><a:graphicData uri="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+    '<pic:pic><pic:nvPicPr><pic:cNvPr id="0" name="{filename}"/><pic:cNvPicPr/></pic:nvPicPr>'
+    '<pic:blipFill><a:blip r:embed="{rId}"/><a:stretch><a:fillRect/></a:stretch></pic:blipFill>'
+    '<pic:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="{cx}" cy="{cy}"/></a:xfrm>'
+    '<a:prstGeom prst="rect"/></pic:spPr></pic:pic>'
+    "</a:graphicData></a:graphic></wp:inline>"
+    "</w:drawing></w:r>"
+)
+
+
+class Picture(NamedTuple):
+    shape_id: int
+    rId: str
+    filename: str
+    cx: int
+    cy: int
+
+
+class DocxItem(NamedTuple):
+    """
+    A problem to render as table rows, see get_problem_xml.
+    """
+
+    problem: object
+    ptype: str
+    label: str
+    pictures: tuple
+
+
+def _check_xml_chars(s: str):
+    if re.search(INVALID_XML_CHARS_PATTERN, s):
+        raise ValueError(
+            "All strings must be XML compatible: Unicode or ASCII, "
+            "no NULL bytes or control characters"
+        )
+
+
+def _escape_xml(s: str):
+    return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _escape_xml_attribute(s: str):
+    return (
+        _escape_xml(s)
+        .replace('"', "&quot;")
+        .replace("\t", "&#9;")
+        .replace("\n", "&#10;")
+        .replace("\r", "&#13;")
+    )
+
+
+def get_run_xml(text: str, bold: bool = False):
+    """
+    Return the XML of a run of text, as python-docx's Paragraph.add_run writes it:
+    tabs and line breaks become <w:tab/> and <w:br/>.
+    """
+
+    rpr = "<w:rPr><w:b/></w:rPr>" if bold else ""
+    if not text:
+        return f"<w:r>{rpr}</w:r>" if bold else "<w:r/>"
+    _check_xml_chars(text)
+
+    content = []
+    for match in re.finditer(RUN_CONTENT_PATTERN, text):
+        t, tab = match.groups()
+        if t:
+            space = ' xml:space="preserve"' if len(t.strip()) < len(t) else ""
+            content.append(f"<w:t{space}>{_escape_xml(t)}</w:t>")
+        elif tab:
+            content.append("<w:tab/>")
+        else:
+            content.append("<w:br/>")
+    return f"<w:r>{rpr}{''.join(content)}</w:r>"
+
+
+def get_picture_xml(picture: Picture):
+    return INLINE_PICTURE.format(
+        cx=picture.cx,
+        cy=picture.cy,
+        shape_id=picture.shape_id,
+        filename=_escape_xml_attribute(picture.filename),
+        rId=picture.rId,
+    )
+
+
+def _get_cell_xml(width: str, runs_xml: str):
+    return (
+        f'<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{width}"/></w:tcPr>'
+        f"<w:p>{runs_xml}</w:p></w:tc>"
+    )
+
+
+def _get_row_xml(widths: tuple, label: str, runs_xml: str):
+    return (
+        "<w:tr>"
+        + _get_cell_xml(widths[0], get_run_xml(label, bold=True))
+        + _get_cell_xml(widths[1], runs_xml)
+        + "</w:tr>"
+    )
+
+
+def get_label_xml(widths: tuple, label: str):
+    """
+    Return the start of the rows of a problem, up to its label, see
+    get_problem_xml.
+    """
+
+    return "<w:tr>" + _get_cell_xml(widths[0], get_run_xml(label, bold=True))
+
+
+def get_problem_xml(item: DocxItem, widths: tuple):
+    """
+    Return the table rows of a problem, without their start up to the label of
+    the problem (see get_label_xml), so that they can be reused under another
+    label.
+
+    widths are the widths of the two columns of the table.
+    """
+
+    problem = item.problem
+    question = problem.question
+    rows = []
+
+    if item.ptype == "true_false":
+        question, *statements = [
+            chunk.strip()
+            for chunk in re.split(r"^\*?[a-zA-z]\)", question, flags=re.MULTILINE)
+            if chunk
+        ]
+        choices = [
+            (f"{chr(ord('A') + i)})", statement) for i, statement in enumerate(statements)
+        ]
+        answer = problem.answers[0][1]
+    else:
+        choices = [
+            (chr(ord("A") + i), choice) for i, (_, choice) in enumerate(problem.answers)
+        ]
+        answer = 0
+        for i, (prefix, _) in enumerate(problem.answers):
+            if prefix[0] == "*":
+                answer = i
+        answer = chr(ord("A") + answer)
+
+    runs_xml = [get_run_xml(question)]
+    for picture in item.pictures:
+        runs_xml.append(get_run_xml("\n\n"))
+        runs_xml.append(get_picture_xml(picture))
+    rows.append(_get_cell_xml(widths[1], "".join(runs_xml)) + "</w:tr>")
+
+    for label, choice in choices:
+        rows.append(_get_row_xml(widths, label, get_run_xml(choice)))
+    rows.append(_get_row_xml(widths, "Lời giải", get_run_xml(problem.solution)))
+    rows.append(_get_row_xml(widths, "Đáp án", get_run_xml(answer)))
+    return "".join(rows)
+
+
+def _get_shard_xml(items: list, widths: tuple):
+    return [get_problem_xml(item, widths) for item in items]
+
+
+def _iter_shards(items: list):
+    # Shards are runs of problems of the same type, e.g. the parts of an exam.
+    shard = []
+    for item in items:
+        if shard and (len(shard) >= SHARD_SIZE or item.ptype != shard[-1].ptype):
+            yield shard
+            shard = []
+        shard.append(item)
+    if shard:
+        yield shard
+
+
+def iter_problems_xml(items: list, widths: tuple, max_workers: int = None):
+    """
+    Yield the table rows of each item, see get_problem_xml.
+
+    With more than one worker, large exams are split into shards rendered in a
+    process pool, and their rows yielded in order.
+    """
+
+    if (max_workers or os.cpu_count() or 1) <= 1 or len(items) < 2 * SHARD_SIZE:
+        for item in items:
+            yield get_problem_xml(item, widths)
+        return
+
+    shards = list(_iter_shards(items))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for shard_xml in executor.map(_get_shard_xml, shards, [widths] * len(shards)):
+            yield from shard_xml
+
+
+def write_docx(doc, rows_xml, docx_dir: str):
+    """
+    Save doc, a python-docx Document whose body holds a single empty table, to
+    docx_dir, with the rows in rows_xml streamed into the table.
+
+    The rows are written to the package as they are yielded rather than added
+    to the document, so that they never have to be held in memory as elements.
+    """
+
+    buffer = io.BytesIO()
+    doc.save(buffer)
+
+    with ZipFile(buffer) as zf_template, ZipFile(
+        docx_dir, "w", compression=ZIP_DEFLATED
+    ) as zf:
+        for info in zf_template.infolist():
+            info_out = ZipInfo(info.filename, info.date_time)
+            info_out.compress_type = ZIP_DEFLATED
+            if info.filename != DOCUMENT_NAME:
+                zf.writestr(info_out, zf_template.read(info))
+                continue
+
+            document_xml = zf_template.read(info).decode("utf-8")
+            i = document_xml.rindex("</w:tbl>")
+            with zf.open(info_out, "w") as f:
+                f.write(document_xml[:i].encode("utf-8"))
+                for row_xml in rows_xml:
+                    f.write(row_xml.encode("utf-8"))
+                f.write(document_xml[i:].encode("utf-8"))
@@ -0,0 +1,132 @@
+import importlib
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import NamedTuple
+
+from rich import print
+
+from .buildManifest import BuildManifest
+
+
+class ExportTarget(NamedTuple):
+    module: str
+    # Exporters of a content file and of problems, both taking dir_output and
+    # a manifest to record their output in.
+    file_exporter: str
+    problems_exporter: str
+    output_name: str
+    label: str
+
+
+EXPORT_TARGETS = {
+    "docx": ExportTarget(
+        "handlers.docxHandler", "docx_handler", "problems_to_docx", "exam.docx", "file docx"
+    ),
+    "qti": ExportTarget(
+        "handlers.qtiHandler", "qti_handler", "problems_to_qti", "qti.zip", "file zip QTI"
+    ),
+    "answer_key": ExportTarget(
+        "handlers.answerKeyHandler",
+        "answer_key_handler",
+        "problems_to_answer_key",
+        "answer_key.csv",
+        "đáp án",
+    ),
+}
+
+
+def parse_targets(targets: str):
+    """
+    Return the comma-separated names of export targets as a list, or raise a
+    KeyError for unknown ones.
+    """
+
+    targets = list(dict.fromkeys(t.strip() for t in targets.split(",") if t.strip()))
+    for target in targets:
+        if target not in EXPORT_TARGETS:
+            raise KeyError(
+                f"Unknown export target: {target}. "
+                f"Expected some of {', '.join(EXPORT_TARGETS)}."
+            )
+    return targets
+
+
+def _export(target_name: str, source, dir_output: str, from_file: bool):
+    target = EXPORT_TARGETS[target_name]
+    module = importlib.import_module(target.module)
+    exporter = getattr(
+        module, target.file_exporter if from_file else target.problems_exporter
+    )
+
+    manifest = BuildManifest(dir_output)
+    exporter(source, dir_output, manifest=manifest)
+    return manifest.outputs.get(target.output_name)
+
+
+def run_exports(targets: list, source, dir_output: str, from_file: bool = False):
+    """
+    Export source, a list of problems or the path of a content file if
+    from_file, to each target in dir_output. See run_exports_to_dirs.
+    """
+
+    run_exports_to_dirs(targets, {dir_output: source}, from_file)
+
+
+def run_exports_to_dirs(targets: list, sources: dict, from_file: bool = False):
+    """
+    Export each source in sources, a dict mapping output directories to
+    sources, to each target in its output directory.
+
+    Exports are run concurrently in worker processes, printing their progress
+    as they go. The outputs are then recorded in the manifest of each output
+    directory by this process only, so that workers never write one at once.
+    """
+
+    targets = list(targets)
+    labels = [EXPORT_TARGETS[target].label for target in targets]
+    print(f"[yellow]Đang tạo {', '.join(labels)}...[/yellow]")
+
+    jobs = [
+        (target, source, dir_output)
+        for dir_output, source in sources.items()
+        for target in targets
+    ]
+    manifests = {dir_output: BuildManifest(dir_output) for dir_output in sources}
+    errors = []
+
+    def on_done(job: tuple, output: dict, is_last: bool):
+        target, _, dir_output = job
+        output_name = EXPORT_TARGETS[target].output_name
+        if output is not None:
+            manifests[dir_output].outputs[output_name] = output
+        print(
+            f"[blue]{'└──' if is_last else '├──'} [/blue]"
+            f"[green]Đã tạo {EXPORT_TARGETS[target].label} thành công: [/green]"
+            f"[white]{os.path.join(dir_output, output_name)}[/white]"
+        )
+
+    if len(jobs) == 1:
+        on_done(jobs[0], _export(*jobs[0], from_file), True)
+    else:
+        # Each target gets its own process at least, even on a single CPU.
+        max_workers = min(len(jobs), max(len(targets), os.cpu_count() or 1))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(_export, *job, from_file): job for job in jobs}
+            for i, future in enumerate(as_completed(futures)):
+                try:
+                    output = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    target, _, dir_output = futures[future]
+                    print(
+                        f"[blue]├── [/blue]"
+                        f"[red]Không tạo được {EXPORT_TARGETS[target].label} "
+                        f"tại [white]{dir_output}[/white].[/red]"
+                    )
+                    continue
+                on_done(futures[future], output, i == len(jobs) - 1)
+
+    for manifest in manifests.values():
+        manifest.save()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,290 @@
+import importlib.util
+import inspect
+import json
+import os
+import sys
+import threading
+
+from .jsonStream import JSONObjectStream
+from .llmClient import get_client, get_model
+from .problemModel import to_problem, to_problems
+
+HANDLERS_DIR = os.path.join("handlers", "custom")
+
+# Appended to the prompt of a request continuing a response that was cut off.
+CONTINUATION_PROMPT = """
+
+Phản hồi trước của bạn cho yêu cầu trên đã bị cắt ngang. Dưới đây là các phần đã hoàn chỉnh:
+
+```json
+{members}
+```
+
+Chỉ tạo các phần còn thiếu: {keys}. Không lặp lại các bài ở trên."""
+
+_handlers = {}
+_handlers_lock = threading.Lock()
+
+
+class Handler:
+    """
+    A handler module, imported once and shared by every batch using it.
+
+    Declarative handler modules define `QuestionBlock` (the pydantic model of a
+    single problem) and `get_problem(key, problem_raw)`, returning a Problem
+    (see problemModel), optionally along with
+    `HEADER_BLOCKS`, `TEMPERATURE`, `MODEL` and `get_problems(response)`. The
+    schema, the LLM calls and the response parsing are then handled here.
+
+    Modules defining their own `handler` function are used as is.
+    """
+
+    def __init__(self, name: str, module):
+        self.name = name
+        self.module = module
+        self.source = inspect.getsource(module)
+        self.is_declarative = not hasattr(module, "handler")
+        self._schemas = {}
+
+    @property
+    def model(self):
+        return getattr(self.module, "MODEL", None) or get_model()
+
+    @property
+    def is_async(self):
+        return self.is_declarative or hasattr(self.module, "handler_async")
+
+    @property
+    def can_cache(self):
+        if self.is_declarative:
+            return True
+        return hasattr(self.module, "get_config") and hasattr(
+            self.module, "get_problems"
+        )
+
+    @property
+    def can_continue(self):
+        # Responses parsed as a whole by the module cannot be salvaged.
+        return (
+            self.is_declarative
+            and hasattr(self.module, "QuestionBlock")
+            and not hasattr(self.module, "get_problems")
+        )
+
+    @property
+    def can_stream(self):
+        if self.is_declarative:
+            return hasattr(self.module, "QuestionBlock")
+        return hasattr(self.module, "handler_stream") and hasattr(
+            self.module, "get_problem"
+        )
+
+    def get_keys(self, n_problems: int):
+        """
+        Return the keys of a response of n_problems problems: the keys of the
+        header blocks, if any, then q0, q1...
+        """
+
+        return list(getattr(self.module, "HEADER_BLOCKS", {})) + [
+            f"q{i}" for i in range(n_problems)
+        ]
+
+    def get_schema(self, n_problems: int, keys: list = None):
+        """
+        Return the response schema of n_problems problems, or of the given keys
+        only, e.g. those missing from a response that was cut off.
+        """
+
+        if not hasattr(self.module, "QuestionBlock"):
+            return None
+
+        # Schemas are memoized per keys, create_model is not cheap.
+        keys = tuple(self.get_keys(n_problems) if keys is None else keys)
+        if keys not in self._schemas:
+            from pydantic import create_model
+
+            header_blocks = getattr(self.module, "HEADER_BLOCKS", {})
+            self._schemas[keys] = create_model(
+                "MyQuestions",
+                **{
+                    key: header_blocks[key]
+                    if key in header_blocks
+                    else (self.module.QuestionBlock, ...)
+                    for key in keys
+                },
+            )
+
+        return self._schemas[keys]
+
+    def get_config(self, n_problems: int, extra_cfg: dict, keys: list = None):
+        if not self.is_declarative:
+            return self.module.get_config(n_problems, extra_cfg)
+
+        config = {
+            "temperature": extra_cfg.get(
+                "temperature", getattr(self.module, "TEMPERATURE", 1.0)
+            ),
+        }
+        schema = self.get_schema(n_problems, keys)
+        if schema is not None:
+            config["response_mime_type"] = "application/json"
+            config["response_schema"] = schema
+        return config
+
+    def get_problem(self, key: str, problem_raw):
+        return to_problem(self.module.get_problem(key, problem_raw))
+
+    def get_problems(self, response: str):
+        """
+        Return the list of problems parsed from response, in order.
+        """
+
+        if hasattr(self.module, "get_problems"):
+            return to_problems(self.module.get_problems(response))
+
+        return [
+            self.get_problem(key, problem_raw)
+            for key, problem_raw in json.loads(response).items()
+        ]
+
+    def salvage(self, response: str):
+        """
+        Return the members of response, a JSON object that may be cut off or
+        malformed, that are fully formed, along with whether response is
+        complete.
+        """
+
+        parser = JSONObjectStream()
+        members = parser.feed(response)
+        return (members, parser.is_complete and not parser.n_invalid)
+
+    def parse_response(self, response: str):
+        """
+        Return the problems parsed from response, along with whether response
+        is complete. Unlike get_problems, the problems of a response that was
+        cut off are salvaged, if the handler allows it (see can_continue).
+        """
+
+        if not self.can_continue:
+            return (self.get_problems(response), True)
+
+        members, is_complete = self.salvage(response)
+        problems = [self.get_problem(key, problem_raw) for key, problem_raw in members]
+        return (problems, is_complete)
+
+    def get_continuation_prompt(self, prompt_content: str, members: dict, keys: list):
+        """
+        Return the prompt of a request for the keys missing from a response
+        that was cut off, of which members were salvaged.
+        """
+
+        return prompt_content + CONTINUATION_PROMPT.format(
+            members=json.dumps(members, ensure_ascii=False, indent=2),
+            keys=", ".join(keys),
+        )
+
+    def generate(
+        self, prompt_content: str, n_problems: int, extra_cfg: dict, keys: list = None
+    ):
+        """
+        Return the problems generated for prompt_content, the raw response and
+        whether it is complete. keys restricts the response to some of its
+        keys (see get_schema).
+        """
+
+        if not self.is_declarative:
+            problems, response = self.module.handler(
+                prompt_content, n_problems, extra_cfg
+            )
+            return (to_problems(problems), response, True)
+
+        response = get_client().models.generate_content(
+            model=self.model,
+            contents=prompt_content,
+            config=self.get_config(n_problems, extra_cfg, keys),
+        )
+
+        problems, is_complete = self.parse_response(response.text)
+        return (problems, response.text, is_complete and not _is_truncated(response))
+
+    async def generate_async(
+        self, prompt_content: str, n_problems: int, extra_cfg: dict, keys: list = None
+    ):
+        if not self.is_declarative:
+            problems, response = await self.module.handler_async(
+                prompt_content, n_problems, extra_cfg
+            )
+            return (to_problems(problems), response, True)
+
+        response = await get_client().aio.models.generate_content(
+            model=self.model,
+            contents=prompt_content,
+            config=self.get_config(n_problems, extra_cfg, keys),
+        )
+
+        problems, is_complete = self.parse_response(response.text)
+        return (problems, response.text, is_complete and not _is_truncated(response))
+
+    async def generate_stream(
+        self, prompt_content: str, n_problems: int, extra_cfg: dict, keys: list = None
+    ):
+        if not self.is_declarative:
+            async for chunk in self.module.handler_stream(
+                prompt_content, n_problems, extra_cfg
+            ):
+                yield chunk
+            return
+
+        async for chunk in await get_client().aio.models.generate_content_stream(
+            model=self.model,
+            contents=prompt_content,
+            config=self.get_config(n_problems, extra_cfg, keys),
+        ):
+            if chunk.text:
+                yield chunk.text
+
+
+def _is_truncated(response):
+    # Cut off by the output token limit, e.g. when asking for too many problems.
+    candidates = response.candidates or []
+    return bool(candidates) and candidates[0].finish_reason == "MAX_TOKENS"
+
+
+def _load_module(handler_name: str):
+    handler_path = os.path.join(HANDLERS_DIR, f"{handler_name}.py")
+
+    if not os.path.exists(handler_path):
+        raise ImportError(f"Module {handler_name} not found at {handler_path}.")
+
+    module_name = f"handlers.custom.{handler_name.replace('/', '.')}"
+
+    spec = importlib.util.spec_from_file_location(module_name, handler_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[module_name]
+        raise
+
+    if not any(
+        hasattr(module, attr) for attr in ["handler", "get_problem", "get_problems"]
+    ):
+        raise ImportError(
+            f"Module {handler_name} defines neither function handler nor get_problem."
+        )
+
+    return module
+
+
+def get_handler(handler_name: str):
+    """
+    Return the handler named handler_name (e.g. "multiple_choice/default"),
+    importing its module on first use only.
+    """
+
+    with _handlers_lock:
+        if handler_name not in _handlers:
+            _handlers[handler_name] = Handler(handler_name, _load_module(handler_name))
+
+        return _handlers[handler_name]
@@ -0,0 +1,89 @@
+import json
+
+
+class JSONObjectStream:
+    """
+    Incremental parser of a JSON object, e.g. {"q0": {...}, "q1": {...}}.
+
+    Text is fed chunk by chunk, and each top-level member is returned as a
+    (key, value) pair as soon as its value is complete, without waiting for
+    the rest of the object.
+
+    Malformed members are skipped and counted in n_invalid, so that the other
+    members of a cut off or malformed response can still be salvaged.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.member_start = None
+        self.is_complete = False
+        self.n_invalid = 0
+
+    def _pop_member(self, end: int):
+        member = self.buffer[self.member_start : end].strip()
+        self.member_start = None
+        if not member:
+            return []
+        try:
+            return list(json.loads(f"{{{member}}}").items())
+        except json.JSONDecodeError:
+            self.n_invalid += 1
+            return []
+
+    def feed(self, chunk: str):
+        """
+        Feed the next chunk of text, return the list of newly completed members.
+        """
+
+        self.buffer += chunk
+        members = []
+
+        buffer = self.buffer
+        for pos in range(self.pos, len(buffer)):
+            c = buffer[pos]
+
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif c == "\\":
+                    self.escaped = True
+                elif c == '"':
+                    self.in_string = False
+                continue
+
+            if c == '"':
+                self.in_string = True
+            elif c in "{[":
+                self.depth += 1
+                if self.depth == 1:
+                    if c != "{":
+                        raise ValueError("Expected a JSON object.")
+                    self.member_start = pos + 1
+            elif c in "}]":
+                self.depth -= 1
+                if self.depth == 1 and self.member_start is not None:
+                    # A nested value just closed: its member is complete.
+                    members += self._pop_member(pos + 1)
+                elif self.depth == 0:
+                    if self.member_start is not None:
+                        members += self._pop_member(pos)
+                    self.is_complete = True
+            elif c == "," and self.depth == 1:
+                if self.member_start is not None:
+                    members += self._pop_member(pos)
+                self.member_start = pos + 1
+
+        self.pos = len(buffer)
+
+        # Drop text that has already been parsed.
+        drop = self.member_start if self.member_start is not None else self.pos
+        self.buffer = self.buffer[drop:]
+        self.pos -= drop
+        if self.member_start is not None:
+            self.member_start = 0
+
+        return members
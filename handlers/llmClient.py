@@ -0,0 +1,390 @@
+import asyncio
+import os
+import random
+import re
+import threading
+import time
+
+import dotenv
+
+from .telemetry import get_call_stats
+
+dotenv.load_dotenv()
+
+DEFAULT_MODEL = "gemini-2.0-flash"
+
+# Transient errors are retried up to MAX_RETRIES times, after a jittered
+# exponential backoff of at most BACKOFF_MAX seconds, unless the server says
+# when to retry.
+DEFAULT_MAX_RETRIES = 6
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# Tokens of a request are estimated from the length of its prompt, plus its
+# maximum output if set, until its actual usage is known.
+CHARS_PER_TOKEN = 4
+DEFAULT_OUTPUT_TOKENS = 2048
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class EmptyResponseError(Exception):
+    pass
+
+
+def get_model():
+    return os.environ.get("MODEL") or DEFAULT_MODEL
+
+
+def get_api_keys():
+    """
+    Return the API keys to spread requests across: API_KEYS, comma-separated,
+    or else API_KEY.
+    """
+
+    keys = [key.strip() for key in os.environ.get("API_KEYS", "").split(",")]
+    keys = [key for key in keys if key]
+    return keys or [os.environ.get("API_KEY")]
+
+
+def _get_int_env(name: str, default: int):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+class _Bucket:
+    """
+    Token bucket holding up to per_minute tokens, refilled at per_minute tokens
+    per minute. A per_minute of 0 means no limit.
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(
+            self.capacity, self.level + (now - self.updated) * self.capacity / 60
+        )
+        self.updated = now
+
+    def get_wait(self, amount: int, now: float):
+        if not self.capacity:
+            return 0.0
+        self._refill(now)
+        # More than the capacity only waits for a full bucket, or it never would.
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) * 60 / self.capacity)
+
+    def take(self, amount: int, now: float):
+        if self.capacity:
+            self._refill(now)
+            self.level -= amount
+
+
+class _Key:
+    def __init__(self, api_key: str, rpm: int, tpm: int):
+        from google import genai
+
+        self.client = genai.Client(api_key=api_key)
+        self.requests = _Bucket(rpm)
+        self.tokens = _Bucket(tpm)
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+
+
+def _get_request_tokens(contents, config):
+    if isinstance(config, dict):
+        max_output_tokens = config.get("max_output_tokens")
+    else:
+        max_output_tokens = getattr(config, "max_output_tokens", None)
+    return len(str(contents)) // CHARS_PER_TOKEN + (
+        max_output_tokens or DEFAULT_OUTPUT_TOKENS
+    )
+
+
+def _get_used_tokens(response):
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "total_token_count", None)
+
+
+def _on_response(response):
+    stats = get_call_stats()
+    if stats is not None:
+        stats.on_response(response)
+
+
+def _get_server_delay(e: Exception):
+    # 429 errors of the Gemini API tell when to retry, e.g. "retryDelay": "30s".
+    match = re.search(r"'retryDelay': '(\d+(?:\.\d+)?)s'", str(getattr(e, "details", "")))
+    return float(match.group(1)) if match else None
+
+
+async def _empty_stream():
+    return
+    yield
+
+
+def _is_transient(e: Exception):
+    import httpx
+    from google.genai import errors
+
+    if isinstance(e, errors.APIError):
+        return e.code in RETRY_STATUS_CODES
+    return isinstance(e, (httpx.TransportError, EmptyResponseError))
+
+
+class KeyPool:
+    """
+    API keys, each with its own client and its own RPM and TPM token buckets.
+
+    Each request goes to the least loaded key whose buckets allow it, that is
+    the key with the fewest requests in flight, ties broken round-robin, and
+    waits if none does. Transient errors are retried with a jittered
+    exponential backoff, and a key hitting its quota (429) is left to cool
+    down meanwhile.
+    """
+
+    def __init__(self, api_keys: list, rpm: int = 0, tpm: int = 0, max_retries: int = 0):
+        self.keys = [_Key(api_key, rpm, tpm) for api_key in api_keys]
+        self.max_retries = max_retries
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: int):
+        # Return a key with tokens taken from its buckets, or the time to wait.
+        with self._lock:
+            now = time.monotonic()
+            best, best_score = None, None
+            for i in range(len(self.keys)):
+                key = self.keys[(self._next + i) % len(self.keys)]
+                wait = max(
+                    key.cooldown_until - now,
+                    key.requests.get_wait(1, now),
+                    key.tokens.get_wait(tokens, now),
+                )
+                score = (wait, key.in_flight)
+                if best_score is None or score < best_score:
+                    best, best_score = key, score
+
+            if best_score[0] > 0:
+                return None, best_score[0]
+
+            best.requests.take(1, now)
+            best.tokens.take(tokens, now)
+            best.in_flight += 1
+            self._next = (self.keys.index(best) + 1) % len(self.keys)
+            return best, 0.0
+
+    def acquire(self, tokens: int):
+        while True:
+            key, wait = self._reserve(tokens)
+            if key is not None:
+                return key
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens: int):
+        while True:
+            key, wait = self._reserve(tokens)
+            if key is not None:
+                return key
+            await asyncio.sleep(wait)
+
+    def release(self, key: _Key, tokens: int, used_tokens: int = None):
+        """
+        Release key after a request for which tokens were reserved, correcting
+        its TPM bucket with the tokens actually used, if known.
+        """
+
+        with self._lock:
+            key.in_flight -= 1
+            if used_tokens is not None:
+                key.tokens.take(used_tokens - tokens, time.monotonic())
+
+    def get_retry_delay(self, key: _Key, e: Exception, attempt: int):
+        """
+        Return the seconds to wait before retrying after e, or None if e is not
+        transient or there are no retries left.
+        """
+
+        if attempt >= self.max_retries or not _is_transient(e):
+            return None
+
+        delay = _get_server_delay(e)
+        if delay is None:
+            delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+        if getattr(e, "code", None) == 429:
+            with self._lock:
+                key.cooldown_until = max(key.cooldown_until, time.monotonic() + delay)
+
+        stats = get_call_stats()
+        if stats is not None:
+            stats.retries += 1
+        return delay
+
+    def generate_content(self, *, model: str, contents, config=None):
+        tokens = _get_request_tokens(contents, config)
+        attempt = 0
+        while True:
+            key = self.acquire(tokens)
+            response = None
+            try:
+                response = key.client.models.generate_content(
+                    model=model, contents=contents, config=config
+                )
+                _on_response(response)
+                if response.text is None:
+                    raise EmptyResponseError("Empty response from the LLM.")
+                return response
+            except Exception as e:
+                delay = self.get_retry_delay(key, e, attempt)
+                if delay is None:
+                    raise
+            finally:
+                self.release(key, tokens, _get_used_tokens(response))
+            time.sleep(delay)
+            attempt += 1
+
+    async def generate_content_async(self, *, model: str, contents, config=None):
+        tokens = _get_request_tokens(contents, config)
+        attempt = 0
+        while True:
+            key = await self.acquire_async(tokens)
+            response = None
+            try:
+                response = await key.client.aio.models.generate_content(
+                    model=model, contents=contents, config=config
+                )
+                _on_response(response)
+                if response.text is None:
+                    raise EmptyResponseError("Empty response from the LLM.")
+                return response
+            except Exception as e:
+                delay = self.get_retry_delay(key, e, attempt)
+                if delay is None:
+                    raise
+            finally:
+                self.release(key, tokens, _get_used_tokens(response))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def generate_content_stream_async(self, *, model: str, contents, config=None):
+        """
+        Like generate_content_async, but streamed. Requests are only retried
+        until their first chunk, since chunks already yielded cannot be taken
+        back.
+        """
+
+        tokens = _get_request_tokens(contents, config)
+        attempt = 0
+        while True:
+            key = await self.acquire_async(tokens)
+            try:
+                stream = await key.client.aio.models.generate_content_stream(
+                    model=model, contents=contents, config=config
+                )
+                stream = stream.__aiter__()
+                first = await stream.__anext__()
+                _on_response(first)
+                break
+            except StopAsyncIteration:
+                # Released right away, the caller may never iterate an empty stream.
+                self.release(key, tokens)
+                return _empty_stream()
+            except Exception as e:
+                self.release(key, tokens)
+                delay = self.get_retry_delay(key, e, attempt)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+        return self._stream(key, tokens, first, stream)
+
+    async def _stream(self, key: _Key, tokens: int, first, stream):
+        used_tokens = None
+        try:
+            used_tokens = _get_used_tokens(first)
+            yield first
+            async for chunk in stream:
+                _on_response(chunk)
+                used_tokens = _get_used_tokens(chunk) or used_tokens
+                yield chunk
+        finally:
+            self.release(key, tokens, used_tokens)
+
+
+class _Models:
+    def __init__(self, pool: KeyPool):
+        self._pool = pool
+
+    def generate_content(self, *, model: str, contents, config=None):
+        return self._pool.generate_content(model=model, contents=contents, config=config)
+
+    def __getattr__(self, name: str):
+        # Other methods, e.g. count_tokens, are left to the first key.
+        return getattr(self._pool.keys[0].client.models, name)
+
+
+class _AsyncModels:
+    def __init__(self, pool: KeyPool):
+        self._pool = pool
+
+    async def generate_content(self, *, model: str, contents, config=None):
+        return await self._pool.generate_content_async(
+            model=model, contents=contents, config=config
+        )
+
+    async def generate_content_stream(self, *, model: str, contents, config=None):
+        return await self._pool.generate_content_stream_async(
+            model=model, contents=contents, config=config
+        )
+
+    def __getattr__(self, name: str):
+        return getattr(self._pool.keys[0].client.aio.models, name)
+
+
+class _AsyncClient:
+    def __init__(self, pool: KeyPool):
+        self.models = _AsyncModels(pool)
+
+
+class Client:
+    """
+    Stand-in for google.genai.Client, whose generate_content calls (sync,
+    async and async streamed) go through a KeyPool.
+    """
+
+    def __init__(self, pool: KeyPool):
+        self.pool = pool
+        self.models = _Models(pool)
+        self.aio = _AsyncClient(pool)
+
+
+def get_client():
+    """
+    Return the client shared by all handlers, created on first use.
+
+    Sharing one client means sharing its HTTP connection pools (sync and async),
+    so that concurrent batches reuse connections instead of opening new ones,
+    and sharing the rate limits of its API keys, RPM and TPM per key.
+    """
+
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = Client(
+                    KeyPool(
+                        get_api_keys(),
+                        rpm=_get_int_env("RPM", 0),
+                        tpm=_get_int_env("TPM", 0),
+                        max_retries=_get_int_env("MAX_RETRIES", DEFAULT_MAX_RETRIES),
+                    )
+                )
+
+    return _client
@@ -0,0 +1,166 @@
+import hashlib
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+IMAGE_FORMATS = ["gif", "jpeg", "jpg", "svg", "png"]
+AUDIO_FORMATS = ["mp3", "mpeg"]
+
+# Assets are stored in these formats, sources already in them are copied as is.
+IMAGE_ASSET_FORMAT = "png"
+AUDIO_ASSET_FORMAT = "mp3"
+
+HASH_CHUNK_SIZE = 1 << 20
+
+# Images shown in documents are downscaled to this resolution, Word's default
+# when compressing pictures, and cached here by content hash and width.
+IMAGE_CACHE_DIR = os.path.join(".cache", "images")
+IMAGE_PPI = 220
+# Formats downscaled, others (e.g. animated gifs) are used as is.
+SCALED_IMAGE_FORMATS = {"png": "PNG", "jpg": "JPEG", "jpeg": "JPEG"}
+
+
+def get_media_format(media_loc: str):
+    return os.path.splitext(media_loc)[1][1:]
+
+
+def get_asset_format(media_loc: str):
+    media_format = get_media_format(media_loc)
+    if media_format in IMAGE_FORMATS:
+        return IMAGE_ASSET_FORMAT
+    if media_format in AUDIO_FORMATS:
+        return AUDIO_ASSET_FORMAT
+    raise Exception(f"Invalid or unsupported media at: {media_loc}")
+
+
+def get_file_hash(file_path: str):
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def _transcode(media_loc: str, asset_path: str):
+    # Written to a temporary file first, so that an interrupted run never leaves
+    # a truncated asset behind to be reused by the next one.
+    tmp_path = f"{asset_path}.tmp"
+
+    if get_asset_format(media_loc) == IMAGE_ASSET_FORMAT:
+        from PIL import Image
+
+        with Image.open(media_loc) as img:
+            img.save(tmp_path, format="PNG")
+    else:
+        import soundfile as sf
+
+        data, samplerate = sf.read(media_loc)
+        sf.write(tmp_path, data, samplerate, format="MP3")
+
+    os.replace(tmp_path, asset_path)
+    return asset_path
+
+
+def prepare_assets(media_locs, assets_dir: str, max_workers: int = None):
+    """
+    Copy or convert each media to assets_dir, return a dict mapping each media
+    path to the path of its asset.
+
+    Medias are deduplicated by content: each unique media is stored once, as
+    {hash}.png or {hash}.mp3, and shared by every problem referencing it. Medias
+    already in the asset format are copied, the others are converted in a
+    process pool.
+    """
+
+    media_locs = list(dict.fromkeys(media_locs))
+    for media_loc in media_locs:
+        if not os.path.isfile(media_loc):
+            raise Exception(f"Invalid or unsupported media at: {media_loc}")
+        get_asset_format(media_loc)
+
+    if not media_locs:
+        return {}
+
+    os.makedirs(assets_dir, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        media_hashes = list(executor.map(get_file_hash, media_locs))
+
+    asset_paths = {}
+    to_transcode = {}
+    for media_loc, media_hash in zip(media_locs, media_hashes):
+        asset_path = os.path.join(
+            assets_dir, f"{media_hash[:16]}.{get_asset_format(media_loc)}"
+        )
+        asset_paths[media_loc] = asset_path
+
+        if os.path.exists(asset_path) or asset_path in to_transcode:
+            continue
+        if get_media_format(media_loc) == get_asset_format(media_loc):
+            shutil.copyfile(media_loc, asset_path)
+        else:
+            to_transcode[asset_path] = media_loc
+
+    if len(to_transcode) > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(_transcode, to_transcode.values(), to_transcode.keys()))
+    else:
+        for asset_path, media_loc in to_transcode.items():
+            _transcode(media_loc, asset_path)
+
+    return asset_paths
+
+
+def _scale_image(media_loc: str, width_px: int, cache_dir: str):
+    from PIL import Image
+
+    media_hash = get_file_hash(media_loc)
+    media_format = get_media_format(media_loc).lower()
+    scaled_path = os.path.join(cache_dir, f"{media_hash[:16]}_{width_px}.{media_format}")
+    if os.path.exists(scaled_path):
+        return scaled_path
+
+    with Image.open(media_loc) as img:
+        if img.width <= width_px:
+            return media_loc
+        height_px = max(1, round(img.height * width_px / img.width))
+        img_scaled = img.resize((width_px, height_px), Image.LANCZOS)
+
+    tmp_path = f"{scaled_path}.tmp"
+    img_scaled.save(tmp_path, format=SCALED_IMAGE_FORMATS[media_format])
+    os.replace(tmp_path, scaled_path)
+    return scaled_path
+
+
+def prepare_scaled_images(
+    media_locs,
+    width_cm: float,
+    cache_dir: str = IMAGE_CACHE_DIR,
+    max_workers: int = None,
+):
+    """
+    Return a dict mapping each image to a copy downscaled to width_cm at
+    IMAGE_PPI, or to itself if it is small enough already.
+
+    Scaled copies are cached in cache_dir by content hash and width, so that an
+    image is only scaled once across runs.
+    """
+
+    media_locs = [
+        media_loc
+        for media_loc in dict.fromkeys(media_locs)
+        if get_media_format(media_loc).lower() in SCALED_IMAGE_FORMATS
+    ]
+    if not media_locs:
+        return {}
+
+    os.makedirs(cache_dir, exist_ok=True)
+    width_px = round(width_cm / 2.54 * IMAGE_PPI)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        scaled_paths = executor.map(
+            _scale_image,
+            media_locs,
+            [width_px] * len(media_locs),
+            [cache_dir] * len(media_locs),
+        )
+        return dict(zip(media_locs, scaled_paths))
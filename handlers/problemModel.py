@@ -0,0 +1,156 @@
+import hashlib
+import json
+import sys
+import uuid
+from typing import NamedTuple
+
+
+class Answer(NamedTuple):
+    prefix: str
+    content: str
+
+
+class Problem:
+    """
+    A question, with its answers (e.g. ("*b)", "...")), solution and medias.
+
+    Problems are kept in memory by the thousands, so they use __slots__ rather
+    than dicts, and store answers and medias as tuples.
+    """
+
+    __slots__ = ("question", "answers", "solution", "medias")
+
+    def __init__(
+        self,
+        question: str,
+        answers=(),
+        solution: str = "",
+        medias=(),
+    ):
+        self.question = question
+        # Only a handful of distinct prefixes exist (e.g. "a)", "*b)"), so
+        # they are interned rather than stored once per answer.
+        self.answers = tuple(
+            Answer(sys.intern(prefix), content) for prefix, content in answers
+        )
+        self.solution = solution or ""
+        self.medias = tuple(medias) if medias else ()
+
+    def replace(self, **changes):
+        return Problem(
+            changes.get("question", self.question),
+            changes.get("answers", self.answers),
+            changes.get("solution", self.solution),
+            changes.get("medias", self.medias),
+        )
+
+    def __eq__(self, other):
+        return isinstance(other, Problem) and all(
+            getattr(self, attr) == getattr(other, attr) for attr in self.__slots__
+        )
+
+    def __repr__(self):
+        return f"Problem(question={self.question[:40]!r}, answers={len(self.answers)})"
+
+
+class Passage:
+    """
+    A text shown before the following problems, e.g. a reading passage.
+    """
+
+    __slots__ = ("text",)
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def __eq__(self, other):
+        return isinstance(other, Passage) and self.text == other.text
+
+    def __repr__(self):
+        return f"Passage(text={self.text[:40]!r})"
+
+
+class Raw:
+    """
+    Problems already in QTI-compatible text format, written as is.
+    """
+
+    __slots__ = ("raw",)
+
+    def __init__(self, raw: str):
+        self.raw = raw
+
+    def __eq__(self, other):
+        return isinstance(other, Raw) and self.raw == other.raw
+
+    def __repr__(self):
+        return f"Raw(raw={self.raw[:40]!r})"
+
+
+def get_problem_id(problem: Problem, occurrence: int = 0):
+    """
+    Return an id derived from the content of problem, formatted as a UUID, so
+    that identical problems get identical ids from one run to the next.
+
+    occurrence tells apart copies of the same problem within one exam.
+    """
+
+    payload = json.dumps(
+        [
+            problem.question,
+            problem.answers,
+            problem.solution,
+            problem.medias,
+            occurrence,
+        ],
+        ensure_ascii=False,
+    )
+    return str(uuid.UUID(bytes=hashlib.sha256(payload.encode("utf-8")).digest()[:16]))
+
+
+class ProblemIds:
+    """
+    Assign ids to the problems of an exam in order, see get_problem_id.
+    """
+
+    def __init__(self):
+        self._occurrences = {}
+
+    def get(self, problem: Problem):
+        problem_id = get_problem_id(problem)
+        occurrence = self._occurrences.get(problem_id, 0)
+        self._occurrences[problem_id] = occurrence + 1
+        if occurrence:
+            problem_id = get_problem_id(problem, occurrence)
+        return problem_id
+
+
+def to_problem(value):
+    """
+    Return value as a Problem, Passage or Raw. Dicts returned by handlers written
+    before this model (e.g. {"question": ..., "answers": [...]}) are converted.
+    """
+
+    if isinstance(value, (Problem, Passage, Raw)):
+        return value
+    if "raw" in value:
+        return Raw(value["raw"])
+    if "text" in value:
+        return Passage(value["text"])
+    return Problem(
+        value["question"],
+        value.get("answers") or (),
+        value.get("solution") or "",
+        value.get("medias") or (),
+    )
+
+
+def to_problems(values):
+    """
+    Return values, a list or a dict of problems as returned by handlers, as a
+    list of problems.
+    """
+
+    if isinstance(values, dict):
+        values = values.values()
+    return [to_problem(value) for value in values]
@@ -1,104 +1,311 @@
 import html
+import io
 import os
 import re
-from tempfile import TemporaryDirectory
 from zipfile import ZipFile
 
-from bs4 import BeautifulSoup
-from bs4.formatter import HTMLFormatter
 from rich import print
 
+from .buildManifest import BuildManifest, get_digest, get_media_stats
+from .mediaHandler import get_file_hash
+from .qtiValidator import format_location, locate_error, validate_content
 
-def qti_handler(dir_input: str, dir_output: str):
+# text2qti forks, by order of preference. Only the default fork is checked
+# before parsing (see validate_content), the others are assumed to support a
+# superset of its syntax.
+FORKS = ["default", "substance9"]
+
+# The post-processing of text2qti output used to go through BeautifulSoup, and
+# Canvas imports are known to work with its serialization of mattext HTML, so
+# it is reproduced here: wrapped in <html><body>, attributes sorted, void
+# elements closed with "/>".
+VOID_ELEMENTS = {
+    "area", "base", "basefont", "bgsound", "br", "col", "command", "embed",
+    "frame", "hr", "image", "img", "input", "isindex", "keygen", "link",
+    "menuitem", "meta", "nextid", "param", "source", "spacer", "track", "wbr",
+}  # fmt: skip
+RAW_TEXT_ELEMENTS = {"rp", "rt", "script", "style", "template"}
+LIST_ATTRIBUTES = {"accesskey", "class", "dropzone"}
+LIST_ATTRIBUTES_PER_TAG = {
+    "a": {"rel", "rev"},
+    "area": {"rel"},
+    "form": {"accept-charset"},
+    "icon": {"sizes"},
+    "iframe": {"sandbox"},
+    "link": {"rel", "rev"},
+    "object": {"archive"},
+    "output": {"for"},
+    "td": {"headers"},
+    "th": {"headers"},
+}
+IMAGE_SRC_PATTERN = r"\.(?!bmp$|gif$|jpeg$|jpg$|svg$|tiff$|png$).*"
+
+# Length of the escaped "<html><body><p>" and "</p></body></html>" around dropdown choices.
+HTML_PREFIX_SIZE = 33
+HTML_SUFFIX_SIZE = 36
+
+
+def qti_handler(dir_input: str, dir_output: str, manifest: BuildManifest = None):
     with open(os.path.join(dir_input), "r", encoding="utf-8") as f:
         content = f.read()
 
-    forks = ["default", "substance9"]
-    error_messages = []
-    is_successful = False
+    content_to_qti(
+        content, dir_output, source_name=os.path.dirname(dir_input), manifest=manifest
+    )
+
+
+def problems_to_qti(problems: list, dir_output: str, manifest: BuildManifest = None):
+    from .contentHandler import json_to_txt
+
+    content_to_qti(
+        json_to_txt(problems, None, with_hidden_uuid=True),
+        dir_output,
+        source_name=dir_output,
+        manifest=manifest,
+    )
+
+
+def _escape_html(s: str):
+    return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _quote_attribute(value: str):
+    value = _escape_html(value)
+    if '"' not in value:
+        return f'"{value}"'
+    if "'" not in value:
+        return f"'{value}'"
+    return '"' + value.replace('"', "&quot;") + '"'
+
+
+def _serialize_html(element, out: list):
+    from lxml import etree
+
+    if element.tag is etree.Comment:
+        out.append(f"<!--{element.text or ''}-->")
+    elif element.tag is etree.PI:
+        out.append(f"<?{element.target} {element.text}>")
+    else:
+        tag = element.tag
+        attributes = []
+        for key, value in sorted(element.attrib.items()):
+            if key in LIST_ATTRIBUTES or key in LIST_ATTRIBUTES_PER_TAG.get(tag, ()):
+                value = " ".join(value.split())
+            attributes.append(f" {key}={_quote_attribute(value)}")
+
+        if tag in VOID_ELEMENTS and not len(element) and not element.text:
+            out.append(f"<{tag}{''.join(attributes)}/>")
+        else:
+            out.append(f"<{tag}{''.join(attributes)}>")
+            if element.text:
+                out.append(
+                    element.text
+                    if tag in RAW_TEXT_ELEMENTS
+                    else _escape_html(element.text)
+                )
+            for child in element:
+                _serialize_html(child, out)
+            out.append(f"</{tag}>")
+
+    if element.tail:
+        out.append(_escape_html(element.tail))
+
+
+def process_mattext(mattext: str, is_choice: bool = False):
+    """
+    Return the HTML of a mattext, with mp3 medias turned into <audio> tags.
+
+    Choices lose their HTML wrapping, which dropdown boxes do not support.
+    """
+
+    from lxml import etree
+
+    if not mattext.strip():
+        return ""
+    root = etree.fromstring(mattext, etree.HTMLParser())
+    if root is None:
+        return ""
+
+    for img in root.iter("img"):
+        src = img.get("src")
+        if src is None or not re.search(IMAGE_SRC_PATTERN, src):
+            continue
+        extension = re.search(r"\.([a-zA-Z0-9]+)$", src)
+        if extension is None or extension.group(1) != "mp3":
+            continue
+
+        audio = etree.Element("audio", controls="True")
+        etree.SubElement(audio, "source", type="audio/mp3", src=src)
+        audio.tail = img.tail
+        img.getparent().replace(img, audio)
+
+    out = []
+    for sibling in reversed(list(root.itersiblings(preceding=True))):
+        _serialize_html(sibling, out)
+    _serialize_html(root, out)
+    for sibling in root.itersiblings():
+        _serialize_html(sibling, out)
+    text = "".join(out)
+
+    if is_choice:
+        # Remove unsupported html tags in dropdown boxes when using substance9's fork.
+        text = html.unescape(html.escape(text)[HTML_PREFIX_SIZE:-HTML_SUFFIX_SIZE])
+    return text
+
+
+def _process_assessment(f_in, f_out):
+    from lxml import etree
+
+    tree = etree.parse(f_in)
+    for mattext in tree.iter("{*}mattext"):
+        mattext.text = process_mattext(
+            mattext.text or "",
+            is_choice=bool(mattext.xpath("ancestor::*[local-name()='response_label']")),
+        )
+    tree.write(f_out, xml_declaration=True, encoding="utf-8")
+
+
+def _postprocess_qti(zip_bytes: bytes, qti_dir: str):
+    """
+    Copy the QTI zip built by text2qti to qti_dir, one member at a time,
+    rewriting assessments on the way: mp3 medias become <audio> tags, and
+    dropdown choices lose their HTML wrapping.
+    """
+
+    with ZipFile(io.BytesIO(zip_bytes), "r") as zf_in:
+        with ZipFile(qti_dir, "w") as zf_out:
+            for info in zf_in.infolist():
+                with zf_in.open(info) as f_in:
+                    with zf_out.open(info, "w") as f_out:
+                        if os.path.basename(info.filename).startswith(
+                            "text2qti_assessment_"
+                        ):
+                            _process_assessment(f_in, f_out)
+                        else:
+                            while chunk := f_in.read(1 << 20):
+                                f_out.write(chunk)
+
+
+def _build_qti(fork: str, content: str, source_name: str):
+    if fork == "default":
+        from text2qti.config import Config
+        from text2qti.qti import QTI
+        from text2qti.quiz import Quiz
+    elif fork == "substance9":
+        from .text2qti_forks.substance9.text2qti.config import Config
+        from .text2qti_forks.substance9.text2qti.qti import QTI
+        from .text2qti_forks.substance9.text2qti.quiz import Quiz
+
+    quiz = Quiz(content, config=Config(), source_name=source_name)
+    return QTI(quiz).zip_bytes()
+
+
+def _try_forks(forks: list, content: str, source_name: str):
+    """
+    Build the QTI zip with each fork in turn, return the first fork to succeed
+    and its zip, along with the errors of the forks which failed before it.
+    """
+
+    errors = {}
     for fork in forks:
         try:
-            if fork == "default":
-                from text2qti.config import Config
-                from text2qti.qti import QTI
-                from text2qti.quiz import Quiz
-            elif fork == "substance9":
-                from .text2qti_forks.substance9.text2qti.config import Config
-                from .text2qti_forks.substance9.text2qti.qti import QTI
-                from .text2qti_forks.substance9.text2qti.quiz import Quiz
-
-            text2qti_config = Config()
-            quiz = Quiz(
-                content, config=text2qti_config, source_name=os.path.dirname(dir_input)
-            )
-            qti = QTI(quiz)
+            return fork, _build_qti(fork, content, source_name), errors
+        except Exception as e:
+            errors[fork] = e
+    return None, None, errors
 
-            qti_dir = os.path.join(dir_output, "qti.zip")
-            qti.save(qti_dir)
 
-            is_successful = True
-            break
-        except Exception as e:
-            error_messages.append(e)
-            pass
+def _build_with_forks(content: str, source_name: str):
+    """
+    Build the QTI zip with the first fork able to parse content.
 
-    if not is_successful:
-        for fork, error_message in zip(forks, error_messages):
+    Questions are first checked against the syntax of the default fork, so that
+    content it cannot parse goes straight to the other forks, which are then
+    tried in order. Errors are reported with the question they occur in.
+    """
+
+    spans, preflight_errors = validate_content(content)
+    errors = {}
+    if not preflight_errors:
+        fork, zip_bytes, errors = _try_forks(FORKS[:1], content, source_name)
+        if fork is not None:
+            return fork, zip_bytes
+    else:
+        print(
+            "[blue]├── [/blue][yellow]"
+            f"Fork {FORKS[0]} không hỗ trợ nội dung, dùng fork {', '.join(FORKS[1:])}:"
+        )
+        for error in preflight_errors:
             print(
-                "[blue]└── [/blue]"
-                f"[red]Fork {fork}: [/red]"
-                f"[white]{error_message}[/white]"
+                "[blue]│   └── [/blue]"
+                f"[yellow]{format_location(error.question, error.linenum)}: [/yellow]"
+                f"[white]{error.message}[/white]"
             )
-        raise Exception(
-            "Cannot parse given content file using any text2qti fork. Please consult the error messages above."
+
+    fork, zip_bytes, fallback_errors = _try_forks(FORKS[1:], content, source_name)
+    if fork is not None:
+        return fork, zip_bytes
+    errors |= fallback_errors
+
+    for fork, error in errors.items():
+        error_message = str(error)
+        question = locate_error(spans, error_message)
+        location = f"{format_location(question)}: " if question else ""
+        print(
+            "[blue]└── [/blue]"
+            f"[red]Fork {fork}: {location}[/red]"
+            f"[white]{error_message}[/white]"
         )
+    raise Exception(
+        "Cannot parse given content file using any text2qti fork. Please consult the error messages above."
+    )
 
-    # Black magic
-    with TemporaryDirectory() as tmpdir:
-        with ZipFile(qti_dir, "r") as zf:
-            zf.extractall(tmpdir)
-
-        for root, _, files in os.walk(tmpdir):
-            for file in files:
-                if os.path.basename(file).startswith("text2qti_assessment_"):
-                    with open(os.path.join(root, file), "r", encoding="utf-8") as f:
-                        soup = BeautifulSoup(f.read(), features="xml")
-
-                    for mattext_tag in soup.find_all("mattext"):
-                        mattext_soup = BeautifulSoup(
-                            mattext_tag.string, features="lxml"
-                        )
-                        for false_img in mattext_soup.find_all(
-                            "img",
-                            src=re.compile(
-                                r"\.(?!bmp$|gif$|jpeg$|jpg$|svg$|tiff$|png$).*"
-                            ),
-                        ):
-                            src_tag = false_img["src"]
-                            extension = re.search(r"\.([a-zA-Z0-9]+)$", src_tag).group(
-                                1
-                            )
-                            if extension == "mp3":
-                                audio_tag = soup.new_tag("audio", controls=True)
-                                source_tag = soup.new_tag(
-                                    "source", type="audio/mp3", src=src_tag
-                                )
-                                audio_tag.append(source_tag)
-                                false_img.replaceWith(audio_tag)
-                        mattext_tag.string = html.escape(str(mattext_soup))
-
-                    for response_label in soup.find_all("response_label"):
-                        for mattext_tag in response_label.find_all("mattext"):
-                            # Remove unsupported html tags in dropdown boxes when using substance9's fork.
-                            mattext_tag.string = mattext_tag.string[33:-36]
-
-                    with open(os.path.join(root, file), "w", encoding="utf-8") as f:
-                        f.write(soup.prettify(formatter=HTMLFormatter(indent=2)))
-
-        with ZipFile(qti_dir, "w") as zf:
-            for root, _, files in os.walk(tmpdir):
-                for file in files:
-                    zf.write(
-                        os.path.join(root, file),
-                        os.path.relpath(os.path.join(root, file), tmpdir),
-                    )
+
+def content_to_qti(
+    content: str,
+    dir_output: str,
+    source_name: str,
+    manifest: BuildManifest = None,
+):
+    """
+    Write the content to qti.zip in dir_output, unless the same content was
+    already built there (see BuildManifest). qti.zip is recorded in manifest if
+    given, which is then left to the caller to save (see run_exports).
+
+    Content is written by the native writer when possible (see write_qti), and
+    only parsed by text2qti otherwise.
+    """
+
+    from . import qtiValidator, qtiWriter
+    from .contentHandler import MEDIA_COMPONENTS_PATTERN
+    from .qtiWriter import UnsupportedContent, write_qti
+
+    save_manifest = manifest is None
+    if manifest is None:
+        manifest = BuildManifest(dir_output)
+    digest = get_digest(
+        get_file_hash(__file__),
+        get_file_hash(qtiWriter.__file__),
+        get_file_hash(qtiValidator.__file__),
+        content,
+        get_media_stats(
+            media_loc
+            for _, media_loc in re.findall(MEDIA_COMPONENTS_PATTERN, content)
+        ),
+    )
+    if manifest.is_up_to_date("qti.zip", digest):
+        print("[blue]├── [/blue][green]Nội dung không thay đổi, giữ nguyên file zip QTI.")
+        return
+
+    qti_dir = os.path.join(dir_output, "qti.zip")
+    try:
+        write_qti(content, qti_dir)
+    except UnsupportedContent:
+        fork, zip_bytes = _build_with_forks(content, source_name)
+        if fork != FORKS[0]:
+            print(f"[blue]├── [/blue][green]Đã tạo file zip QTI bằng fork {fork}.")
+        _postprocess_qti(zip_bytes, qti_dir)
+
+    manifest.record("qti.zip", digest)
+    if save_manifest:
+        manifest.save()
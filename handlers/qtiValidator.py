@@ -0,0 +1,252 @@
+import bisect
+import re
+from typing import NamedTuple
+
+# Response types of the default text2qti fork, per start pattern of a response.
+RESPONSE_TYPES = {
+    "mctf_correct_choice": "multiple_choice_question",
+    "mctf_incorrect_choice": "multiple_choice_question",
+    "multans_correct_choice": "multiple_answers_question",
+    "multans_incorrect_choice": "multiple_answers_question",
+    "shortans_correct_choice": "short_answer_question",
+    "essay": "essay_question",
+    "upload": "file_upload_question",
+    "numerical": "numerical_question",
+}
+CORRECT_CHOICES = {
+    "mctf_correct_choice",
+    "multans_correct_choice",
+    "shortans_correct_choice",
+}
+CHOICES = {
+    "mctf_correct_choice",
+    "mctf_incorrect_choice",
+    "multans_correct_choice",
+    "multans_incorrect_choice",
+    "shortans_correct_choice",
+}
+# Start patterns which end the current question, as in text2qti.
+QUESTION_ENDS = {"question", "text_title", "text", "start_group", "end_group"}
+# Start patterns setting attributes of the next question.
+QUESTION_ATTRIBUTES = {"question_title", "question_points"}
+
+LINE_PATTERN = r"on line (\d+)"
+
+
+class QuestionSpan(NamedTuple):
+    number: int
+    linenum_start: int
+    linenum_end: int
+
+
+class QuestionError(NamedTuple):
+    question: QuestionSpan
+    linenum: int
+    message: str
+
+
+class _Question:
+    __slots__ = ("number", "linenum_start", "linenum_end", "type", "choices", "n_correct")
+
+    def __init__(self, number: int, linenum_start: int):
+        self.number = number
+        self.linenum_start = linenum_start
+        self.linenum_end = linenum_start
+        self.type = None
+        self.choices = set()
+        self.n_correct = 0
+
+    def get_span(self):
+        return QuestionSpan(self.number, self.linenum_start, self.linenum_end)
+
+
+def _finalize(question: _Question):
+    # Same checks as text2qti's Question.finalize.
+    if question.type is None:
+        return "Question must specify a response type"
+    if question.type == "multiple_choice_question":
+        if len(question.choices) < 2:
+            return "Question must provide more than one choice"
+        if question.n_correct < 1:
+            return "Question must specify a correct choice"
+        if question.n_correct > 1:
+            return "Question must specify only one correct choice"
+    elif question.type == "multiple_answers_question":
+        if len(question.choices) < 2:
+            return "Question must provide more than one choice"
+        if question.n_correct < 1:
+            return "Question must specify a correct choice"
+    return None
+
+
+def validate_content(content: str):
+    """
+    Check content against the syntax of the default text2qti fork, line by line
+    and without rendering markdown, which is much faster than parsing it.
+
+    Return the span of each question and the errors found. Unlike text2qti,
+    which stops at the first error and reports missing choices on the line of
+    the next question, every error is located in the question it belongs to.
+    Only errors text2qti is certain to raise are reported, so that valid
+    content is never rejected.
+    """
+
+    from text2qti.quiz import multi_line, multi_para, start_patterns, start_re
+
+    spans = []
+    errors = []
+    questions = set()
+    question = None
+    number = 0
+    has_attributes = False
+
+    # The multi-line item being read: its action, first line and text lines.
+    item = None
+    indent = None
+    in_comment = False
+    code_delim = None
+
+    def add_error(linenum: int, message: str):
+        errors.append(
+            QuestionError(question.get_span() if question else None, linenum, message)
+        )
+
+    def end_item():
+        nonlocal item
+        if item is None:
+            return
+        action, linenum, lines = item
+        text = "\n".join(lines).strip()
+        if action == "question":
+            if text in questions:
+                add_error(linenum, "Duplicate question")
+            questions.add(text)
+        elif action in CHOICES and question is not None:
+            if text in question.choices:
+                add_error(linenum, "Duplicate choice for question")
+            question.choices.add(text)
+        item = None
+
+    def end_question():
+        nonlocal question
+        if question is None:
+            return
+        message = _finalize(question)
+        if message:
+            add_error(question.linenum_end, message)
+        spans.append(question.get_span())
+        question = None
+
+    for linenum, line in enumerate(content.split("\n"), 1):
+        if in_comment:
+            in_comment = not line.startswith("END_COMMENT")
+            continue
+        if code_delim is not None:
+            if line.startswith(code_delim) and not line.lstrip("`").strip():
+                code_delim = None
+            continue
+
+        if not line or line.isspace():
+            if item is not None:
+                if item[0] in multi_para:
+                    item[2].append("")
+                else:
+                    end_item()
+            continue
+
+        if item is not None:
+            line_expandtabs = line.expandtabs(4)
+            if indent is None and line.startswith((" ", "\t")):
+                indent = len(line_expandtabs) - len(line_expandtabs.lstrip(" "))
+                if indent < 2:
+                    add_error(linenum, "Indentation must be at least 2 spaces or 1 tab here")
+                    end_item()
+                    continue
+            if indent is not None and line_expandtabs.startswith(" " * indent):
+                item[2].append(line_expandtabs[indent:].rstrip())
+                if question is not None:
+                    question.linenum_end = linenum
+                continue
+            end_item()
+
+        if line.startswith("%"):
+            continue
+        if line.startswith("COMMENT"):
+            in_comment = True
+            continue
+
+        match = start_re.match(line)
+        if match is None:
+            add_error(
+                linenum,
+                "Syntax error; unexpected text, or incorrect indentation for a wrapped paragraph",
+            )
+            continue
+        action = match.lastgroup
+
+        if action == "start_code":
+            code_delim = "`" * (len(line) - len(line.lstrip("`")))
+            continue
+        if has_attributes and action not in QUESTION_ATTRIBUTES | {"question"}:
+            add_error(
+                linenum,
+                "Expected question; question title and/or points were set but not used",
+            )
+        has_attributes = action in QUESTION_ATTRIBUTES
+
+        if action in QUESTION_ENDS:
+            end_question()
+        if action == "question":
+            number += 1
+            question = _Question(number, linenum)
+        elif action in RESPONSE_TYPES:
+            if question is None:
+                add_error(linenum, "Cannot have a response without a question")
+            elif question.type not in (None, RESPONSE_TYPES[action]) or (
+                question.type is not None and action in ("essay", "upload", "numerical")
+            ):
+                add_error(
+                    linenum,
+                    f'Question type "{question.type}" does not support this response',
+                )
+            else:
+                question.type = RESPONSE_TYPES[action]
+                question.n_correct += action in CORRECT_CHOICES
+        if question is not None and not has_attributes:
+            question.linenum_end = linenum
+
+        if action in multi_line:
+            item = (action, linenum, [line[match.end() :].strip()])
+            indent = (
+                None
+                if start_patterns[action].endswith(":")
+                else len(line[: match.end()].expandtabs(4))
+            )
+
+    end_item()
+    end_question()
+    return spans, errors
+
+
+def locate_error(spans: list, message: str):
+    """
+    Return the question in which a text2qti error message is located, if any.
+    """
+
+    match = re.search(LINE_PATTERN, message)
+    if match is None or not spans:
+        return None
+    linenum = int(match.group(1))
+    i = bisect.bisect_right([span.linenum_start for span in spans], linenum) - 1
+    if i < 0 or linenum > spans[i].linenum_end:
+        return None
+    return spans[i]
+
+
+def format_location(question: QuestionSpan, linenum: int = None):
+    if question is None:
+        return f"Dòng {linenum}" if linenum else "Nội dung"
+    location = f"Câu {question.number} (dòng {question.linenum_start}"
+    if question.linenum_end != question.linenum_start:
+        location += f"-{question.linenum_end}"
+    return location + ")"
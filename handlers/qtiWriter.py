@@ -0,0 +1,380 @@
+import hashlib
+import re
+from types import SimpleNamespace
+from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
+
+from .qtiHandler import process_mattext
+
+# Items of the QTI-compatible text format written by the native writer. Other
+# items (e.g. numerical or essay responses, question groups) go through text2qti.
+CHOICE_ACTIONS = {
+    "mctf_correct_choice": "append_mctf_correct_choice",
+    "mctf_incorrect_choice": "append_mctf_incorrect_choice",
+    "multans_correct_choice": "append_multans_correct_choice",
+    "multans_incorrect_choice": "append_multans_incorrect_choice",
+    "shortans_correct_choice": "append_shortans_correct_choice",
+}
+ACTIONS = {"question", "feedback", "text"} | set(CHOICE_ACTIONS)
+
+# The assessment is written as lxml serializes it after post-processing.
+XML_DECLARATION = "<?xml version='1.0' encoding='UTF-8'?>\n"
+# Empty elements are self-closed, except mattexts, whose text is always set.
+EMPTY_ELEMENT_PATTERN = r"<(?!mattext\b)([\w:]+)([^<>]*)></\1>"
+INVALID_XML_CHARS_PATTERN = r"[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]"
+
+# Markdown made of plain paragraphs (lines starting with a letter, with no
+# character markdown or its extensions give a meaning to), optionally followed
+# by the hidden id of a problem (see contentHandler), which most choices and
+# solutions are. Python-Markdown renders it as is, one <p> per paragraph.
+PLAIN_LINE_PATTERN = r"[^\W\d_](?:[^\W_]|[ ,;:?!()%/]|\.(?!\.)|-(?!-))*(?<! )"
+PLAIN_MARKDOWN_PATTERN = (
+    rf"{PLAIN_LINE_PATTERN}(?:\n+{PLAIN_LINE_PATTERN})*"
+    r'(?:\n\n<font style="display:none">[0-9a-f-]{36}</font>)?'
+)
+
+
+class UnsupportedContent(Exception):
+    pass
+
+
+def _get_markdown():
+    """
+    Return a text2qti Markdown renderer which skips Python-Markdown for plain
+    paragraphs, rendering them the same way.
+    """
+
+    from text2qti.config import Config
+    from text2qti.markdown import Markdown
+
+    md = Markdown(Config())
+    md_to_html = md.md_to_html
+
+    def md_to_html_plain(markdown_string: str, strip_p_tags: bool = False):
+        if strip_p_tags or not re.fullmatch(PLAIN_MARKDOWN_PATTERN, markdown_string):
+            return md_to_html(markdown_string, strip_p_tags)
+        return "\n".join(f"<p>{p}</p>" for p in re.split(r"\n\n+", markdown_string))
+
+    md.md_to_html = md_to_html_plain
+    return md
+
+
+def _iter_chunks(content: str):
+    # Items start on unindented lines, the lines of an item are indented or blank.
+    lines = []
+    for line in content.split("\n"):
+        if lines and line and not line.isspace() and not line.startswith((" ", "\t")):
+            yield "\n".join(lines)
+            lines = []
+        lines.append(line)
+    if lines:
+        yield "\n".join(lines)
+
+
+def _read_item(chunk: str):
+    """
+    Return the action and text of an item in QTI-compatible text format, as
+    text2qti reads them (see text2qti.quiz.Quiz), or None if chunk is empty.
+    """
+
+    from text2qti.quiz import single_line, start_patterns, start_re
+
+    lines = chunk.rstrip("\n").split("\n")
+    if not chunk.strip():
+        return None
+    match = start_re.match(lines[0])
+    if match is None or match.lastgroup not in ACTIONS:
+        raise UnsupportedContent
+    action = match.lastgroup
+    text_lines = [lines[0][match.end() :].strip()]
+
+    if action in single_line:
+        if any(line.strip() for line in lines[1:]):
+            raise UnsupportedContent
+        return action, text_lines[0]
+
+    if start_patterns[action].endswith(":"):
+        indent = None
+    else:
+        indent = len(lines[0][: match.end()].expandtabs(4))
+    for line in lines[1:]:
+        if not line or line.isspace():
+            text_lines.append("")
+            continue
+        line_expandtabs = line.expandtabs(4)
+        if indent is None:
+            if not line.startswith((" ", "\t")):
+                raise UnsupportedContent
+            indent = len(line_expandtabs) - len(line_expandtabs.lstrip(" "))
+            if indent < 2:
+                raise UnsupportedContent
+        elif not line_expandtabs.startswith(" " * indent):
+            raise UnsupportedContent
+        text_lines.append(line_expandtabs[indent:].rstrip())
+    while text_lines and not text_lines[-1]:
+        text_lines.pop()
+    return action, "\n".join(text_lines)
+
+
+def _unescape_xml(s: str):
+    return s.replace("&lt;", "<").replace("&gt;", ">").replace("&amp;", "&")
+
+
+def _to_mattext(html_xml: str, is_choice: bool = False):
+    text = _unescape_xml(html_xml)
+    if re.search(INVALID_XML_CHARS_PATTERN, text):
+        raise UnsupportedContent
+    # Line endings are normalized by XML parsers.
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = process_mattext(text, is_choice=is_choice)
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _to_mattext_text(s: str):
+    # Short answers are plain text, not HTML.
+    if re.search(INVALID_XML_CHARS_PATTERN, s):
+        raise UnsupportedContent
+    s = s.replace("\r\n", "\n").replace("\r", "\n")
+    return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _get_text_xml(text_region):
+    from text2qti.xml_assessment import TEXT
+
+    return TEXT.format(
+        ident=f"text2qti_text_{text_region.id}",
+        text_title_xml=text_region.title_xml,
+        assessment_question_identifierref=f"text2qti_question_ref_{text_region.id}",
+        text_html_xml=_to_mattext(text_region.text_html_xml),
+    )
+
+
+def _get_question_xml(question):
+    """
+    Return the XML of a question, as text2qti.xml_assessment.assessment writes
+    it, with its mattexts post-processed.
+    """
+
+    from text2qti import xml_assessment as xa
+
+    xml = [
+        xa.START_ITEM.format(
+            question_identifier=f"text2qti_question_{question.id}",
+            question_title=question.title_xml,
+        ),
+        xa.ITEM_METADATA_MCTF_SHORTANS_MULTANS_NUM.format(
+            question_type=question.type,
+            points_possible=question.points_possible,
+            original_answer_ids=",".join(
+                f"text2qti_choice_{c.id}" for c in question.choices
+            ),
+            assessment_question_identifierref=f"text2qti_question_ref_{question.id}",
+        ),
+    ]
+    question_html_xml = _to_mattext(question.question_html_xml)
+
+    if question.type == "short_answer_question":
+        xml.append(
+            xa.ITEM_PRESENTATION_SHORTANS.format(question_html_xml=question_html_xml)
+        )
+        varequal = "\n".join(
+            xa.ITEM_RESPROCESSING_SHORTANS_SET_CORRECT_VAREQUAL.format(
+                answer_xml=_to_mattext_text(c.choice_raw)
+            )
+            for c in question.choices
+        )
+        set_correct = xa.ITEM_RESPROCESSING_SHORTANS_SET_CORRECT_NO_FEEDBACK.format(
+            varequal=varequal
+        )
+    else:
+        if question.type == "multiple_answers_question":
+            item_presentation = xa.ITEM_PRESENTATION_MULTANS
+        else:
+            item_presentation = xa.ITEM_PRESENTATION_MCTF
+        choices = "\n".join(
+            xa.ITEM_PRESENTATION_MCTF_CHOICE.format(
+                ident=f"text2qti_choice_{c.id}",
+                choice_html_xml=_to_mattext(c.choice_html_xml, is_choice=True),
+            )
+            for c in question.choices
+        )
+        xml.append(
+            item_presentation.format(
+                question_html_xml=question_html_xml, choices=choices
+            )
+        )
+
+        if question.type == "multiple_answers_question":
+            varequal = "\n".join(
+                (
+                    xa.ITEM_RESPROCESSING_MULTANS_SET_CORRECT_VAREQUAL_CORRECT
+                    if c.correct
+                    else xa.ITEM_RESPROCESSING_MULTANS_SET_CORRECT_VAREQUAL_INCORRECT
+                ).format(ident=f"text2qti_choice_{c.id}")
+                for c in question.choices
+            )
+            set_correct = xa.ITEM_RESPROCESSING_MULTANS_SET_CORRECT_NO_FEEDBACK.format(
+                varequal=varequal
+            )
+        else:
+            correct_choice = next(c for c in question.choices if c.correct)
+            set_correct = xa.ITEM_RESPROCESSING_MCTF_SET_CORRECT_NO_FEEDBACK.format(
+                ident=f"text2qti_choice_{correct_choice.id}"
+            )
+
+    xml.append(xa.ITEM_RESPROCESSING_START)
+    if question.feedback_raw is not None:
+        xml.append(xa.ITEM_RESPROCESSING_MCTF_GENERAL_FEEDBACK)
+    xml.append(set_correct)
+    xml.append(xa.ITEM_RESPROCESSING_END)
+    if question.feedback_raw is not None:
+        xml.append(
+            xa.ITEM_FEEDBACK_MCTF_SHORTANS_MULTANS_NUM_GENERAL.format(
+                feedback=_to_mattext(question.feedback_html_xml)
+            )
+        )
+    xml.append(xa.END_ITEM)
+    return "".join(xml)
+
+
+def _iter_items(content: str, md):
+    """
+    Build text2qti questions and text regions from the items of content, as
+    text2qti.quiz.Quiz does, yielding each once complete along with its XML.
+    """
+
+    from text2qti.err import Text2qtiError
+    from text2qti.quiz import Question, TextRegion
+
+    quiz = SimpleNamespace(feedback_is_solution=None)
+    question_set = set()
+    question = None
+    index = 0
+
+    def finalize(question):
+        question.finalize()
+        return question, re.sub(EMPTY_ELEMENT_PATTERN, r"<\1\2/>", _get_question_xml(question))
+
+    try:
+        for chunk in _iter_chunks(content):
+            item = _read_item(chunk)
+            if item is None:
+                continue
+            action, text = item
+
+            if action in ("question", "text") and question is not None:
+                yield finalize(question)
+                question = None
+
+            if action == "question":
+                question = Question(
+                    text,
+                    quiz=quiz,
+                    title=None,
+                    points=None,
+                    md=md,
+                    linenum_start=0,
+                    linenum_end=0,
+                )
+                if question.question_html_xml in question_set:
+                    raise UnsupportedContent
+                question_set.add(question.question_html_xml)
+                index += 1
+            elif action == "text":
+                text_region = TextRegion(index=index, md=md, linenum_start=0, linenum_end=0)
+                text_region.set_text(text, 0, 0)
+                yield text_region, re.sub(
+                    EMPTY_ELEMENT_PATTERN, r"<\1\2/>", _get_text_xml(text_region)
+                )
+                index += 1
+            elif question is None or (action == "feedback" and question.choices):
+                # Choice feedbacks are not written by the native writer.
+                raise UnsupportedContent
+            elif action == "feedback":
+                question.append_feedback(text, 0, 0)
+            else:
+                getattr(question, CHOICE_ACTIONS[action])(text, 0, 0)
+
+        if question is not None:
+            yield finalize(question)
+    except Text2qtiError:
+        raise UnsupportedContent
+
+
+def write_qti(content: str, qti_dir: str):
+    """
+    Write the QTI zip of content, in QTI-compatible text format, to qti_dir
+    without going through the text2qti parser.
+
+    Items are read from content and built with text2qti's own classes, so that
+    ids and HTML are the same as text2qti's, and written as the post-processing
+    of its output would rewrite them (see content_to_qti). The XML of every item
+    is held in memory until the assessment is written to the zip.
+    Raise UnsupportedContent for content only text2qti can handle, in which case
+    nothing is written.
+    """
+
+    from text2qti.quiz import Question
+    from text2qti.xml_assessment import AFTER_ITEMS, BEFORE_ITEMS
+    from text2qti.xml_assessment_meta import assessment_meta
+    from text2qti.xml_imsmanifest import imsmanifest
+
+    md = _get_markdown()
+    items_xml = []
+    digests = []
+    points_possible = 0
+    try:
+        for item, item_xml in _iter_items(content, md):
+            items_xml.append(item_xml.encode("utf-8"))
+            if isinstance(item, Question):
+                digests.append(item.hash_digest)
+                points_possible += item.points_possible
+    finally:
+        md.finalize()
+    if not items_xml:
+        raise UnsupportedContent
+
+    h = hashlib.blake2b()
+    for digest in sorted(digests):
+        h.update(digest)
+    quiz_id = h.hexdigest()[:64]
+    assessment_identifier = f"text2qti_assessment_{quiz_id}"
+
+    with ZipFile(qti_dir, "w", compression=ZIP_DEFLATED) as zf:
+        zf.writestr(
+            "imsmanifest.xml",
+            imsmanifest(
+                manifest_identifier=f"text2qti_manifest_{quiz_id}",
+                assessment_identifier=assessment_identifier,
+                dependency_identifier=f"text2qti_dependency_{quiz_id}",
+                images=md.images,
+            ),
+        )
+        zf.writestr(ZipInfo("non_cc_assessments/"), b"")
+        zf.writestr(
+            f"{assessment_identifier}/assessment_meta.xml",
+            assessment_meta(
+                assessment_identifier=assessment_identifier,
+                assignment_identifier=f"text2qti_assignment_{quiz_id}",
+                assignment_group_identifier=f"text2qti_assignment-group_{quiz_id}",
+                title_xml="Quiz",
+                description_html_xml="",
+                points_possible=points_possible,
+                shuffle_answers="false",
+                show_correct_answers="true",
+                one_question_at_a_time="false",
+                cant_go_back="false",
+            ),
+        )
+
+        before_items = BEFORE_ITEMS.format(
+            assessment_identifier=assessment_identifier, title="Quiz"
+        )
+        with zf.open(f"{assessment_identifier}/{assessment_identifier}.xml", "w") as f:
+            f.write(XML_DECLARATION.encode("utf-8"))
+            f.write(before_items.split("\n", 1)[1].encode("utf-8"))
+            for item_xml in items_xml:
+                f.write(item_xml)
+            f.write(AFTER_ITEMS.rstrip("\n").encode("utf-8"))
+
+        for image in md.images.values():
+            zf.writestr(image.qti_zip_path, image.data)
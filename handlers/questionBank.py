@@ -0,0 +1,362 @@
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import time
+import unicodedata
+
+from .contentHandler import ANSWER_PATTERNS, parse_raw_problems
+from .mediaHandler import prepare_assets
+from .problemModel import Passage, Problem
+
+BANK_PATH = os.path.join("bank", "bank.sqlite")
+# Medias of the problems of a bank, next to its database.
+BANK_ASSETS_DIR = "assets"
+
+SELECTOR_KEYS = ["n_problems", "types", "topics", "prompt", "handler", "search", "seed"]
+# SQLite limits the number of variables of a statement.
+MAX_VARIABLES = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS passages (
+    id INTEGER PRIMARY KEY,
+    content_hash TEXT NOT NULL UNIQUE,
+    text TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS problems (
+    id INTEGER PRIMARY KEY,
+    content_hash TEXT NOT NULL UNIQUE,
+    qtype TEXT NOT NULL,
+    prompt TEXT,
+    handler TEXT,
+    source TEXT,
+    topic TEXT,
+    passage_id INTEGER REFERENCES passages (id),
+    question TEXT NOT NULL,
+    answers TEXT NOT NULL,
+    solution TEXT NOT NULL,
+    medias TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS problems_prompt ON problems (prompt);
+CREATE INDEX IF NOT EXISTS problems_handler ON problems (handler);
+CREATE INDEX IF NOT EXISTS problems_qtype ON problems (qtype);
+CREATE INDEX IF NOT EXISTS problems_topic ON problems (topic);
+
+-- Diacritics are ignored, so that "khoa chinh" finds "khóa chính".
+CREATE VIRTUAL TABLE IF NOT EXISTS problems_fts USING fts5 (
+    question,
+    content = 'problems',
+    content_rowid = 'id',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS problems_fts_insert AFTER INSERT ON problems BEGIN
+    INSERT INTO problems_fts (rowid, question) VALUES (new.id, new.question);
+END;
+
+CREATE TRIGGER IF NOT EXISTS problems_fts_delete AFTER DELETE ON problems BEGIN
+    INSERT INTO problems_fts (problems_fts, rowid, question)
+    VALUES ('delete', old.id, old.question);
+END;
+"""
+
+
+def get_problem_type(problem: Problem):
+    """
+    Return the type of problem: multiple_choice, multiple_answers, true_false,
+    short_answer or other.
+    """
+
+    prefixes = [prefix for prefix, _ in problem.answers]
+    if not prefixes:
+        return "other"
+    if all(re.match(ANSWER_PATTERNS["mctf"], prefix) for prefix in prefixes):
+        return "multiple_choice"
+    if all(re.match(ANSWER_PATTERNS["multans"], prefix) for prefix in prefixes):
+        return "multiple_answers"
+    if all(re.match(ANSWER_PATTERNS["shortans"], prefix) for prefix in prefixes):
+        # Same test as the true_false type of problems_to_docx.
+        if len(prefixes) == 1 and re.match(r"^[SD]+$", problem.answers[0].content):
+            return "true_false"
+        return "short_answer"
+    return "other"
+
+
+def _normalize(text: str):
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def _get_content_hash(payload):
+    return hashlib.sha256(
+        json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+def get_content_hash(problem: Problem, asset_paths: dict):
+    """
+    Return the key a problem is stored once under: a hash of its type, its
+    normalized question and solution, its answers sorted with whether they
+    are correct, and the content of its medias, through the name of their
+    asset (see prepare_assets).
+
+    The order of choices, often random (e.g. in get_problem of handlers), and
+    the paths of medias do not change the key, so that the same problem
+    generated again, e.g. replayed from the cache, is not stored twice.
+    """
+
+    return _get_content_hash(
+        [
+            get_problem_type(problem),
+            _normalize(problem.question),
+            _normalize(problem.solution),
+            sorted(
+                ["*" in prefix, _normalize(content)]
+                for prefix, content in problem.answers
+            ),
+            [os.path.basename(asset_paths[media_loc]) for media_loc in problem.medias],
+        ]
+    )
+
+
+def _iter_chunks(values: list):
+    for i in range(0, len(values), MAX_VARIABLES):
+        yield values[i : i + MAX_VARIABLES]
+
+
+class QuestionBank:
+    """
+    Problems of past runs, stored once each in a SQLite database, along with
+    the prompt, handler or source file and topic they came from.
+
+    Problems are indexed by prompt, handler, type, topic and content hash (see
+    get_content_hash), and their question text by full-text search, so that
+    exams can be assembled from the bank without calling the LLM, see sample.
+    """
+
+    def __init__(self, path: str = BANK_PATH):
+        self.path = path
+        self.dir = os.path.dirname(path) or "."
+        self.assets_dir = os.path.join(self.dir, BANK_ASSETS_DIR)
+        os.makedirs(self.dir, exist_ok=True)
+
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(
+        self,
+        problems,
+        prompt: str = None,
+        handler: str = None,
+        source: str = None,
+        topic: str = None,
+    ):
+        """
+        Add problems to the bank, with the prompt and handler or source file
+        they came from, and return the number of problems not already in it.
+
+        Problems keep the passage they follow, if any. Their medias are
+        copied to the assets of the bank, stored once per unique file, and
+        referred to relative to the bank, so that it can be moved around.
+        """
+
+        # Raw problems are parsed, so that they are stored like the others.
+        problems = list(parse_raw_problems(problems))
+        asset_paths = prepare_assets(
+            (
+                media_loc
+                for problem in problems
+                if isinstance(problem, Problem)
+                for media_loc in problem.medias
+            ),
+            self.assets_dir,
+        )
+
+        n_added = 0
+        passage_id = None
+        created_at = time.time()
+        with self.connection:
+            for problem in problems:
+                if isinstance(problem, Passage):
+                    content_hash = _get_content_hash(_normalize(problem.text))
+                    self.connection.execute(
+                        "INSERT OR IGNORE INTO passages (content_hash, text) "
+                        "VALUES (?, ?)",
+                        (content_hash, problem.text),
+                    )
+                    (passage_id,) = self.connection.execute(
+                        "SELECT id FROM passages WHERE content_hash = ?", (content_hash,)
+                    ).fetchone()
+                    continue
+                if not isinstance(problem, Problem):
+                    continue
+
+                cursor = self.connection.execute(
+                    "INSERT OR IGNORE INTO problems (content_hash, qtype, prompt, "
+                    "handler, source, topic, passage_id, question, answers, solution, "
+                    "medias, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        get_content_hash(problem, asset_paths),
+                        get_problem_type(problem),
+                        prompt,
+                        handler,
+                        source,
+                        topic,
+                        passage_id,
+                        problem.question,
+                        json.dumps(problem.answers, ensure_ascii=False),
+                        problem.solution,
+                        json.dumps(
+                            [
+                                os.path.relpath(asset_paths[m], self.dir)
+                                for m in problem.medias
+                            ],
+                            ensure_ascii=False,
+                        ),
+                        created_at,
+                    ),
+                )
+                n_added += cursor.rowcount
+
+        return n_added
+
+    def _load(self, ids: list):
+        # Return the problems of ids in order, each run of problems of the same
+        # passage preceded by the passage.
+        rows = {}
+        for chunk in _iter_chunks(ids):
+            for row in self.connection.execute(
+                "SELECT id, passage_id, question, answers, solution, medias "
+                f"FROM problems WHERE id IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            ):
+                rows[row[0]] = row
+
+        passage_ids = list({row[1] for row in rows.values() if row[1] is not None})
+        passages = {}
+        for chunk in _iter_chunks(passage_ids):
+            passages.update(
+                self.connection.execute(
+                    "SELECT id, text FROM passages "
+                    f"WHERE id IN ({', '.join('?' * len(chunk))})",
+                    chunk,
+                )
+            )
+
+        groups = {}
+        for i in ids:
+            passage_id = rows[i][1]
+            key = i if passage_id is None else ("passage", passage_id)
+            groups.setdefault(key, []).append(i)
+
+        problems = []
+        for key, group in groups.items():
+            if isinstance(key, tuple):
+                problems.append(Passage(passages[key[1]]))
+            for i in group:
+                _, _, question, answers, solution, medias = rows[i]
+                medias = [os.path.join(self.dir, m) for m in json.loads(medias)]
+                problems.append(Problem(question, json.loads(answers), solution, medias))
+        return problems
+
+    def search(self, query: str, limit: int = 20):
+        """
+        Return the problems whose question matches query, a full-text search
+        query (e.g. "khóa chính", "database OR sql"), best matches first.
+        """
+
+        ids = [
+            row[0]
+            for row in self.connection.execute(
+                "SELECT rowid FROM problems_fts WHERE problems_fts MATCH ? "
+                "ORDER BY rank LIMIT ?",
+                (query, limit),
+            )
+        ]
+        return self._load(ids)
+
+    def sample(
+        self,
+        n_problems: int = None,
+        types: dict = None,
+        topics: dict = None,
+        prompt: str = None,
+        handler: str = None,
+        search: str = None,
+        seed=None,
+        exclude: set = None,
+    ):
+        """
+        Return a random sample of problems from the bank, with the ids of the
+        problems sampled.
+
+        :param n_problems: Number of problems, by default the sum of the quotas,
+            or else every matching problem.
+        :param types: Number of problems per type (see get_problem_type), e.g.
+            {"multiple_choice": 15, "true_false": 5}. Other types are left out.
+        :param topics: Number of problems per topic, as types.
+        :param prompt: Only sample problems generated with this prompt.
+        :param handler: Only sample problems generated with this handler.
+        :param search: Only sample problems whose question matches this
+            full-text search query.
+        :param seed: Seed of the sample, the same seed gives the same sample.
+        :param exclude: Ids of problems not to sample, e.g. already sampled.
+        """
+
+        if n_problems is None and (types or topics):
+            n_problems = sum((types or topics).values())
+        exclude = exclude or set()
+
+        conditions = []
+        params = []
+        for column, value in [("prompt", prompt), ("handler", handler)]:
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        for column, quotas in [("qtype", types), ("topic", topics)]:
+            if quotas:
+                conditions.append(f"{column} IN ({', '.join('?' * len(quotas))})")
+                params += list(quotas)
+        if search is not None:
+            conditions.append(
+                "id IN (SELECT rowid FROM problems_fts WHERE problems_fts MATCH ?)"
+            )
+            params.append(search)
+
+        rows = self.connection.execute(
+            "SELECT id, qtype, topic FROM problems"
+            + (f" WHERE {' AND '.join(conditions)}" if conditions else "")
+            + " ORDER BY id",
+            params,
+        ).fetchall()
+        random.Random(seed).shuffle(rows)
+
+        ids = []
+        counts = {}
+        for i, qtype, topic in rows:
+            if n_problems is not None and len(ids) >= n_problems:
+                break
+            if i in exclude:
+                continue
+            if types and counts.get(("qtype", qtype), 0) >= types[qtype]:
+                continue
+            if topics and counts.get(("topic", topic), 0) >= topics[topic]:
+                continue
+            ids.append(i)
+            counts[("qtype", qtype)] = counts.get(("qtype", qtype), 0) + 1
+            counts[("topic", topic)] = counts.get(("topic", topic), 0) + 1
+
+        return self._load(ids), ids
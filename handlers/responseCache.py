@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import time
+
+CACHE_DIR = os.path.join(".cache", "responses")
+CACHE_MODES = ["off", "read", "readwrite"]
+
+# Eviction limits, overridable with [global] cache_max_size_mb / cache_max_age_days.
+CACHE_MAX_SIZE_MB = 512
+CACHE_MAX_AGE_DAYS = 30
+
+
+def _to_jsonable(value):
+    # Pydantic models (e.g. response schemas), without importing pydantic.
+    if isinstance(value, type) and hasattr(value, "model_json_schema"):
+        return value.model_json_schema()
+    if isinstance(value, dict):
+        return {str(k): _to_jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_jsonable(v) for v in value]
+    return value
+
+
+def get_cache_key(
+    prompt_content: str,
+    handler_source: str,
+    config: dict,
+    model: str,
+    extra_cfg: dict,
+    n_problems: int,
+    replica: int = 0,
+):
+    """
+    Content-addressed key of a single LLM request.
+
+    `config` is the handler's generation config, including its response schema.
+    `replica` tells apart identical requests made within the same run (e.g.
+    shards of a batch), which would otherwise share one cached response.
+    """
+
+    payload = json.dumps(
+        {
+            "prompt_content": prompt_content,
+            "handler_source": handler_source,
+            "config": _to_jsonable(config),
+            "model": model,
+            "extra_cfg": _to_jsonable(extra_cfg),
+            "n_problems": n_problems,
+            "replica": replica,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        mode: str = "off",
+        cache_dir: str = CACHE_DIR,
+        max_size_mb: float = CACHE_MAX_SIZE_MB,
+        max_age_days: float = CACHE_MAX_AGE_DAYS,
+    ):
+        if mode not in CACHE_MODES:
+            raise ValueError(
+                f"Invalid cache mode: {mode}. Expected one of {', '.join(CACHE_MODES)}."
+            )
+
+        self.mode = mode
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024 * 1024
+        self.max_age = max_age_days * 24 * 60 * 60
+
+        if self.mode != "off":
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @property
+    def can_read(self):
+        return self.mode in ["read", "readwrite"]
+
+    @property
+    def can_write(self):
+        return self.mode == "readwrite"
+
+    def _get_entry_dir(self, key: str):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str):
+        if not self.can_read:
+            return None
+
+        entry_dir = self._get_entry_dir(key)
+        try:
+            if time.time() - os.path.getmtime(entry_dir) > self.max_age:
+                return None
+            with open(entry_dir, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # Refresh mtime so that eviction drops the least recently used entries first.
+        os.utime(entry_dir)
+        return entry["response"]
+
+    def put(self, key: str, response: str, meta: dict = None):
+        if not self.can_write:
+            return
+
+        entry_dir = self._get_entry_dir(key)
+        tmp_dir = f"{entry_dir}.tmp"
+        with open(tmp_dir, "w", encoding="utf-8") as f:
+            json.dump(
+                {"response": response, "created": time.time()} | (meta or {}),
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(tmp_dir, entry_dir)
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".json"):
+                continue
+            stat = entry.stat()
+            if now - stat.st_mtime > self.max_age:
+                os.remove(entry.path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(entry_dir)
+            total_size -= size
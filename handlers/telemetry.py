@@ -0,0 +1,244 @@
+import json
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+METRICS_NAME = "metrics.json"
+PERCENTILES = [50, 95, 99]
+
+TOKEN_STATS_PATH = os.path.join(".cache", "token_stats.json")
+# Weight of the latest call in the average output tokens per problem.
+TOKEN_STATS_ALPHA = 0.3
+# Share of the output token limit a request is planned to use at most.
+TOKEN_HEADROOM = 0.8
+
+_call_stats = ContextVar("call_stats", default=None)
+
+
+class CallStats:
+    """
+    Stats of a single LLM call, filled in by the client layer (see llmClient)
+    while the call runs in a context where it is current, see track_call.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.time_to_first_token = None
+        self.retries = 0
+        self.prompt_tokens = None
+        self.output_tokens = None
+        self.cached_tokens = None
+
+    def on_first_token(self):
+        if self.time_to_first_token is None:
+            self.time_to_first_token = time.perf_counter() - self.start
+
+    def on_response(self, response):
+        # Streamed chunks all carry the usage so far, the last one wins.
+        usage = getattr(response, "usage_metadata", None)
+        if usage is None:
+            return
+        self.prompt_tokens = usage.prompt_token_count
+        self.output_tokens = usage.candidates_token_count
+        self.cached_tokens = usage.cached_content_token_count
+
+
+def get_call_stats():
+    """
+    Return the stats of the current LLM call, or None outside of track_call.
+    """
+
+    return _call_stats.get()
+
+
+def track_call():
+    """
+    Make new stats current for the LLM call about to run in this context, and
+    return them. Calls run in an executor must be run in a copy of this
+    context (contextvars.copy_context) to be tracked.
+    """
+
+    stats = CallStats()
+    _call_stats.set(stats)
+    return stats
+
+
+def _percentile(values: list, p: float):
+    # Linear interpolation between the closest ranks.
+    values = sorted(values)
+    if not values:
+        return None
+    k = (len(values) - 1) * p / 100
+    i = int(k)
+    j = min(i + 1, len(values) - 1)
+    return values[i] + (values[j] - values[i]) * (k - i)
+
+
+def _get_distribution(values: list):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    return {
+        **{f"p{p}": round(_percentile(values, p), 4) for p in PERCENTILES},
+        "mean": round(sum(values) / len(values), 4),
+        "max": round(max(values), 4),
+    }
+
+
+def _sum(values: list):
+    return sum(v for v in values if v is not None)
+
+
+class Telemetry:
+    """
+    Records of the LLM calls of a content_handler run, summarized per handler
+    in metrics.json.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def now(self):
+        return time.perf_counter() - self.start
+
+    def record(
+        self,
+        handler: str,
+        batch: str,
+        shard: int,
+        started: float,
+        queued: float,
+        stats: CallStats = None,
+        n_problems: int = 0,
+        cached: bool = False,
+        error: str = None,
+    ):
+        """
+        Record a call of handler for a shard of batch, started at started
+        seconds into the run after waiting queued seconds for a free slot, and
+        ending now. The time to first token is only known for streamed calls.
+        """
+
+        ended = self.now()
+        stats = stats or CallStats()
+        with self._lock:
+            self.calls.append(
+                {
+                    "handler": handler,
+                    "batch": batch,
+                    "shard": shard,
+                    "started": round(started, 4),
+                    "queued": round(queued, 4),
+                    "wall_time": round(ended - started, 4),
+                    "time_to_first_token": None
+                    if stats.time_to_first_token is None
+                    else round(stats.time_to_first_token, 4),
+                    "prompt_tokens": stats.prompt_tokens,
+                    "output_tokens": stats.output_tokens,
+                    "cached_tokens": stats.cached_tokens,
+                    "retries": stats.retries,
+                    "n_problems": n_problems,
+                    "cached": cached,
+                    "error": error,
+                }
+            )
+
+    def _get_handler_summary(self, calls: list):
+        # Cached responses take no time, latencies are those of actual calls.
+        llm_calls = [call for call in calls if not call["cached"]]
+        n_problems = _sum(call["n_problems"] for call in calls)
+        span = max(call["started"] + call["wall_time"] for call in calls) - min(
+            call["started"] for call in calls
+        )
+        return {
+            "calls": len(llm_calls),
+            "cached": len(calls) - len(llm_calls),
+            "errors": sum(call["error"] is not None for call in calls),
+            "retries": _sum(call["retries"] for call in calls),
+            "problems": n_problems,
+            "problems_per_second": round(n_problems / span, 2) if span > 0 else None,
+            "wall_time": _get_distribution([c["wall_time"] for c in llm_calls]),
+            "time_to_first_token": _get_distribution(
+                [c["time_to_first_token"] for c in llm_calls]
+            ),
+            "queued": _get_distribution([c["queued"] for c in llm_calls]),
+            "tokens": {
+                name: _sum(call[f"{name}_tokens"] for call in llm_calls)
+                for name in ["prompt", "output", "cached"]
+            },
+        }
+
+    def get_metrics(self, n_problems: int):
+        """
+        Return the metrics of the run so far, which produced n_problems
+        problems in all, including those of manual batches.
+        """
+
+        elapsed = self.now()
+        handlers = {}
+        for call in self.calls:
+            handlers.setdefault(call["handler"], []).append(call)
+
+        return {
+            "elapsed": round(elapsed, 4),
+            "problems": n_problems,
+            "problems_per_second": round(n_problems / elapsed, 2) if elapsed > 0 else None,
+            "handlers": {
+                name: self._get_handler_summary(calls) for name, calls in handlers.items()
+            },
+            "calls": self.calls,
+        }
+
+    def save(self, metrics_dir: str, n_problems: int):
+        metrics = self.get_metrics(n_problems)
+        with open(metrics_dir, "w", encoding="utf-8") as f:
+            json.dump(metrics, f, ensure_ascii=False, indent=2)
+        return metrics
+
+
+class TokenStats:
+    """
+    Average output tokens per problem of each handler, learned from the calls
+    of past runs and kept in TOKEN_STATS_PATH, so that requests can be sized
+    to fit the output token limit, see get_max_problems.
+    """
+
+    def __init__(self, path: str = TOKEN_STATS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.tokens_per_problem = json.load(f)
+        except (OSError, ValueError):
+            self.tokens_per_problem = {}
+
+    def update(self, handler: str, stats: CallStats, n_problems: int):
+        if not n_problems or not stats.output_tokens:
+            return
+        value = stats.output_tokens / n_problems
+        with self._lock:
+            previous = self.tokens_per_problem.get(handler)
+            self.tokens_per_problem[handler] = (
+                value
+                if previous is None
+                else previous + TOKEN_STATS_ALPHA * (value - previous)
+            )
+
+    def get_max_problems(self, handler: str, max_output_tokens: int):
+        """
+        Return the number of problems of handler a request can ask for without
+        being cut off by max_output_tokens, or None if not known yet.
+        """
+
+        tokens_per_problem = self.tokens_per_problem.get(handler)
+        if not tokens_per_problem:
+            return None
+        return max(1, int(max_output_tokens * TOKEN_HEADROOM / tokens_per_problem))
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(self.tokens_per_problem, f, indent=2)
@@ -0,0 +1,160 @@
+import json
+import os
+import random
+import re
+
+from rich import print
+
+from .contentHandler import ANSWER_PATTERNS, parse_raw_problems
+from .exportHandler import run_exports_to_dirs
+from .problemModel import Passage, Problem
+
+VARIANTS_NAME = "variants.json"
+VARIANT_DIR_FORMAT = "variant_{}"
+# Statements of true/false problems, as split by problems_to_docx.
+STATEMENT_PATTERN = r"^\*?[a-zA-Z]\)"
+
+
+def _is_true_false(problem: Problem):
+    # Same test as the true_false type of problems_to_docx.
+    prefix, content = problem.answers[0]
+    return (
+        len(problem.answers) == 1
+        and re.match(ANSWER_PATTERNS["shortans"], prefix)
+        and not re.match(ANSWER_PATTERNS["mctf"], prefix)
+        and re.match(r"^[SD]+$", content)
+    )
+
+
+def _relabel(prefix: str, i: int):
+    # e.g. "*c)" moved to the first position becomes "*a)".
+    letter = chr(ord("a" if prefix.lstrip("*")[0].islower() else "A") + i)
+    return f"{'*' if prefix.startswith('*') else ''}{letter})"
+
+
+def _shuffle_choices(problem: Problem, rng: random.Random):
+    """
+    Return problem with its choices shuffled, along with the original index of
+    each choice, or None if its choices cannot be shuffled (e.g. short answers).
+    """
+
+    prefixes = [prefix for prefix, _ in problem.answers]
+    if len(prefixes) > 1 and all(
+        re.match(ANSWER_PATTERNS["mctf"], prefix) for prefix in prefixes
+    ):
+        order = list(range(len(prefixes)))
+        rng.shuffle(order)
+        answers = [
+            (_relabel(problem.answers[j].prefix, i), problem.answers[j].content)
+            for i, j in enumerate(order)
+        ]
+        return problem.replace(answers=answers), order
+
+    if len(prefixes) > 1 and all(
+        re.match(ANSWER_PATTERNS["multans"], prefix) for prefix in prefixes
+    ):
+        order = list(range(len(prefixes)))
+        rng.shuffle(order)
+        return problem.replace(answers=[problem.answers[j] for j in order]), order
+
+    if problem.answers and _is_true_false(problem):
+        # Statements are part of the question, each answered by a letter D or S.
+        parts = re.split(f"({STATEMENT_PATTERN})", problem.question, flags=re.MULTILINE)
+        labels, statements = parts[1::2], parts[2::2]
+        answer = problem.answers[0].content
+        if len(statements) != len(answer):
+            return problem, None
+
+        order = list(range(len(statements)))
+        rng.shuffle(order)
+        # Labels and the blank lines after each statement stay in place.
+        separators = [s[len(s.rstrip("\n")) :] for s in statements]
+        question = parts[0] + "".join(
+            labels[i] + statements[j].rstrip("\n") + separators[i]
+            for i, j in enumerate(order)
+        )
+        answers = [(problem.answers[0].prefix, "".join(answer[j] for j in order))]
+        return problem.replace(question=question, answers=answers), order
+
+    return problem, None
+
+
+def make_variant(problems: list, rng: random.Random):
+    """
+    Return a variant of problems, with the order of problems and of their
+    choices shuffled, along with a record of both permutations.
+
+    Passages stay in place, problems are only shuffled among those between the
+    same two passages, so that each passage is still followed by its problems.
+    Raw problems are parsed first, so that they are shuffled like the others,
+    and the record refers to the parsed problems.
+    """
+
+    problems = list(parse_raw_problems(problems))
+    segments = [[]]
+    for i, problem in enumerate(problems):
+        if isinstance(problem, Passage):
+            segments.append([])
+        segments[-1].append(i)
+
+    order = []
+    for segment in segments:
+        if segment and isinstance(problems[segment[0]], Passage):
+            order.append(segment.pop(0))
+        rng.shuffle(segment)
+        order += segment
+
+    variant = []
+    choices = []
+    for i in order:
+        problem = problems[i]
+        choices_order = None
+        if isinstance(problem, Problem):
+            problem, choices_order = _shuffle_choices(problem, rng)
+        variant.append(problem)
+        choices.append(choices_order)
+
+    return variant, {"order": order, "choices": choices}
+
+
+def export_variants(
+    problems: list,
+    path: str,
+    n_variants: int,
+    targets: list,
+    seed: int = None,
+):
+    """
+    Export n_variants shuffled variants of problems to variant_1, variant_2...
+    in path, each with an answer key, all exports running concurrently.
+
+    Variant k is shuffled with a generator seeded from seed and k, so that the
+    same seed always gives the same variants. The seed and the permutations of
+    each variant are recorded in variants.json in path.
+    """
+
+    if seed is None:
+        seed = random.randrange(1 << 32)
+    # Parsed once for all variants.
+    problems = list(parse_raw_problems(problems))
+
+    sources = {}
+    records = []
+    for k in range(1, n_variants + 1):
+        dir_variant = os.path.join(path, VARIANT_DIR_FORMAT.format(k))
+        os.makedirs(dir_variant, exist_ok=True)
+
+        variant, record = make_variant(problems, random.Random(f"{seed}:{k}"))
+        sources[dir_variant] = variant
+        records.append({"dir": VARIANT_DIR_FORMAT.format(k), **record})
+
+    with open(os.path.join(path, VARIANTS_NAME), "w", encoding="utf-8") as f:
+        json.dump({"seed": seed, "variants": records}, f, ensure_ascii=False, indent=2)
+
+    print(
+        f"[green]Đã tạo {n_variants} đề hoán vị với seed [white]{seed}[/white].[/green]"
+    )
+
+    if "answer_key" not in targets:
+        targets = list(targets) + ["answer_key"]
+    run_exports_to_dirs(targets, sources)
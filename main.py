@@ -1,82 +1,129 @@
 import os
+import re
+import subprocess
+import sys
 from datetime import datetime
 
-import tomli
 from clize import ArgumentError, run
 from rich import print
 
-from handlers import content_handler, docx_handler, qti_handler
+from handlers.responseCache import CACHE_MODES
 
 CONFIG_FILE = "config.toml"
 PROMPTS_DIR = "prompts"
 
 
-def txt_to_docx(*, input: "i", output: "o" = None):
+def _parse_targets(targets: str):
+    from handlers.exportHandler import parse_targets
+
+    try:
+        return parse_targets(targets)
+    except KeyError as e:
+        raise ArgumentError(e.args[0])
+
+
+def _profile_imports():
+    # Run the same command again without the flag, see profile_imports.
+    argv = sys.argv[1:]
+    argv.remove("--import-profile")
+    sys.exit(profile_imports(argv))
+
+
+def _check_variants(variants: int):
+    if variants < 0:
+        raise ArgumentError(f"Invalid number of variants: {variants}.")
+
+
+def txt_to_docx(*, input: "i", output: "o" = None, import_profile: bool = False):
     """
     Generate exam content in docx format from QTI-compatible text format.
 
     :param input: Path to input file in QTI-compatible text format.
     :param output: Path to output. Will be created if not exists. (default: dist/{datetime})
+    :param import_profile: Run the command, then report the time spent importing each module.
     """
 
+    if import_profile:
+        _profile_imports()
+
     if output is None:
         output = os.path.join("dist", datetime.now().strftime("%Y%m%d_%H%M%S"))
         os.makedirs(output)
     elif not os.path.isdir(output):
         raise ArgumentError(f"Not a directory: {output}")
 
-    print("[yellow]Đang tạo file docx...[/yellow]")
+    from handlers.exportHandler import run_exports
 
-    docx_handler(input, output)
-
-    print(
-        "[blue]└── [/blue]"
-        "[green]Đã tạo file docx thành công: [/green]"
-        f"[white]{os.path.join(output, 'exam.docx')}[/white]"
-    )
+    run_exports(["docx"], input, output, from_file=True)
 
 
-def txt_to_qti(*, input: "i", output: "o" = None):
+def txt_to_qti(*, input: "i", output: "o" = None, import_profile: bool = False):
     """
     Generate exam in QTI format from QTI-compatible text format.
 
     :param input: Path to input file in QTI-compatible text format.
     :param output: Path to output. Will be created if not exists. (default: dist/{datetime})
+    :param import_profile: Run the command, then report the time spent importing each module.
     """
 
+    if import_profile:
+        _profile_imports()
+
     if output is None:
         output = os.path.join("dist", datetime.now().strftime("%Y%m%d_%H%M%S"))
         os.makedirs(output)
     elif not os.path.isdir(output):
         raise ArgumentError(f"Not a directory: {output}")
 
-    print("[yellow]Đang tạo file zip QTI...[/yellow]")
-
-    qti_handler(input, output)
+    from handlers.exportHandler import run_exports
 
-    print(
-        "[blue]└── [/blue]"
-        "[green]Đã tạo file zip QTI thành công: [/green]"
-        f"[white]{os.path.join(output, 'qti.zip')}[/white]"
-    )
+    run_exports(["qti"], input, output, from_file=True)
 
 
-def txt_to_docx_qti(*, input: "i", output: "o" = None):
+def txt_to_docx_qti(
+    *,
+    input: "i",
+    output: "o" = None,
+    targets: str = "docx,qti",
+    variants: int = 0,
+    seed: int = None,
+    import_profile: bool = False,
+):
     """
     Generate exam content in docx format, along with exam in QTI format, from QTI-compatible text format.
 
     :param input: Path to input file in QTI-compatible text format.
     :param output: Path to output. Will be created if not exists. (default: dist/{datetime})
+    :param targets: Comma-separated formats to export to in parallel, among docx, qti, answer_key.
+    :param variants: Number of shuffled variants of the exam to export, each with its answer key.
+    :param seed: Seed of the shuffled variants. (default: random, recorded in variants.json)
+    :param import_profile: Run the command, then report the time spent importing each module.
     """
 
+    if import_profile:
+        _profile_imports()
+
+    targets = _parse_targets(targets)
+    _check_variants(variants)
+
     if output is None:
         output = os.path.join("dist", datetime.now().strftime("%Y%m%d_%H%M%S"))
         os.makedirs(output)
     elif not os.path.isdir(output):
         raise ArgumentError(f"Not a directory: {output}")
 
-    txt_to_docx(input=input, output=output)
-    txt_to_qti(input=input, output=output)
+    if variants:
+        from handlers.contentHandler import txt_to_json
+        from handlers.variantHandler import export_variants
+
+        with open(input, "r", encoding="utf-8") as f:
+            problems = txt_to_json(f.read())
+        export_variants(problems, output, variants, targets, seed)
+        return
+
+    from handlers.exportHandler import run_exports
+
+    run_exports(targets, input, output, from_file=True)
 
 
 def main(
@@ -84,6 +131,12 @@ def main(
     config: "c" = "config.toml",
     output: "o" = None,
     raw_content_only: "r" = False,
+    cache: str = "off",
+    replay: bool = False,
+    targets: str = "docx,qti",
+    variants: int = 0,
+    seed: int = None,
+    import_profile: bool = False,
 ):
     """
     Generate a exam from LLM prompts.
@@ -91,14 +144,34 @@ def main(
     :param config: Path to config file.
     :param output: Path to output. Will be created if not exists. (default: dist/{datetime})
     :param raw_content_only: docx and QTI zip files will not be generated.
+    :param cache: LLM response cache mode, one of off, read, readwrite.
+    :param replay: Only use cached LLM responses, never call the LLM.
+    :param targets: Comma-separated formats to export to in parallel, among docx, qti, answer_key.
+    :param variants: Number of shuffled variants of the exam to export, each with its answer key.
+    :param seed: Seed of the shuffled variants. (default: random, recorded in variants.json)
+    :param import_profile: Run the command, then report the time spent importing each module.
     """
 
+    if import_profile:
+        _profile_imports()
+
+    if cache not in CACHE_MODES:
+        raise ArgumentError(
+            f"Invalid cache mode: {cache}. Expected one of {', '.join(CACHE_MODES)}."
+        )
+    targets = _parse_targets(targets)
+    _check_variants(variants)
+
     if output is None:
         output = os.path.join("dist", datetime.now().strftime("%Y%m%d_%H%M%S"))
         os.makedirs(output)
     elif not os.path.isdir(output):
         raise ArgumentError(f"Not a directory: {output}")
 
+    import tomli
+
+    from handlers.contentHandler import content_handler
+
     with open(config, "r", encoding="utf-8") as log:
         config_all = tomli.loads(log.read())
 
@@ -114,6 +187,7 @@ def main(
 
     keys_per_prompt_generated = ["prompt", "handler"]
     keys_per_prompt_manual = ["source"]
+    keys_per_prompt_bank = ["from_bank"]
 
     config_global = config_all.get("global", {})
 
@@ -124,6 +198,8 @@ def main(
             mode = "generated"
         if all((key in config_per_prompt_curr) for key in keys_per_prompt_manual):
             mode = "manual"
+        if all((key in config_per_prompt_curr) for key in keys_per_prompt_bank):
+            mode = "bank"
 
         if not mode:
             raise KeyError(f"Batch {i}: Insufficient keys.")
@@ -133,14 +209,62 @@ def main(
 
     print("[yellow]Đang tạo nội dung đề thi...[/yellow]")
 
-    content_handler(path, config_global, config_per_prompt)
+    problems = content_handler(
+        path, config_global, config_per_prompt, cache_mode=cache, replay=replay
+    )
 
     if raw_content_only:
         print("[green]File zip QTI và file docx sẽ không được tạo.[/green]")
-    else:
-        txt_to_docx_qti(
-            input=os.path.join(path, "content.txt"), output=os.path.join(path)
-        )
+        return
+
+    # The generated problems are exported as is, content.txt is not read back.
+    if variants:
+        from handlers.variantHandler import export_variants
+
+        export_variants(problems, path, variants, targets, seed)
+        return
+
+    from handlers.exportHandler import run_exports
+
+    run_exports(targets, problems, path)
+
+
+def profile_imports(argv: list, n_modules: int = 25):
+    """
+    Run main.py again with the given arguments under `python -X importtime`,
+    then report the modules that took the longest to import.
+    """
+
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", os.path.abspath(__file__), *argv],
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+
+    import_times = []
+    for line in process.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)", line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            import_times.append((int(cumulative_us), int(self_us), len(indent), module))
+        elif not line.startswith("import time:"):
+            sys.stderr.write(line + "\n")
+
+    from rich.table import Table
+
+    table = Table(title="Import time per module")
+    for column in ["module", "cumulative (ms)", "self (ms)"]:
+        table.add_column(column, justify="left" if column == "module" else "right")
+    for cumulative_us, self_us, _, module in sorted(import_times, reverse=True)[
+        :n_modules
+    ]:
+        table.add_row(module, f"{cumulative_us / 1000:.1f}", f"{self_us / 1000:.1f}")
+
+    total_us = sum(cumulative_us for cumulative_us, _, indent, _ in import_times if indent == 0)
+    print(table)
+    print(f"[green]Tổng thời gian import: [white]{total_us / 1000:.1f} ms[/white][/green]")
+
+    return process.returncode
 
 
 if __name__ == "__main__":
@@ -0,0 +1,28 @@
+from handlers import qtiHandler
+
+
+def _build_qti(fork: str, content: str, source_name: str):
+    if fork.startswith("broken"):
+        raise ValueError(f"{fork} cannot parse {source_name}")
+    return fork.encode()
+
+
+def test_try_forks_returns_first_success(monkeypatch):
+    monkeypatch.setattr(qtiHandler, "_build_qti", _build_qti)
+
+    fork, zip_bytes, errors = qtiHandler._try_forks(
+        ["broken", "first", "second"], "", "quiz"
+    )
+
+    assert (fork, zip_bytes) == ("first", b"first")
+    assert list(errors) == ["broken"]
+
+
+def test_try_forks_reports_every_error(monkeypatch):
+    monkeypatch.setattr(qtiHandler, "_build_qti", _build_qti)
+
+    fork, zip_bytes, errors = qtiHandler._try_forks(["broken_a", "broken_b"], "", "quiz")
+
+    assert (fork, zip_bytes) == (None, None)
+    assert sorted(errors) == ["broken_a", "broken_b"]
+    assert all(isinstance(error, ValueError) for error in errors.values())
@@ -0,0 +1,37 @@
+import os
+import shutil
+
+from handlers.problemModel import Passage, Problem
+from handlers.questionBank import QuestionBank
+
+MEDIA = os.path.join(
+    os.path.dirname(__file__), "..", "examples", "example_a", "example.jpg"
+)
+
+
+def _get_batch(media_loc: str, reverse: bool):
+    # Choices in another order, as get_problem of handlers shuffles them.
+    choices = [("*a)", "Khóa chính"), ("b)", "Khóa ngoại"), ("c)", "Chỉ mục")]
+    if reverse:
+        choices = [("a)", "Chỉ mục"), ("b)", "Khóa ngoại"), ("*c)", "Khóa chính")]
+    return [
+        Passage("Đọc đoạn văn sau."),
+        Problem("Cột nào định danh mỗi dòng?", choices, "Khóa chính.", [media_loc]),
+        Problem("Bảng có  bao nhiêu khóa chính?", [("*", "1")]),
+    ]
+
+
+def test_add_same_batch_twice(tmp_path):
+    media_a = str(tmp_path / "a.jpg")
+    media_b = str(tmp_path / "other" / "b.jpg")
+    os.makedirs(os.path.dirname(media_b))
+    shutil.copy(MEDIA, media_a)
+    shutil.copy(MEDIA, media_b)
+
+    with QuestionBank(str(tmp_path / "bank" / "bank.sqlite")) as bank:
+        assert bank.add(_get_batch(media_a, False), prompt="p", handler="h") == 2
+        assert bank.add(_get_batch(media_b, True), prompt="p", handler="h") == 0
+
+        count = "SELECT COUNT(*) FROM {}"
+        assert bank.connection.execute(count.format("problems")).fetchone() == (2,)
+        assert bank.connection.execute(count.format("passages")).fetchone() == (1,)
@@ -0,0 +1,47 @@
+import random
+
+from handlers.problemModel import Problem, Raw
+from handlers.variantHandler import _shuffle_choices, make_variant
+
+
+def test_shuffle_true_false_keeps_blank_lines():
+    problem = Problem(
+        "Context here.\n\na) Stmt one\n\nb) Stmt two\n\nc) Stmt three\n\nd) Stmt four\n",
+        [("*", "DSSD")],
+        "",
+        [],
+    )
+
+    shuffled, order = _shuffle_choices(problem, random.Random(1))
+
+    assert order == [3, 0, 2, 1]
+    assert shuffled.question == (
+        "Context here.\n\na) Stmt four\n\nb) Stmt one\n\nc) Stmt three\n\nd) Stmt two\n"
+    )
+    assert shuffled.answers[0].content == "DDSS"
+
+
+def test_make_variant_shuffles_raw_problems():
+    raw = Raw(
+        "".join(
+            f"{i}.    Question {i}?\n\n*a)   Yes {i}.\n\nb)    No {i}.\n\nc)    Maybe {i}.\n\n"
+            for i in range(1, 7)
+        )
+    )
+
+    variants = [
+        make_variant([Problem("Before?", [("*a)", "Yes."), ("b)", "No.")]), raw], rng)
+        for rng in (random.Random(seed) for seed in range(5))
+    ]
+
+    for variant, record in variants:
+        assert len(variant) == 7
+        assert not any(isinstance(problem, Raw) for problem in variant)
+        assert sorted(record["order"]) == list(range(7))
+    orders = {tuple(record["order"]) for _, record in variants}
+    choices = {
+        tuple(tuple(order or ()) for order in record["choices"])
+        for _, record in variants
+    }
+    assert len(orders) > 1
+    assert len(choices) > 1